@@ -100,7 +100,7 @@ def boolean(flag):
     raise ValueError('Unknown flag %r' % s)
 
 config.read(soft_mem_limit=int, hard_mem_limit=int, port=int,
-            multi_user=boolean)
+            multi_user=boolean, max_outstanding_tasks=int)
 
 if config.directory.custom_tmp:
     os.environ['TMPDIR'] = config.directory.custom_tmp
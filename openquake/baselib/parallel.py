@@ -148,12 +148,15 @@ import os
 import sys
 import mock
 import time
+import queue
 import socket
 import signal
 import pickle
+import weakref
 import inspect
 import logging
 import operator
+import tempfile
 import functools
 import itertools
 import traceback
@@ -172,6 +175,8 @@ from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize)
 
 cpu_count = multiprocessing.cpu_count()
+# directory where the shared arrays are published, in memory if possible
+SHM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
 OQ_DISTRIBUTE = os.environ.get('OQ_DISTRIBUTE', 'processpool').lower()
 if OQ_DISTRIBUTE == 'futures':  # legacy name
     print('Warning: OQ_DISTRIBUTE=futures is deprecated', file=sys.stderr)
@@ -289,6 +294,66 @@ def pickle_sequence(objects):
     return out
 
 
+def _remove(path, pid):
+    # remove the file, only if called by the process that created it
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+class SharedArray(object):
+    """
+    A large read-only array published once in a memory-mapped .npy file,
+    by default in /dev/shm, i.e. in shared memory. Pickling a SharedArray
+    transfers only the path of the file: the unpickled instances attach to
+    the file in read-only mode, so the processes of the pool share the
+    same memory pages and the data are never serialized nor copied.
+
+    >>> shared = SharedArray(numpy.arange(3))
+    >>> pickle.loads(pickle.dumps(shared)).array
+    array([0, 1, 2])
+    >>> shared.close()
+
+    The file is removed when the publishing instance is closed, garbage
+    collected or at the exit of the publishing process.
+
+    :param array: the array to publish
+    :param dirname: the directory where to save it (default SHM_DIR)
+    """
+    def __init__(self, array, dirname=SHM_DIR):
+        fd, self.path = tempfile.mkstemp(
+            dir=dirname, prefix='oq-shared-', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        self.pid = os.getpid()
+        self._attach()
+        self._finalizer = weakref.finalize(self, _remove, self.path, self.pid)
+
+    def _attach(self):
+        # a plain ndarray view keeping the underlying memmap alive
+        self.array = numpy.load(self.path, mmap_mode='r').view(numpy.ndarray)
+
+    def close(self):
+        """
+        Remove the underlying file, if called by the publishing process.
+        The already attached arrays stay valid.
+        """
+        _remove(self.path, self.pid)
+
+    def __getstate__(self):
+        return dict(path=self.path, pid=self.pid)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def __len__(self):
+        return len(self.array)
+
+    def __repr__(self):
+        return '<%s %s%s %s>' % (self.__class__.__name__, self.array.dtype,
+                                 self.array.shape, self.path)
+
+
 class Result(object):
     """
     :param val: value to return or exception instance
@@ -356,6 +421,13 @@ def safely_call(func, args):
     return zsocket.num_sent if backurl else res
 
 
+def _combine(combine, piks):
+    """
+    Combine the given pickled results with the function `combine`
+    """
+    return functools.reduce(combine, (pik.unpickle() for pik in piks))
+
+
 if OQ_DISTRIBUTE.startswith('celery'):
     from celery.result import ResultSet
     from celery import Celery
@@ -372,7 +444,8 @@ class IterResult(object):
     :param taskname:
         the name of the task
     :param num_tasks:
-        the total number of expected tasks
+        the total number of expected tasks, or None if the tasks are
+        submitted in streaming mode and their number is not known yet
     :param progress:
         a logging function for the progress report
     :param sent:
@@ -387,14 +460,17 @@ class IterResult(object):
         self.sent = sent
         self.progress = progress
         self.received = []
-        if self.num_tasks:
+        self.pool = None  # set by the Starmap when running on a pool
+        self.task_data_dt = numpy.dtype(
+            [('taskno', numpy.uint32), ('weight', numpy.float32),
+             ('duration', numpy.float32), ('received', numpy.int64)])
+        if self.num_tasks is None:  # streaming, the data are not sent yet
+            return
+        elif self.num_tasks:
             self.log_percent = self._log_percent()
             next(self.log_percent)
         else:
             self.progress('No %s tasks were submitted', self.name)
-        self.task_data_dt = numpy.dtype(
-            [('taskno', numpy.uint32), ('weight', numpy.float32),
-             ('duration', numpy.float32), ('received', numpy.int64)])
         self.progress('Sent %s of data in %s task(s)',
                       humansize(sent.sum()), num_tasks)
 
@@ -413,24 +489,36 @@ class IterResult(object):
         yield done
 
     def __iter__(self):
+        for result in self._iter_results():
+            yield result.get()
+
+    def _iter_results(self):
+        # yield the Result objects, still pickled
         self.received = []
         if self.num_tasks == 0:
             return
+        streaming = self.num_tasks is None
         for result in self.iresults:
             check_mem_usage()  # log a warning if too much memory is used
             if isinstance(result, BaseException):
                 # this happens with WorkerLostError with celery
                 raise result
             elif isinstance(result, Result):
-                val = result.get()
+                if result.tb_str:
+                    result.get()  # raise the exception in the task
                 self.received.append(len(result.pik))
             else:  # this should never happen
                 raise ValueError(result)
-            next(self.log_percent)
+            if not streaming:
+                next(self.log_percent)
             if not self.name.startswith('_'):  # no info for private tasks
                 self.save_task_info(result.mon)
-            yield val
+            yield result
 
+        if streaming:
+            self.num_tasks = len(self.received)
+            self.progress('Sent %s of data in %s task(s)',
+                          humansize(self.sent.sum()), self.num_tasks)
         if self.received:
             tot = sum(self.received)
             max_per_task = max(self.received)
@@ -446,13 +534,76 @@ class IterResult(object):
                          argnames=self.argnames, sent=self.sent)
         mon.flush()
 
-    def reduce(self, agg=operator.add, acc=None):
+    def reduce(self, agg=operator.add, acc=None, combine=None, fanin=4):
+        """
+        Reduce the task results with the function `agg`.
+
+        :param agg: aggregation function (acc, result) -> acc
+        :param acc: the initial accumulator (an empty AccumDict by default)
+        :param combine:
+            if given, a pure and associative function (res1, res2) -> res
+            used to perform a tree-reduce: when the tasks run on a pool,
+            the results are combined in groups of `fanin` by reducer tasks
+            running in the workers and `agg` is called in the master only
+            on the final result(s)
+        :param fanin: number of results combined by each reducer task
+
+        NB: the reducer tasks are queued in the pool after the tasks already
+        submitted; in the default mode all the tasks are submitted upfront,
+        so the reduction happens mostly after the computation. To overlap
+        the reduction with the computation use the streaming mode, i.e.
+        set `max_outstanding` (or `max_outstanding_tasks` in openquake.cfg).
+        """
         if acc is None:
             acc = AccumDict()
-        for result in self:
-            acc = agg(acc, result)
+        if combine is None or self.pool is None:
+            for result in self:
+                acc = agg(acc, result)
+        else:
+            for result in self._tree_reduce(combine, fanin):
+                acc = agg(acc, result)
         return acc
 
+    def _tree_reduce(self, combine, fanin):
+        # the results are not unpickled in the master; they are sent to
+        # reducer tasks as soon as `fanin` of them are available and the
+        # combined results are combined again, until only one is left
+        combined = queue.Queue()
+        buffer = []
+        outstanding = 0
+
+        def submit(piks):
+            nonlocal outstanding
+            self.pool.apply_async(
+                safely_call, (_combine, (combine, piks)),
+                callback=combined.put, error_callback=combined.put)
+            outstanding += 1
+
+        def add(result):
+            if isinstance(result, BaseException):
+                raise result
+            elif result.tb_str:
+                result.get()  # raise the exception in the reducer task
+            buffer.append(result.pik)
+            if len(buffer) >= fanin:
+                submit(buffer[:])
+                del buffer[:]
+
+        for result in self._iter_results():
+            add(result)
+            while not combined.empty():  # collect the combined results
+                outstanding -= 1
+                add(combined.get())
+        while outstanding or len(buffer) > 1:
+            if outstanding:
+                outstanding -= 1
+                add(combined.get())
+            elif len(buffer) > 1:  # the last few results
+                submit(buffer[:])
+                del buffer[:]
+        for pik in buffer:
+            yield pik.unpickle()
+
     @classmethod
     def sum(cls, iresults):
         """
@@ -546,8 +697,13 @@ class Starmap(object):
         task_args = [(ch,) + args for ch in chunks]
         return cls(task, task_args, name, distribute).submit_all()
 
-    def __init__(self, task_func, task_args, name=None, distribute=None):
+    def __init__(self, task_func, task_args, name=None, distribute=None,
+                 max_outstanding=None):
         self.__class__.init(distribute=distribute or OQ_DISTRIBUTE)
+        if max_outstanding is None:
+            max_outstanding = config.distribution.get(
+                'max_outstanding_tasks', 0)
+        self.max_outstanding = max_outstanding
         self.task_func = task_func
         self.name = name or task_func.__name__
         self.task_args = task_args
@@ -613,20 +769,30 @@ class Starmap(object):
         elif self.distribute == 'zmq':
             it = self._iter_zmq()
         num_tasks = next(it)
-        return IterResult(it, self.name, self.argnames, num_tasks,
+        ires = IterResult(it, self.name, self.argnames, num_tasks,
                           self.sent, self.progress)
+        if it.__name__ == '_iter_pool':
+            # the pool can be restarted while generating the arguments,
+            # so it must be taken after the call to next(it)
+            ires.pool = self.pool  # used by the tree-reduce
+        return ires
 
-    def reduce(self, agg=operator.add, acc=None):
+    def reduce(self, agg=operator.add, acc=None, combine=None):
         """
         Submit all tasks and reduce the results
         """
-        return self.submit_all().reduce(agg, acc)
+        return self.submit_all().reduce(agg, acc, combine)
 
     def __iter__(self):
         return iter(self.submit_all())
 
     def _iter_sequential(self):
         self.progress('Executing "%s" in process', self.name)
+        if self.max_outstanding:  # run the tasks as they are generated
+            yield None
+            for args in self._genargs(pickle=False):
+                yield safely_call(self.task_func, args)
+            return
         allargs = list(self._genargs(pickle=False))
         yield len(allargs)
         for args in allargs:
@@ -634,11 +800,30 @@ class Starmap(object):
 
     def _iter_pool(self):
         safefunc = functools.partial(safely_call, self.task_func)
+        if self.max_outstanding:
+            yield from self._iter_pool_streaming(safefunc)
+            return
         allargs = list(self._genargs())
         yield len(allargs)
         for res in self.pool.imap_unordered(safefunc, allargs):
             yield res
 
+    def _iter_pool_streaming(self, safefunc):
+        # the arguments are generated and pickled lazily and there are
+        # never more than .max_outstanding tasks submitted and not completed
+        results = queue.Queue()
+        yield None  # the number of tasks is not known in advance
+        outstanding = 0
+        for args in self._genargs():
+            if outstanding == self.max_outstanding:
+                yield results.get()  # wait for a task to complete
+                outstanding -= 1
+            self.pool.apply_async(safefunc, (args,), callback=results.put,
+                                  error_callback=results.put)
+            outstanding += 1
+        for _ in range(outstanding):
+            yield results.get()
+
     def iter_native(self, results):
         for task_id, result_dict in ResultSet(results).iter_native():
             self.task_ids.remove(task_id)
@@ -673,6 +858,9 @@ class Starmap(object):
         with Socket(self.receiver, zmq.PULL, 'bind') as socket:
             task_in_url = ('tcp://%(master_host)s:%(task_in_port)s' %
                            config.zworkers)
+            if self.max_outstanding:
+                yield from self._iter_zmq_streaming(socket, task_in_url)
+                return
             with Socket(task_in_url, zmq.PUSH, 'connect') as sender:
                 num_results = 0
                 for args in self._genargs(socket.backurl):
@@ -689,6 +877,31 @@ class Starmap(object):
                 num_results -= 1
                 yield res
 
+    def _iter_zmq_streaming(self, socket, task_in_url):
+        # send a new task only when there are less than .max_outstanding
+        # tasks submitted and not completed
+        yield None  # the number of tasks is not known in advance
+        isocket = iter(socket)
+
+        def receive():
+            while True:
+                res = next(isocket)
+                if self.calc_id and self.calc_id != res.mon.calc_id:
+                    logging.warn('Discarding a result from job %d, since this '
+                                 'is job %d', res.mon.calc_id, self.calc_id)
+                    continue
+                return res
+        outstanding = 0
+        with Socket(task_in_url, zmq.PUSH, 'connect') as sender:
+            for args in self._genargs(socket.backurl):
+                if outstanding == self.max_outstanding:
+                    yield receive()
+                    outstanding -= 1
+                sender.send((self.task_func, args))
+                outstanding += 1
+        for _ in range(outstanding):
+            yield receive()
+
 
 def sequential_apply(task, args, concurrent_tasks=cpu_count * 3,
                      weight=lambda item: 1, key=lambda item: 'Unspecified'):
@@ -32,6 +32,15 @@ def get_length(data, monitor):
     return {'n': len(data)}
 
 
+def add_lengths(dic1, dic2):
+    return {'n': dic1['n'] + dic2['n']}
+
+
+def get_sum(shared, monitor):
+    assert not shared.array.flags.writeable
+    return {'n': shared.array.sum()}
+
+
 class StarmapTestCase(unittest.TestCase):
     monitor = parallel.Monitor()
 
@@ -75,6 +84,52 @@ class StarmapTestCase(unittest.TestCase):
             res[key] = val.reduce()
         self.assertEqual(res, {'a': {'n': 10}, 'c': {'n': 15}, 'b': {'n': 20}})
 
+    def test_streaming(self):
+        received = []
+        generated = []
+
+        def genargs():
+            for i in range(1, 11):
+                # never more than 2 tasks generated and not completed
+                self.assertLessEqual(len(generated) - len(received), 2)
+                generated.append(i)
+                yield numpy.arange(i), self.monitor
+        smap = parallel.Starmap(get_length, genargs(), max_outstanding=2)
+        ires = smap.submit_all()
+        self.assertEqual(generated, [])  # nothing was generated yet
+        for res in ires:
+            received.append(res['n'])
+        self.assertEqual(sorted(received), generated)
+        self.assertEqual(ires.num_tasks, 10)
+
+    def test_tree_reduce(self):
+        calls = []
+
+        def agg(acc, dic):
+            calls.append(dic)
+            return acc + dic['n']
+        smap = parallel.Starmap(
+            get_length, [(numpy.arange(i), self.monitor) for i in range(10)])
+        res = smap.submit_all().reduce(agg, 0, combine=add_lengths)
+        self.assertEqual(res, 45)
+        if smap.distribute in ('processpool', 'threadpool'):
+            # a single result is aggregated in the master
+            self.assertEqual(len(calls), 1)
+        else:  # the combine function is ignored
+            self.assertEqual(len(calls), 10)
+
+    def test_shared(self):
+        shared = parallel.SharedArray(numpy.arange(100000))
+        try:
+            smap = parallel.Starmap(
+                get_sum, [(shared, self.monitor)] * 3)
+            self.assertEqual(smap.reduce(), {'n': 3 * 4999950000})
+            # only the handle was sent, not the 800 KB of data
+            self.assertLess(smap.sent[0], 1000)
+        finally:
+            shared.close()
+        self.assertFalse(os.path.exists(shared.path))
+
     @classmethod
     def tearDownClass(cls):
         parallel.Starmap.shutdown()
@@ -31,10 +31,11 @@ import numpy
 from openquake.baselib import (
     config, general, hdf5, datastore, __version__ as engine_version)
 from openquake.baselib.performance import Monitor
+from openquake.baselib.python3compat import encode
 from openquake.hazardlib.calc.filters import SourceFilter, RtreeFilter, rtree
-from openquake.risklib import riskinput, riskmodels
+from openquake.risklib import riskinput, riskmodels, scientific
 from openquake.commonlib import readinput, source, calc, writers
-from openquake.baselib.parallel import Starmap
+from openquake.baselib.parallel import Starmap, oq_distribute
 from openquake.hazardlib.shakemap import get_sitecol_shakemap, to_gmfs
 from openquake.calculators.export import export as exp
 from openquake.calculators.getters import GmfDataGetter, PmapGetter
@@ -436,6 +437,9 @@ class HazardCalculator(BaseCalculator):
                 self.datastore['sitecol'] = self.sitecol
             else:
                 self.datastore['sitecol'] = self.sitecol.complete
+            if oq_distribute() == 'processpool':
+                # the workers will receive a handle to the shared sitecol
+                self.sitecol.complete.share()
         self.param = {}  # used in the risk calculators
         if 'gmfs' in self.oqparam.inputs:
             save_gmfs(self)
@@ -701,7 +705,7 @@ class RiskCalculator(HazardCalculator):
         :param kind:
             kind of hazard getter, can be 'poe' or 'gmf'
         :param eps:
-            a matrix of epsilons (or None)
+            a matrix of epsilons, an EpsilonGetter or None
         :param num_events:
             how many events there are
         :returns:
@@ -747,10 +751,12 @@ class RiskCalculator(HazardCalculator):
             reduced_assets = assets_by_site[sids]
             # dictionary of epsilons for the reduced assets
             reduced_eps = {}
-            for assets in reduced_assets:
-                for ass in assets:
-                    if eps is not None and len(eps):
-                        reduced_eps[ass.ordinal] = eps[ass.ordinal]
+            if isinstance(eps, riskinput.EpsilonGetter):
+                reduced_eps = eps  # the epsilons are computed on the fly
+            elif eps is not None and len(eps):
+                for assets in reduced_assets:
+                    for aid in assets['ordinal'].tolist():
+                        reduced_eps[aid] = eps[aid]
             # build the riskinputs
             if kind == 'poe':  # hcurves, shape (R, N)
                 getter = PmapGetter(dstore, self.rlzs_assoc, sids)
@@ -818,6 +824,30 @@ def save_gmdata(calc, n_rlzs):
     calc.datastore['gmdata'] = array
 
 
+def save_agg_loss_table(calc, tables):
+    """
+    Sum the partial aggregate loss tables coming from the tasks and save
+    a composite array `agg_loss_table` in the datastore.
+
+    :param calc: a risk calculator with a non-empty `aggregate_by`
+    :param tables: a list of arrays returned by
+                   :func:`openquake.risklib.scientific.agg_loss_table`
+    """
+    oq = calc.oqparam
+    table = numpy.concatenate(tables)
+    n, LI = table['loss'].shape
+    # the same triple (eid, rlzi, agg_id) can come from different tasks
+    table = scientific.agg_loss_table(
+        table['eid'].repeat(LI), table['rlzi'].repeat(LI),
+        table['agg_id'].repeat(LI), numpy.tile(numpy.arange(LI), n),
+        table['loss'].ravel(), LI)
+    calc.datastore['agg_loss_table'] = table
+    calc.datastore.set_attrs(
+        'agg_loss_table', aggregate_by=encode(oq.aggregate_by),
+        shape=calc.assetcol.agg_shape(oq.aggregate_by),
+        loss_types=encode(oq.loss_dt().names), nbytes=table.nbytes)
+
+
 def save_gmfs(calculator):
     """
     :param calculator: a scenario_risk/damage or event_based_risk calculator
@@ -74,12 +74,49 @@ def saving_sources_by_task(iterargs, dstore):
     dstore.extend('task_info/source_data', numpy.array(data, source_data_dt))
 
 
+def get_nsites(pmap_by_grp):
+    """
+    :returns: the number of effective sites per group and task, also
+              for the results combined with :func:`combine_pmaps`
+    """
+    try:
+        return pmap_by_grp.nsites
+    except AttributeError:  # a result coming directly from a task
+        return [len(pmap_by_grp[grp_id]) for grp_id in pmap_by_grp]
+
+
+def combine_pmaps(pmap_by_grp, other):
+    """
+    Combine two dictionaries grp_id -> ProbabilityMap returned by the
+    classical tasks; used to reduce the results in the workers.
+    NB: the first dictionary is updated in place, which is fine since
+    the results are freshly unpickled by the reducer tasks.
+
+    :param pmap_by_grp: a dictionary which is updated and returned
+    :param other: a dictionary with the same structure
+    """
+    nsites = get_nsites(pmap_by_grp) + get_nsites(other)
+    for grp_id, pmap in other.items():
+        if grp_id in pmap_by_grp:
+            pmap_by_grp[grp_id] |= pmap
+        else:
+            pmap_by_grp[grp_id] = pmap
+    pmap_by_grp.eff_ruptures += other.eff_ruptures
+    pmap_by_grp.calc_times += other.calc_times
+    pmap_by_grp.nsites = nsites
+    pmap_by_grp.collapsing_error = max(
+        getattr(pmap_by_grp, 'collapsing_error', 0),
+        getattr(other, 'collapsing_error', 0))
+    return pmap_by_grp
+
+
 @base.calculators.add('psha')
 class PSHACalculator(base.HazardCalculator):
     """
     Classical PSHA calculator
     """
     core_task = classical
+    combine_results = staticmethod(combine_pmaps)  # used in the tree-reduce
 
     def agg_dicts(self, acc, pmap_by_grp):
         """
@@ -93,7 +130,10 @@ class PSHACalculator(base.HazardCalculator):
             for grp_id in pmap_by_grp:
                 if pmap_by_grp[grp_id]:
                     acc[grp_id] |= pmap_by_grp[grp_id]
-                self.nsites.append(len(pmap_by_grp[grp_id]))
+            self.nsites.extend(get_nsites(pmap_by_grp))
+            self.collapsing_error = max(
+                self.collapsing_error,
+                getattr(pmap_by_grp, 'collapsing_error', 0))
             for srcid, (srcweight, nsites, calc_time, split) in \
                     pmap_by_grp.calc_times.items():
                 info = self.csm.infos[srcid]
@@ -138,10 +178,15 @@ class PSHACalculator(base.HazardCalculator):
             ires = parallel.Starmap(
                 self.core_task.__func__, iterargs).submit_all()
         self.nsites = []
-        acc = ires.reduce(self.agg_dicts, self.zerodict())
+        self.collapsing_error = 0
+        acc = ires.reduce(
+            self.agg_dicts, self.zerodict(), self.combine_results)
         if not self.nsites:
             raise RuntimeError('All sources were filtered out!')
         logging.info('Effective sites per task: %d', numpy.mean(self.nsites))
+        if self.oqparam.pointsource_distance:
+            logging.info('Maximum PoE error due to the collapsing of the '
+                         'point sources (sampled): %s', self.collapsing_error)
         with self.monitor('store source_info', autoflush=True):
             self.store_source_info(self.csm.infos, acc)
         return acc
@@ -156,7 +201,9 @@ class PSHACalculator(base.HazardCalculator):
         oq = self.oqparam
         opt = self.oqparam.optimize_same_id_sources
         param = dict(truncation_level=oq.truncation_level, imtls=oq.imtls,
-                     filter_distance=oq.filter_distance)
+                     filter_distance=oq.filter_distance,
+                     pointsource_distance=oq.pointsource_distance,
+                     distance_cache_size=oq.distance_cache_size)
         minweight = source.MINWEIGHT * math.sqrt(len(self.sitecol))
         totweight = 0
         num_tasks = 0
@@ -260,6 +307,7 @@ class PreCalculator(PSHACalculator):
     ruptures
     """
     core_task = count_ruptures
+    combine_results = None  # the results are dicts, not ProbabilityMaps
 
 
 def fix_ones(pmap):
@@ -273,9 +321,8 @@ def fix_ones(pmap):
     Here we solve the issue by replacing the unphysical probabilities 1
     with .9999999999999999 (the float64 closest to 1).
     """
-    for sid in pmap:
-        array = pmap[sid].array
-        array[array == 1.] = .9999999999999999
+    array = pmap.array
+    array[array == 1.] = .9999999999999999
 
 
 def build_hcurves_and_stats(pgetter, hstats, monitor):
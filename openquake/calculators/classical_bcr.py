@@ -20,6 +20,7 @@ import numpy
 
 from openquake.baselib.general import AccumDict
 from openquake.hazardlib import stats
+from openquake.risklib import riskmodels
 from openquake.calculators import base, classical_risk
 
 F32 = numpy.float32
@@ -45,10 +46,11 @@ def classical_bcr(riskinput, riskmodel, param, monitor):
     result = AccumDict(accum=numpy.zeros((R, 3), F32))
     for outputs in riskmodel.gen_outputs(riskinput, monitor):
         assets = outputs.assets
+        avalues = riskmodels.get_values('structural', assets)
         for out in outputs:
-            for asset, (eal_orig, eal_retro, bcr) in zip(assets, out):
-                aval = asset.value('structural')
-                result[asset.ordinal][outputs.rlzi] = numpy.array([
+            for aid, aval, (eal_orig, eal_retro, bcr) in zip(
+                    assets['ordinal'], avalues, out):
+                result[aid][outputs.rlzi] = numpy.array([
                     eal_orig * aval, eal_retro * aval, bcr])
     return result
 
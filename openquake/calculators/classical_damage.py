@@ -42,7 +42,7 @@ def classical_damage(riskinput, riskmodel, param, monitor):
     result = {i: AccumDict() for i in range(R)}
     for outputs in riskmodel.gen_outputs(riskinput, monitor):
         for l, out in enumerate(outputs):
-            ordinals = [a.ordinal for a in outputs.assets]
+            ordinals = outputs.assets['ordinal']
             result[outputs.rlzi] += dict(zip(ordinals, out))
     return result
 
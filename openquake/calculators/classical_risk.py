@@ -15,11 +15,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import numpy
-from openquake.baselib.general import groupby, AccumDict
 from openquake.baselib.python3compat import encode
 from openquake.hazardlib.stats import compute_stats
-from openquake.risklib import scientific
+from openquake.risklib import scientific, riskmodels
+from openquake.risklib.riskinput import group_by_taxonomy
 from openquake.commonlib import readinput, source
 from openquake.calculators import base
 
@@ -41,41 +42,55 @@ def classical_risk(riskinput, riskmodel, param, monitor):
         :class:`openquake.baselib.performance.Monitor` instance
     """
     result = dict(loss_curves=[], stat_curves=[])
-    all_outputs = list(riskmodel.gen_outputs(riskinput, monitor))
-    for outputs in all_outputs:
-        r = outputs.rlzi
-        outputs.average_losses = AccumDict(accum=[])  # l -> array
-        for l, loss_curves in enumerate(outputs):
-            # loss_curves has shape (C, N, 2)
-            for i, asset in enumerate(outputs.assets):
-                aid = asset.ordinal
-                avg = scientific.average_loss(loss_curves[:, i].T)
-                outputs.average_losses[l].append(avg)
-                lcurve = (loss_curves[:, i, 0], loss_curves[:, i, 1], avg)
-                result['loss_curves'].append((l, r, aid, lcurve))
-
-    # compute statistics
-    R = riskinput.hazard_getter.num_rlzs
+    hazard_getter = riskinput.hazard_getter
+    with monitor('getting hazard'):
+        hazard_getter.init()
+        hazard = hazard_getter.get_hazard()
+    imti = {imt: i for i, imt in enumerate(hazard_getter.imtls)}
+    R = hazard_getter.num_rlzs
     w = param['weights']
     statnames, stats = zip(*param['stats'])
-    l_idxs = range(len(riskmodel.lti))
-    for assets, outs in groupby(
-            all_outputs, lambda o: tuple(o.assets)).items():
-        weights = [w[out.rlzi] for out in outs]
-        out = outs[0]
-        for l in l_idxs:
-            for i, asset in enumerate(assets):
-                avgs = numpy.array([r.average_losses[l][i] for r in outs])
-                avg_stats = compute_stats(avgs, stats, weights)
-                # is a pair loss_curves, insured_loss_curves
-                # out[l][:, i, 0] are the i-th losses
-                # out[l][:, i, 1] are the i-th poes
-                losses = out[l][:, i, 0]
-                poes_stats = compute_stats(
-                    numpy.array([out[l][:, i, 1] for out in outs]),
-                    stats, weights)
-                result['stat_curves'].append(
-                    (l, asset.ordinal, losses, poes_stats, avg_stats))
+    dic = collections.defaultdict(list)  # taxonomy -> [(sid, assets)]
+    for sid, assets in zip(hazard_getter.sids, riskinput.assets_by_site):
+        for taxonomy, tassets in group_by_taxonomy(assets):
+            dic[taxonomy].append((sid, tassets))
+    with monitor('computing risk'):
+        for taxonomy in sorted(dic):
+            rm = riskmodel[taxonomy]
+            sids = [sid for sid, tassets in dic[taxonomy]]
+            assets = numpy.concatenate([ta for sid, ta in dic[taxonomy]])
+            site = numpy.repeat(numpy.arange(len(sids)),
+                                [len(ta) for sid, ta in dic[taxonomy]])
+            for l, loss_type in enumerate(riskmodel.loss_types):
+                vf = rm.risk_functions[loss_type]
+                imls = rm.hazard_imtls[vf.imt]
+                values = riskmodels.get_values(loss_type, assets)
+                all_poes = []  # R arrays of shape (A, C)
+                all_avgs = []  # R arrays of shape A
+                for r in range(R):
+                    # the loss curves of all the sites come from a
+                    # single product with the cached kernel
+                    hcurves = numpy.array(
+                        [hazard[sid][r][imti[vf.imt]] for sid in sids])
+                    ratios, poes = scientific.classical_curves(
+                        vf, imls, hcurves, rm.lrem_steps_per_interval)
+                    poes = poes[site]
+                    losses = numpy.outer(values, ratios)
+                    avgs = numpy.sum(numpy.diff(losses) * (
+                        poes[:, :-1] + poes[:, 1:]) / 2., axis=1)
+                    all_poes.append(poes)
+                    all_avgs.append(avgs)
+                    for aid, lss, pss, avg in zip(
+                            assets['ordinal'], losses, poes, avgs):
+                        result['loss_curves'].append((l, r, aid,
+                                                      (lss, pss, avg)))
+
+                # compute statistics
+                avg_stats = compute_stats(numpy.array(all_avgs), stats, w)
+                poes_stats = compute_stats(numpy.array(all_poes), stats, w)
+                for i, (aid, lss) in enumerate(zip(assets['ordinal'], losses)):
+                    result['stat_curves'].append(
+                        (l, aid, lss, poes_stats[:, i], avg_stats[:, i]))
     if R == 1:  # the realization is the same as the mean
         del result['loss_curves']
     return result
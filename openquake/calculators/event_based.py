@@ -17,7 +17,6 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import math
 import os.path
-import itertools
 import logging
 import collections
 import numpy
@@ -276,7 +275,7 @@ def compute_gmfs_and_curves(getters, oq, monitor):
             hc_mon = monitor('building hazard curves', measuremem=False)
             duration = oq.investigation_time * oq.ses_per_logic_tree_path
             with monitor('building hazard', measuremem=True):
-                gmfdata = numpy.fromiter(getter.gen_gmv(), getter.gmf_data_dt)
+                gmfdata = getter.get_gmfdata()
                 hazard = getter.get_hazard(data=gmfdata)
             for sid, hazardr in zip(getter.sids, hazard):
                 for rlzi, array in hazardr.items():
@@ -291,20 +290,18 @@ def compute_gmfs_and_curves(getters, oq, monitor):
                             hcurves[rsi2str(rlzi, sid, imt)] = poes
         else:  # fast lane
             with monitor('building hazard', measuremem=True):
-                gmfdata = numpy.fromiter(getter.gen_gmv(), getter.gmf_data_dt)
-        indices = []
+                gmfdata = getter.get_gmfdata()
         if oq.ground_motion_fields:
             gmfdata.sort(order=('sid', 'rlzi', 'eid'))
-            start = stop = 0
-            for sid, rows in itertools.groupby(gmfdata['sid']):
-                for row in rows:
-                    stop += 1
-                indices.append((sid, start, stop))
-                start = stop
+            sids = numpy.unique(gmfdata['sid'])
+            starts = gmfdata['sid'].searchsorted(sids)
+            stops = gmfdata['sid'].searchsorted(sids, 'right')
+            indices = numpy.array([sids, starts, stops], U32).T
         else:
             gmfdata = None
+            indices = numpy.zeros((0, 3), U32)
         res = dict(gmfdata=gmfdata, hcurves=hcurves, gmdata=getter.gmdata,
-                   indices=numpy.array(indices, (U32, 3)))
+                   indices=indices)
         if len(getter.gmdata):
             results.append(res)
     return results
@@ -386,7 +383,9 @@ class EventBasedCalculator(base.HazardCalculator):
         if self.precalc:
             num_ruptures = sum(len(rs) for rs in self.precalc.result.values())
             block_size = math.ceil(num_ruptures / (oq.concurrent_tasks or 1))
-            for grp_id, ruptures in self.precalc.result.items():
+            for grp_id in list(self.precalc.result):
+                # remove the ruptures in memory as soon as they are sent
+                ruptures = self.precalc.result.pop(grp_id)
                 if not ruptures:
                     continue
                 for block in block_splitter(ruptures, block_size):
@@ -436,9 +435,6 @@ class EventBasedCalculator(base.HazardCalculator):
         self.indices = collections.defaultdict(list)  # sid -> indices
         ires = parallel.Starmap(
             self.core_task.__func__, self.gen_args()).submit_all()
-        if self.precalc and self.precalc.result:
-            # remove the ruptures in memory to save memory
-            self.precalc.result.clear()
         acc = ires.reduce(self.combine_pmaps_and_save_gmfs, {
             r: ProbabilityMap(L) for r in range(R)})
         base.save_gmdata(self, R)
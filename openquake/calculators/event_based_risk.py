@@ -17,16 +17,17 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import logging
 import operator
-import itertools
 import collections
 import numpy
 
 from openquake.baselib.python3compat import zip, encode
 from openquake.baselib.general import (
-    AccumDict, block_splitter, split_in_blocks)
+    AccumDict, block_splitter, split_in_blocks, humansize)
 from openquake.baselib import parallel
 from openquake.hazardlib.stats import set_rlzs_stats
-from openquake.risklib import riskinput
+from openquake.risklib import riskinput, riskmodels, scientific
+from openquake.risklib.asset import get_agg_ids
+from openquake.risklib.riskinput import group_by_taxonomy
 from openquake.calculators import base, event_based, getters
 from openquake.calculators.export.loss_curves import get_loss_builder
 
@@ -38,6 +39,10 @@ F64 = numpy.float64
 U64 = numpy.uint64
 getweight = operator.attrgetter('weight')
 indices_dt = numpy.dtype([('start', U32), ('stop', U32)])
+# a slice of rows of all_loss_ratios/data belonging to the same asset
+lrs_idx_dt = numpy.dtype([('aid', U32), ('start', U32), ('stop', U32)])
+# maximum size of the buffer of top losses kept in the master
+MAX_TOP_LOSSES_BYTES = 2 * 1024 ** 3
 
 
 def build_loss_tables(dstore):
@@ -60,6 +65,128 @@ def build_loss_tables(dstore):
     return tbl, lbr
 
 
+class AssetEventPairs(object):
+    """
+    The (asset, event) pairs of a taxonomy and a realization, built from
+    the GMFs of the sites with assets of that taxonomy. The ground motion
+    values of all the sites are stored one after the other, so that the
+    vulnerability functions can be applied to all the assets in one go.
+
+    :param items:
+        a list of triples (asset start, number of assets, haz), one for
+        each affected site, where haz is an array with fields eid, gmv
+    """
+    def __init__(self, items):
+        astarts, ns, hazs = zip(*items)
+        self.gmvs = numpy.concatenate([haz['gmv'] for haz in hazs])
+        self.eids = numpy.concatenate([haz['eid'] for haz in hazs])
+        self.ns = ns = numpy.array(ns)  # number of assets per site
+        self.es = es = numpy.array([len(haz) for haz in hazs])
+        gstarts = numpy.cumsum(es) - es
+        self.blocks = [slice(start, start + e)
+                       for start, e in zip(gstarts, es)]
+        self.positions = numpy.concatenate(
+            [numpy.arange(start, start + n) for start, n in zip(astarts, ns)])
+        ne = numpy.repeat(es, ns)  # number of events per asset
+        pstarts = numpy.cumsum(ne) - ne  # first pair of each asset
+        # asset position and gmv index of each pair
+        self.apos = numpy.repeat(self.positions, ne)
+        self.gidx = numpy.arange(ne.sum()) - numpy.repeat(
+            pstarts - numpy.repeat(gstarts, ns), ne)
+
+    def sum_by_asset(self, ratios):
+        """
+        :param ratios: an array of shape (P, I)
+        :returns: an array of shape (A', I) with the sums over the events
+        """
+        sums = []
+        stop = 0
+        for n, e in zip(self.ns, self.es):
+            start, stop = stop, stop + n * e
+            # NB: summing on the reshaped array is the same as summing
+            # the ratios of each asset separately, even at the bit level
+            sums.append(ratios[start:stop].reshape(n, e, -1).sum(axis=1))
+        return numpy.concatenate(sums)
+
+
+def get_top_losses(ass, R, LI, k):
+    """
+    :param ass: a list of tuples (aids, rlzs, eids, lis, ratios)
+    :param R: the number of realizations
+    :param LI: the number of loss types times the number of insured flags
+    :param k: the number of largest loss ratios to keep
+    :returns: a triple (aids, rlzs, top) where top is an array of shape
+              (U, k, LI) with the largest loss ratios of each asset and
+              realization, in ascending order
+    """
+    if not ass:
+        return (numpy.zeros(0, U32), numpy.zeros(0, U16),
+                numpy.zeros((0, k, LI), F32))
+    aids, rlzs, eids, lis, ratios = map(numpy.concatenate, zip(*ass))
+    slots = aids.astype(numpy.int64) * R + rlzs
+    keys, top = scientific.top_losses(slots * LI + lis, ratios, k)
+    uslots, inv = numpy.unique(keys // LI, return_inverse=True)
+    array = numpy.zeros((len(uslots), k, LI), F32)
+    array[inv, :, keys % LI] = top
+    return uslots // R, uslots % R, array
+
+
+def build_csr(indices, num_assets):
+    """
+    :param indices: an array of dtype lrs_idx_dt, in order of storage
+    :param num_assets: the total number of assets A
+    :returns: the indices sorted by asset and an array indptr of length
+              A + 1, so that the slices of the asset `aid` are
+              indices[indptr[aid]:indptr[aid + 1]]
+    """
+    # the sorting is stable, so the slices are in order of storage
+    indices = indices[numpy.argsort(indices['aid'], kind='mergesort')]
+    indptr = numpy.zeros(num_assets + 1, U32)
+    numpy.cumsum(numpy.bincount(indices['aid'], minlength=num_assets),
+                 out=indptr[1:])
+    return indices, indptr
+
+
+def gen_pairs(riskinput, monitor):
+    """
+    Group the assets by taxonomy and yield, for each taxonomy and
+    realization, the corresponding AssetEventPairs.
+
+    :param riskinput: a RiskInput instance with a GMF hazard getter
+    :param monitor: a Monitor instance
+    :yields: triples (taxonomy, assets, rlzi, pairs)
+    """
+    hazard_getter = riskinput.hazard_getter
+    dic = collections.defaultdict(list)  # taxonomy -> [(sid, assets)]
+    for sid, assets in zip(hazard_getter.sids, riskinput.assets_by_site):
+        for taxonomy, tassets in group_by_taxonomy(assets):
+            dic[taxonomy].append((sid, tassets))
+    # save memory by working one gsim at the time
+    for gsim in getattr(hazard_getter, 'rlzs_by_gsim', [None]):
+        with monitor('getting hazard'):
+            hazard = hazard_getter.get_hazard(gsim)
+            for sid in hazard_getter.sids:
+                for haz in hazard[sid].values():
+                    if isinstance(haz, numpy.ndarray):
+                        # reorder the gmfs by event ID, see the note
+                        # in CompositeRiskModel._gen_outputs
+                        haz.sort(order='eid')
+        for taxonomy in sorted(dic):
+            start = 0
+            by_rlz = collections.defaultdict(list)
+            for sid, tassets in dic[taxonomy]:
+                for rlzi, haz in hazard[sid].items():
+                    if isinstance(haz, numpy.ndarray) and len(haz):
+                        by_rlz[rlzi].append((start, len(tassets), haz))
+                start += len(tassets)
+            assets = numpy.concatenate(
+                [tassets for sid, tassets in dic[taxonomy]])
+            for rlzi in sorted(by_rlz):
+                yield taxonomy, assets, rlzi, AssetEventPairs(by_rlz[rlzi])
+    if hasattr(hazard_getter, 'gmdata'):
+        riskinput.gmdata = hazard_getter.gmdata
+
+
 def event_based_risk(riskinput, riskmodel, param, monitor):
     """
     :param riskinput:
@@ -83,48 +210,77 @@ def event_based_risk(riskinput, riskmodel, param, monitor):
     R = riskinput.hazard_getter.num_rlzs
     param['lrs_dt'] = numpy.dtype([('rlzi', U16), ('ratios', (F32, (L * I,)))])
     ass = []
-    lrs_idx = AccumDict(accum=[])  # aid -> indices
+    collect = param['asset_loss_table'] or param.get('top_losses')
+    aggregate_by = param.get('aggregate_by')
+    aggl = []  # losses by event and aggregation ID
     agg = numpy.zeros((E, R, L * I), F32)
     avg = AccumDict(accum={} if riskinput.by_site or not param['avg_losses']
                     else numpy.zeros(A, F64))
-    result = dict(assratios=ass, lrs_idx=lrs_idx,
-                  aids=riskinput.aids, avglosses=avg)
-
-    # update the result dictionary and the agg array with each output
-    for out in riskmodel.gen_outputs(riskinput, monitor):
-        if len(out.eids) == 0:  # this happens for sites with no events
-            continue
-        r = out.rlzi
-        eid2idx = riskinput.hazard_getter.eid2idx
-        for l, loss_ratios in enumerate(out):
-            if loss_ratios is None:  # for GMFs below the minimum_intensity
-                continue
-            loss_type = riskmodel.loss_types[l]
-            indices = numpy.array([eid2idx[eid] for eid in out.eids])
-            for a, asset in enumerate(out.assets):
-                ratios = loss_ratios[a]  # shape (E, I)
-                aid = asset.ordinal
-                losses = ratios * asset.value(loss_type)
+    result = dict(aids=riskinput.aids, avglosses=avg)
+    imti = {imt: m for m, imt in enumerate(riskinput.hazard_getter.imtls)}
+    sorter = numpy.argsort(eids)
+
+    # update the result dictionary and the agg array with the losses
+    # of all the assets of a taxonomy for a given realization
+    for taxonomy, assets, r, pairs in gen_pairs(riskinput, monitor):
+        with monitor('computing risk'):
+            rm = riskmodel[taxonomy]
+            ordinals = assets['ordinal']
+            aids = ordinals[pairs.apos]
+            if aggregate_by:
+                agg_ids = get_agg_ids(
+                    assets, aggregate_by, param['agg_shape'])[pairs.apos]
+            # event index of each pair
+            indices = sorter[numpy.searchsorted(
+                eids, pairs.eids, sorter=sorter)][pairs.gidx]
+            epsilons = riskinput.get_epsilons(aids, pairs.eids[pairs.gidx])
+            for l, loss_type in enumerate(riskmodel.loss_types):
+                m = imti[rm.risk_functions[loss_type].imt]
+                values = riskmodels.get_values(
+                    loss_type, assets).astype(F32)
+                deductibles = limits = None
+                if I > 1:
+                    deductibles = riskmodels.get_deductibles(
+                        loss_type, assets)[pairs.apos]
+                    limits = riskmodels.get_insurance_limits(
+                        loss_type, assets)[pairs.apos]
+                ratios = rm.get_loss_ratios(  # shape (P, I)
+                    loss_type, pairs.gmvs[:, m], pairs.blocks, pairs.gidx,
+                    epsilons, deductibles, limits)
+
                 # average losses
                 if param['avg_losses']:
-                    rat = ratios.sum(axis=0) * param['ses_ratio']
+                    rat = pairs.sum_by_asset(ratios) * param['ses_ratio']
                     for i in range(I):
                         lba = avg[l + L * i, r]
-                        try:
-                            lba[aid] += rat[i]
-                        except KeyError:
-                            lba[aid] = rat[i]
+                        if isinstance(lba, numpy.ndarray):
+                            lba[ordinals[pairs.positions]] += rat[:, i]
+                            continue
+                        for aid, ratio in zip(
+                                ordinals[pairs.positions], rat[:, i]):
+                            try:
+                                lba[aid] += ratio
+                            except KeyError:
+                                lba[aid] = ratio
 
                 # agglosses, asset_loss_table
                 for i in range(I):
                     li = l + L * i
-                    # this is the critical loop: it is import to keep it
-                    # vectorized in terms of the event indices
-                    agg[indices, r, li] += losses[:, i]
-                    if param['asset_loss_table']:
-                        for eid, ratio in zip(out.eids, ratios[:, i]):
-                            if ratio > 0:
-                                ass.append((aid, r, eid, li, ratio))
+                    losses = ratios[:, i] * values[pairs.apos]
+                    # scatter-add the losses of all the pairs, in the same
+                    # order as the assets
+                    numpy.add.at(agg[:, r, li], indices, losses)
+                    if aggregate_by:
+                        n = len(losses)
+                        aggl.append((pairs.eids[pairs.gidx],
+                                     numpy.repeat(r, n), agg_ids,
+                                     numpy.repeat(li, n), losses))
+                    if collect:
+                        ok = ratios[:, i] > 0
+                        ass.append((aids[ok], numpy.repeat(r, ok.sum()),
+                                    pairs.eids[pairs.gidx[ok]],
+                                    numpy.repeat(li, ok.sum()),
+                                    ratios[ok, i]))
 
     # collect agglosses
     if param.get('gmf_ebrisk'):
@@ -137,25 +293,45 @@ def event_based_risk(riskinput, riskmodel, param, monitor):
         result['agglosses'] = numpy.fromiter(it, param['elt_dt'])
 
     # when there are asset loss ratios, group them in a composite array
-    # of dtype lrs_dt, i.e. (rlzi, ratios)
+    # of dtype lrs_dt, i.e. (rlzi, ratios), sorted by asset, and in an
+    # array of dtype lrs_idx_dt with the slice of rows of each asset
     if param['asset_loss_table']:
-        data = sorted(ass)  # sort by aid, r
-        result['num_losses'] = num_losses = collections.Counter()  # by aid, r
-        n = 0
-        all_ratios = []
-        for aid, agroup in itertools.groupby(data, operator.itemgetter(0)):
-            for r, rgroup in itertools.groupby(agroup, operator.itemgetter(1)):
-                for e, egroup in itertools.groupby(
-                        rgroup, operator.itemgetter(2)):
-                    ratios = numpy.zeros(L * I, F32)
-                    for rec in egroup:
-                        ratios[rec[3]] = rec[4]
-                    all_ratios.append((r, ratios))
-                    num_losses[aid, r] += 1
-            n1 = len(all_ratios)
-            lrs_idx[aid].append((n, n1))
-            n = n1
-        result['assratios'] = numpy.array(all_ratios, param['lrs_dt'])
+        result['assratios'] = numpy.zeros(0, param['lrs_dt'])
+        result['lrs_idx'] = numpy.zeros(0, lrs_idx_dt)
+        if ass:
+            aids, rlzs, eids, lis, ratios = map(numpy.concatenate, zip(*ass))
+            idxs = numpy.lexsort((eids, rlzs, aids))  # sort by aid, r, eid
+            aids, rlzs, eids = aids[idxs], rlzs[idxs], eids[idxs]
+            new = numpy.ones(len(idxs), bool)
+            new[1:] = ((aids[1:] != aids[:-1]) | (rlzs[1:] != rlzs[:-1]) |
+                       (eids[1:] != eids[:-1]))
+            nums = numpy.cumsum(new) - 1  # ordinal of the (aid, r, eid)
+            all_ratios = numpy.zeros(nums[-1] + 1, param['lrs_dt'])
+            all_ratios['rlzi'] = rlzs[new]
+            all_ratios['ratios'][nums, lis[idxs]] = ratios[idxs]
+            result['assratios'] = all_ratios
+            aids = aids[new]
+            uaids, starts = numpy.unique(aids, return_index=True)
+            lrs_idx = numpy.zeros(len(uaids), lrs_idx_dt)
+            lrs_idx['aid'] = uaids
+            lrs_idx['start'] = starts
+            lrs_idx['stop'][:-1] = starts[1:]
+            lrs_idx['stop'][-1] = len(aids)
+            result['lrs_idx'] = lrs_idx
+
+    # sum the losses by event and aggregation ID
+    if aggregate_by:
+        with monitor('aggregating by tags'):
+            arrays = map(numpy.concatenate, zip(*aggl)) if aggl else [[]] * 5
+            result['agg_loss_table'] = scientific.agg_loss_table(
+                *arrays, LI=L * I)
+
+    # keep the largest loss ratios of each asset and realization, enough
+    # to build the loss curves and maps without reading them back
+    if param.get('top_losses'):
+        with monitor('building top losses'):
+            result['top_losses'] = get_top_losses(
+                ass, R, L * I, param['top_losses'])
 
     # store info about the GMFs, must be done at the end
     result['gmdata'] = riskinput.gmdata
@@ -174,6 +350,40 @@ class EbrCalculator(base.RiskCalculator):
     core_task = event_based_risk
     pre_calculator = 'event_based_rupture'
     is_stochastic = True
+    top_losses = None  # array of shape (A, R, K, LI) in online mode
+
+    def init_loss_params(self):
+        """
+        Set the attributes .L, .T, .A, .I, .num_top, .save_loss_ratios,
+        .agg_shape and .agg_tables; it is called also by the UCERF risk
+        calculator, which has its own pre_execute.
+        """
+        oq = self.oqparam
+        self.L = len(self.riskmodel.lti)
+        self.T = len(self.assetcol.tagcol)
+        self.A = len(self.assetcol)
+        self.I = oq.insured_losses + 1
+        # in online mode the tasks return the largest loss ratios for each
+        # asset, so that the loss maps can be built without a second pass
+        # over the asset loss table; this requires explicit return periods
+        # and a buffer of shape (A, R, K, LI) small enough for the master
+        self.num_top = 0
+        if (oq.return_periods and oq.conditional_loss_poes and
+                not oq.asset_loss_table):
+            eff_time = oq.investigation_time * oq.ses_per_logic_tree_path
+            num_top = scientific.num_top_losses(oq.return_periods, eff_time)
+            nbytes = self.A * self.R * num_top * self.L * self.I * 4
+            if nbytes > MAX_TOP_LOSSES_BYTES:
+                logging.warn('The top losses would require %s, storing the '
+                             'asset loss table instead', humansize(nbytes))
+            else:
+                self.num_top = num_top
+        # the loss ratios are stored when requested or when they are needed
+        # to build the loss maps with the two-pass approach
+        self.save_loss_ratios = oq.asset_loss_table or bool(
+            oq.conditional_loss_poes and not self.num_top)
+        self.agg_shape = self.assetcol.agg_shape(oq.aggregate_by)
+        self.agg_tables = []  # partial aggregate loss tables
 
     def pre_execute(self):
         oq = self.oqparam
@@ -182,10 +392,7 @@ class EbrCalculator(base.RiskCalculator):
         base.RiskCalculator.pre_execute(self)
         if not hasattr(self, 'assetcol'):
             self.assetcol = self.datastore['assetcol']
-        self.L = len(self.riskmodel.lti)
-        self.T = len(self.assetcol.tagcol)
-        self.A = len(self.assetcol)
-        self.I = oq.insured_losses + 1
+        self.init_loss_params()
         parent = self.datastore.parent
         self.precomputed_gmfs = 'gmf_data' in parent or 'gmfs' in oq.inputs
         if not self.precomputed_gmfs:
@@ -202,33 +409,35 @@ class EbrCalculator(base.RiskCalculator):
                 raise ValueError(
                     'The parent calculation was using minimum_intensity=%s'
                     ' != %s' % (oqp.minimum_intensity, oq.minimum_intensity))
-            # sorting the eids is essential to get the epsilons in the right
-            # order (i.e. consistent with the one used in ebr from ruptures)
+            # sorting the eids gives the same order of the events used
+            # in ebr from ruptures
             self.eids = sorted(parent['events']['eid'])
             self.datastore['csm_info'] = parent['csm_info']
             self.rlzs_assoc = parent['csm_info'].get_rlzs_assoc()
         self.E = len(self.eids)
-        eps = self.epsilon_getter()()
+        eps = self.epsilon_getter()
         self.riskinputs = self.build_riskinputs('gmf', eps, self.E)
         self.param['gmf_ebrisk'] = True
         self.param['insured_losses'] = oq.insured_losses
         self.param['avg_losses'] = oq.avg_losses
         self.param['ses_ratio'] = oq.ses_ratio
-        self.param['asset_loss_table'] = oq.asset_loss_table
+        self.param['asset_loss_table'] = self.save_loss_ratios
+        self.param['top_losses'] = self.num_top
+        self.param['aggregate_by'] = oq.aggregate_by
+        self.param['agg_shape'] = self.agg_shape
         self.param['elt_dt'] = numpy.dtype(
             [('eid', U64), ('rlzi', U16), ('loss', (F32, (self.L * self.I,)))])
         self.taskno = 0
-        self.start = 0
         avg_losses = self.oqparam.avg_losses
         if avg_losses:
             self.dset = self.datastore.create_dset(
                 'avg_losses-rlzs', F32, (self.A, self.R, self.L * self.I))
         self.agglosses = numpy.zeros((self.E, self.R, self.L * self.I), F32)
         self.num_losses = numpy.zeros((self.A, self.R), U32)
-        if oq.asset_loss_table:
+        if self.save_loss_ratios:
             # save all_loss_ratios
             self.alr_nbytes = 0
-            self.indices = collections.defaultdict(list)  # sid -> pairs
+            self.alr_start = 0  # number of rows in all_loss_ratios/data
 
     # TODO: if the number of source models is larger than concurrent_tasks
     # a different strategy should be used; the one used here is good when
@@ -259,6 +468,7 @@ class EbrCalculator(base.RiskCalculator):
         samples_by_grp = csm_info.get_samples_by_grp()
         num_events = 0
         num_ruptures = {}
+        eps = self.epsilon_getter()
         taskname = '%s#%d' % (event_based_risk.__name__, sm_id + 1)
         monitor = self.monitor(taskname)
         for grp_id in grp_ids:
@@ -276,9 +486,7 @@ class EbrCalculator(base.RiskCalculator):
             for rupts in blocks:
                 n_events = (rupts.n_events if from_parent
                             else sum(ebr.multiplicity for ebr in rupts))
-                eps = self.get_eps(self.start, self.start + n_events)
                 num_events += n_events
-                self.start += n_events
                 getter = getters.GmfGetter(
                     rlzs_by_gsim, rupts, sitecol, imtls, min_iml,
                     self.oqparam.maximum_distance, trunc_level, correl_model,
@@ -314,7 +522,10 @@ class EbrCalculator(base.RiskCalculator):
             param = dict(
                 ses_ratio=oq.ses_ratio,
                 loss_dt=oq.loss_dt(), elt_dt=elt_dt,
-                asset_loss_table=oq.asset_loss_table,
+                asset_loss_table=self.save_loss_ratios,
+                top_losses=self.num_top,
+                aggregate_by=oq.aggregate_by,
+                agg_shape=self.agg_shape,
                 avg_losses=oq.avg_losses,
                 insured_losses=oq.insured_losses,
                 ses_per_logic_tree_path=oq.ses_per_logic_tree_path,
@@ -327,13 +538,12 @@ class EbrCalculator(base.RiskCalculator):
 
     def epsilon_getter(self):
         """
-        :returns: a callable (start, stop) producing a slice of epsilons
+        :returns: an EpsilonGetter or None if the epsilons are not needed
         """
-        return riskinput.make_epsilon_getter(
-            len(self.assetcol), self.E,
-            self.oqparam.asset_correlation,
-            self.oqparam.master_seed,
-            self.oqparam.ignore_covs or not self.riskmodel.covs)
+        oq = self.oqparam
+        if oq.ignore_covs or not self.riskmodel.covs:
+            return
+        return riskinput.EpsilonGetter(oq.master_seed, oq.asset_correlation)
 
     def execute(self):
         """
@@ -370,8 +580,6 @@ class EbrCalculator(base.RiskCalculator):
         self.sm_by_grp = self.csm_info.get_sm_by_grp()
         self.E = num_events = len(self.datastore['events'])
         self.assets_by_site = self.assetcol.assets_by_site()
-        self.start = 0
-        self.get_eps = self.epsilon_getter()
         self.riskmodel.taxonomy = self.assetcol.tagcol.taxonomy
         for i, args in enumerate(self.gen_args()):
             ires = self.start_tasks(*args)
@@ -391,10 +599,10 @@ class EbrCalculator(base.RiskCalculator):
         """
         oq = self.oqparam
         self.A = len(self.assetcol)
-        if oq.asset_loss_table:
+        if self.save_loss_ratios:
             # save all_loss_ratios
             self.alr_nbytes = 0
-            self.indices = collections.defaultdict(list)  # sid -> pairs
+            self.alr_start = 0  # number of rows in all_loss_ratios/data
 
         if oq.avg_losses:
             self.dset = self.datastore.create_dset(
@@ -403,7 +611,6 @@ class EbrCalculator(base.RiskCalculator):
         num_events = collections.Counter()
         self.gmdata = AccumDict(accum=numpy.zeros(len(oq.imtls) + 1, F32))
         self.taskno = 0
-        self.start = 0
         self.num_losses = numpy.zeros((self.A, num_rlzs), U32)
         for res in allres:
             start, stop = res.rlz_slice.start, res.rlz_slice.stop
@@ -442,9 +649,7 @@ class EbrCalculator(base.RiskCalculator):
         """
         aids = dic.pop('aids')
         agglosses = dic.pop('agglosses')
-        assratios = dic.pop('assratios')
         avglosses = dic.pop('avglosses')
-        lrs_idx = dic.pop('lrs_idx')
         with self.monitor('saving event loss table', autoflush=True):
             if self.precomputed_gmfs:
                 idx, agg = agglosses
@@ -452,18 +657,39 @@ class EbrCalculator(base.RiskCalculator):
             else:  # event_based_risk
                 agglosses['rlzi'] += offset
                 self.datastore.extend('losses_by_event', agglosses)
-        if self.oqparam.asset_loss_table:
+        if self.save_loss_ratios:
+            assratios = dic.pop('assratios')
+            lrs_idx = dic.pop('lrs_idx')
             with self.monitor('saving loss ratios', autoflush=True):
-                for (a, r), num in dic.pop('num_losses').items():
-                    self.num_losses[a, r + offset] += num
-                for aid, pairs in lrs_idx.items():
-                    self.indices[aid].extend(
-                        (start + self.start, stop + self.start)
-                        for start, stop in pairs)
-                self.start += len(assratios)
                 assratios['rlzi'] += offset
+                sizes = lrs_idx['stop'] - lrs_idx['start']
+                numpy.add.at(self.num_losses, (
+                    lrs_idx['aid'].repeat(sizes), assratios['rlzi']), 1)
+                # the slices are sorted by asset in .postproc
+                lrs_idx['start'] += self.alr_start
+                lrs_idx['stop'] += self.alr_start
+                self.alr_start += len(assratios)
                 self.datastore.extend('all_loss_ratios/data', assratios)
+                self.datastore.extend('all_loss_ratios/indices', lrs_idx)
                 self.alr_nbytes += assratios.nbytes
+        if 'agg_loss_table' in dic:
+            table = dic.pop('agg_loss_table')
+            table['rlzi'] += offset
+            self.agg_tables.append(table)
+        if 'top_losses' in dic:
+            aids, rlzs, top = dic.pop('top_losses')
+            with self.monitor('merging top losses', autoflush=True):
+                if self.top_losses is None:
+                    self.top_losses = numpy.zeros(
+                        self.num_losses.shape + top.shape[1:], F32)
+                # the top losses of the union are the top losses of the
+                # union of the top losses
+                rlzs = rlzs + offset
+                k = top.shape[1]
+                top = numpy.concatenate(
+                    [self.top_losses[aids, rlzs], top], axis=1)
+                top.sort(axis=1)
+                self.top_losses[aids, rlzs] = top[:, -k:]
 
         if not hasattr(self, 'vals'):
             self.vals = self.assetcol.values()
@@ -519,6 +745,9 @@ class EbrCalculator(base.RiskCalculator):
                 agglt = self.datastore['losses_by_event']
                 agglt.attrs['nonzero_fraction'] = len(agglt) / E
 
+        if getattr(self, 'agg_tables', None):
+            with self.monitor('saving agg_loss_table', measuremem=True):
+                base.save_agg_loss_table(self, self.agg_tables)
         self.postproc()
 
     def postproc(self):
@@ -560,10 +789,12 @@ class EbrCalculator(base.RiskCalculator):
                 stats=[encode(name) for (name, func) in stats], units=units)
 
         if 'all_loss_ratios' in self.datastore:
-            self.datastore.save_vlen(
-                'all_loss_ratios/indices',
-                [numpy.array(self.indices[aid], riskinput.indices_dt)
-                 for aid in range(self.A)])
+            # store the slices in CSR format: the slices of the asset `aid`
+            # are indices[indptr[aid]:indptr[aid + 1]]
+            dset = self.datastore['all_loss_ratios/indices']
+            indices, indptr = build_csr(dset.value, self.A)
+            dset[:] = indices
+            self.datastore['all_loss_ratios/indptr'] = indptr
             self.datastore.set_attrs(
                 'all_loss_ratios',
                 loss_types=' '.join(self.riskmodel.loss_types))
@@ -572,20 +803,28 @@ class EbrCalculator(base.RiskCalculator):
             self.datastore.set_attrs(
                 'all_loss_ratios/data',
                 nbytes=nbytes, bytes_per_asset=nbytes / self.A)
+        if 'all_loss_ratios' in self.datastore or self.top_losses is not None:
             EbrPostCalculator(self).run(close=False)
 
 
 # ######################### EbrPostCalculator ############################## #
 
-def build_curves_maps(avalues, builder, lrgetter, stats, clp, monitor):
+def build_curves_maps(avalues, builder, lrgetter, stats, clp, online,
+                      monitor):
     """
     Build loss curves and optionally maps if conditional_loss_poes are set.
+    In online mode `lrgetter` is a pair (aids, top_losses).
     """
-    with monitor('getting loss ratios'):
-        loss_ratios = lrgetter.get_all()
-    curves, curves_stats = builder.build_all(avalues, loss_ratios, stats)
+    if online:  # the top losses are already there
+        aids, top_losses = lrgetter
+        curves, curves_stats = builder.build_top(avalues, top_losses, stats)
+    else:
+        aids = lrgetter.aids
+        with monitor('getting loss ratios'):
+            loss_ratios = lrgetter.get_all()
+        curves, curves_stats = builder.build_all(avalues, loss_ratios, stats)
     loss_maps, loss_maps_stats = builder.build_maps(curves, clp, stats)
-    res = {'aids': lrgetter.aids, 'loss_maps-rlzs': loss_maps}
+    res = {'aids': aids, 'loss_maps-rlzs': loss_maps}
     if loss_maps_stats is not None:
         res['loss_maps-stats'] = loss_maps_stats
     if curves_stats is not None:
@@ -599,6 +838,7 @@ class EbrPostCalculator(base.RiskCalculator):
         self.oqparam = calc.oqparam
         self._monitor = calc._monitor
         self.riskmodel = calc.riskmodel
+        self.top_losses = calc.top_losses
         self.loss_builder = get_loss_builder(calc.datastore)
         P = len(self.oqparam.conditional_loss_poes)
         self.loss_maps_dt = self.oqparam.loss_dt((F32, (P,)))
@@ -630,7 +870,9 @@ class EbrPostCalculator(base.RiskCalculator):
         oq = self.oqparam
         R = len(self.loss_builder.weights)
         # build loss maps
-        if 'all_loss_ratios' in self.datastore and oq.conditional_loss_poes:
+        online = self.top_losses is not None
+        if ((online or 'all_loss_ratios' in self.datastore) and
+                oq.conditional_loss_poes):
             assetcol = self.datastore['assetcol']
             stats = oq.risk_stats()
             builder = self.loss_builder
@@ -653,6 +895,17 @@ class EbrPostCalculator(base.RiskCalculator):
                     'curves-stats', return_periods=builder.return_periods,
                     stats=[encode(name) for (name, func) in stats])
             mon = self.monitor('loss maps')
+            if online:
+                # no need to read the loss ratios, the top losses are enough
+                allargs = []
+                for aids in split_in_blocks(range(A), oq.concurrent_tasks):
+                    aids = list(aids)
+                    allargs.append((assetcol.values(aids), builder,
+                                    (aids, self.top_losses[aids]), stats,
+                                    oq.conditional_loss_poes, True, mon))
+                parallel.Starmap(build_curves_maps, allargs).reduce(
+                    self.save_curves_maps)
+                return
             lazy = ('all_loss_ratios' in self.datastore.parent
                     and self.can_read_parent())
             logging.info('Instantiating LossRatiosGetters')
@@ -665,7 +918,8 @@ class EbrPostCalculator(base.RiskCalculator):
                     # a lazy getter will read the loss_ratios from the workers
                     # an eager getter reads the loss_ratios upfront
                     allargs.append((assetcol.values(aids), builder, getter,
-                                    stats, oq.conditional_loss_poes, mon))
+                                    stats, oq.conditional_loss_poes, False,
+                                    mon))
             if lazy:
                 # avoid OSError: Can't read data (Wrong b-tree signature)
                 self.datastore.parent.close()
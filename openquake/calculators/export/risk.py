@@ -516,13 +516,12 @@ def export_asset_loss_table(ekey, dstore):
         total = numpy.zeros(len(dtlist), F32)
         for pairs in parallel.Starmap(get_loss_ratios, allargs):
             for aid, data in pairs:
-                asset = assetcol[aid]
                 avalue = avals[aid]
                 for l, lt in enumerate(loss_types):
                     aval = avalue[lt]
                     for i in range(oq.insured_losses + 1):
                         data['ratios'][:, l + L * i] *= aval
-                aref = arefs[asset.ordinal]
+                aref = arefs[aid]
                 f[b'asset_loss_table/' + aref] = data.view(lrs_dt)
                 total += data['ratios'].sum(axis=0)
                 nbytes += data.nbytes
@@ -28,9 +28,10 @@ else:
     memoized = lru_cache(100)
 from openquake.baselib.hdf5 import ArrayWrapper
 from openquake.baselib.general import DictArray, group_array
-from openquake.baselib.python3compat import encode
+from openquake.baselib.python3compat import encode, decode
 from openquake.calculators import getters
 from openquake.commonlib import calc, util
+from openquake.risklib import riskmodels
 
 F32 = numpy.float32
 F64 = numpy.float64
@@ -125,11 +126,10 @@ def extract_asset_values(dstore, sid):
     data = []
     for assets in assets_by_site:
         vals = numpy.zeros(len(assets), dt)
-        for a, asset in enumerate(assets):
-            vals[a]['aref'] = asset_refs[a]
-            vals[a]['aid'] = asset.ordinal
-            for lt in lts:
-                vals[a][lt] = asset.value(lt, time_event)
+        vals['aref'] = asset_refs[assets['ordinal']]
+        vals['aid'] = assets['ordinal']
+        for lt in lts:
+            vals[lt] = riskmodels.get_values(lt, assets, time_event)
         data.append(vals)
     return data
 
@@ -275,41 +275,46 @@ def extract_uhs(dstore, what):
     return hazard_items(dic, mesh, investigation_time=oq.investigation_time)
 
 
-def _agg(losses, idxs):
+def _agg(losses, mask):
     shp = losses.shape[1:]
-    if not idxs:
+    if not mask.any():
         # no intersection, return a 0-dim matrix
         return numpy.zeros((0,) + shp, losses.dtype)
-    # numpy.array wants lists, not sets, hence the sorted below
-    return losses[numpy.array(sorted(idxs))].sum(axis=0)
+    return losses[mask].sum(axis=0)
 
 
 def _filter_agg(assetcol, losses, selected, stats=''):
     # losses is an array of shape (A, ..., R) with A=#assets, R=#realizations
-    aids_by_tag = assetcol.get_aids_by_tag()
-    idxs = set(range(len(assetcol)))
+    # the assets are selected with boolean masks built from the tag indices
+    tagcol = assetcol.tagcol
+    mask = numpy.ones(len(assetcol), bool)
     tagnames = []
     for tag in selected:
         tagname, tagvalue = tag.split('=', 1)
         if tagvalue == '*':
             tagnames.append(tagname)
+            continue
+        tagvalues = [decode(val) for val in getattr(tagcol, tagname, [])]
+        try:
+            tagidx = tagvalues.index(tagvalue)
+        except ValueError:  # unknown tag
+            mask[:] = False
         else:
-            idxs &= aids_by_tag[tag]
+            mask &= assetcol.array[tagname] == tagidx
     if len(tagnames) > 1:
         raise ValueError('Too many * as tag values in %s' % tagnames)
     elif not tagnames:  # return an array of shape (..., R)
         return ArrayWrapper(
-            _agg(losses, idxs), dict(selected=encode(selected), stats=stats))
+            _agg(losses, mask), dict(selected=encode(selected), stats=stats))
     else:  # return an array of shape (T, ..., R)
         [tagname] = tagnames
-        _tags = list(assetcol.tagcol.gen_tags(tagname))
-        all_idxs = [idxs & aids_by_tag[t] for t in _tags]
-        # NB: using a generator expression for all_idxs caused issues (?)
+        tagidxs = assetcol.array[tagname]
+        counts = numpy.bincount(tagidxs[mask],
+                                minlength=len(getattr(tagcol, tagname)))
         data, tags = [], []
-        for idxs, tag in zip(all_idxs, _tags):
-            agglosses = _agg(losses, idxs)
-            if len(agglosses):
-                data.append(agglosses)
+        for tagidx, tag in enumerate(tagcol.gen_tags(tagname)):
+            if counts[tagidx]:
+                data.append(_agg(losses, mask & (tagidxs == tagidx)))
                 tags.append(tag)
         return ArrayWrapper(
             numpy.array(data),
@@ -92,14 +92,17 @@ class PmapGetter(object):
         self._pmap_by_grp = {}
         if 'poes' in self.dstore:
             # build probability maps restricted to the given sids
-            ok_sids = set(self.sids)
             for grp, dset in self.dstore['poes'].items():
                 ds = dset['array']
                 L, I = ds.shape[1:]
-                pmap = probability_map.ProbabilityMap(L, I)
-                for idx, sid in enumerate(dset['sids'].value):
-                    if sid in ok_sids:
-                        pmap[sid] = probability_map.ProbabilityCurve(ds[idx])
+                sids = dset['sids'].value
+                ok, = numpy.isin(sids, self.sids).nonzero()
+                if len(ok):  # read only the relevant slice of the dataset
+                    start, stop = ok[0], ok[-1] + 1
+                    pmap = probability_map.ProbabilityMap.from_array(
+                        ds[start:stop][ok - start], sids[ok])
+                else:
+                    pmap = probability_map.ProbabilityMap(L, I)
                 self._pmap_by_grp[grp] = pmap
                 self.nbytes += pmap.nbytes
         return self._pmap_by_grp
@@ -309,7 +312,8 @@ class GmfGetter(object):
     def gen_gmv(self, gsim=None):
         """
         Compute the GMFs for the given realization and populate the .gmdata
-        array. Yields tuples of the form (sid, eid, imti, gmv).
+        array. Yields arrays of dtype gmf_data_dt, one for each rupture and
+        realization, containing only the nonzero ground motion values.
         """
         sample = 0  # in case of sampling the realizations have a corresponding
         # sample number from 0 to the number of samples of the given src model
@@ -329,59 +333,99 @@ class GmfGetter(object):
                 # NB: the trick for performance is to keep the call to
                 # compute.compute outside of the loop over the realizations
                 # it is better to have few calls producing big arrays
-                array = computer.compute(gs, num_events).transpose(1, 0, 2)
-                # shape (N, I, E)
+                array = computer.compute(gs, num_events)  # shape (I, N, E)
                 for i, miniml in enumerate(self.min_iml):  # gmv < minimum
-                    arr = array[:, i, :]
+                    arr = array[i]
                     arr[arr < miniml] = 0
                 n = 0
                 for r, rlzi in enumerate(rlzs):
-                    e = len(all_eids[r])
+                    eids = all_eids[r]
+                    e = len(eids)
                     gmdata = self.gmdata[rlzi]
                     gmdata[-1] += e  # increase number of events
-                    for ei, eid in enumerate(all_eids[r]):
-                        gmf = array[:, :, n + ei]  # shape (N, I)
-                        tot = gmf.sum(axis=0)  # shape (I,)
-                        if not tot.sum():
-                            continue
-                        for i, val in enumerate(tot):
-                            gmdata[i] += val
-                        for sid, gmv in zip(sids, gmf):
-                            if gmv.sum():
-                                yield rlzi, sid, eid, gmv
+                    gmf = array[:, :, n: n + e].transpose(2, 1, 0)  # (e, N, I)
                     n += e
+                    eidx, sidx = gmf.any(axis=2).nonzero()  # nonzero gmvs
+                    if len(eidx) == 0:
+                        continue
+                    gmdata[:-1] += gmf.sum(axis=(0, 1))
+                    data = numpy.zeros(len(eidx), self.gmf_data_dt)
+                    data['rlzi'] = rlzi
+                    data['sid'] = sids[sidx]
+                    data['eid'] = eids[eidx]
+                    data['gmv'] = gmf[eidx, sidx]
+                    yield data
             sample += len(rlzs)
 
+    def get_gmfdata(self, gsim=None):
+        """
+        :returns: an array of dtype gmf_data_dt with all the nonzero GMFs
+        """
+        data = list(self.gen_gmv(gsim))
+        if not data:
+            return numpy.zeros(0, self.gmf_data_dt)
+        return numpy.concatenate(data)
+
     def get_hazard(self, gsim=None, data=None):
         """
-        :param data: if given, an iterator of records of dtype gmf_data_dt
+        :param data: if given, an array of records of dtype gmf_data_dt
         :returns: an array (rlzi, sid, imti) -> array(gmv, eid)
         """
         if data is None:
-            data = self.gen_gmv(gsim)
+            data = self.get_gmfdata(gsim)
         hazard = numpy.array([collections.defaultdict(list)
                               for _ in range(self.N)])
-        for rlzi, sid, eid, gmv in data:
-            hazard[sid][rlzi].append((gmv, eid))
-        for haz in hazard:
-            for rlzi in haz:
-                haz[rlzi] = numpy.array(haz[rlzi], self.gmv_eid_dt)
+        if len(data) == 0:
+            return hazard
+        # group the records by site and realization, keeping their order
+        idxs = numpy.lexsort((data['rlzi'], data['sid']))
+        data = data[idxs]
+        sids, rlzis = data['sid'], data['rlzi']
+        starts, = ((sids[1:] != sids[:-1]) | (rlzis[1:] != rlzis[:-1])
+                   ).nonzero()
+        starts = numpy.append(0, starts + 1)
+        stops = numpy.append(starts[1:], len(data))
+        for start, stop in zip(starts, stops):
+            arr = numpy.zeros(stop - start, self.gmv_eid_dt)
+            arr['gmv'] = data['gmv'][start:stop]
+            arr['eid'] = data['eid'][start:stop]
+            hazard[sids[start]][rlzis[start]] = arr
         return hazard
 
 
 class LossRatiosGetter(object):
     """
     Read loss ratios from the datastore for all realizations or for a specific
-    realization.
+    realization. The slices of `all_loss_ratios/data` are stored in CSR
+    format, i.e. the slices of the asset `aid` are
+    `indices[indptr[aid]:indptr[aid + 1]]`, so that only the indices
+    in the range of the given assets are read. The datastores without
+    `all_loss_ratios/indptr` store the slices of each asset in a row of
+    `all_loss_ratios/indices` and are still supported.
 
     :param dstore: a DataStore instance
     """
     def __init__(self, dstore, aids=None, lazy=True):
         self.dstore = dstore
         dstore.open()
-        dset = self.dstore['all_loss_ratios/indices']
-        self.aids = list(aids or range(len(dset)))
-        self.indices = [dset[aid] for aid in self.aids]
+        if 'all_loss_ratios/indptr' not in dstore:  # old layout
+            dset = self.dstore['all_loss_ratios/indices']
+            self.aids = list(aids or range(len(dset)))
+            self.indices = [dset[aid] for aid in self.aids]
+            self.data = None if lazy else self.get_all()
+            return
+        indptr = self.dstore['all_loss_ratios/indptr']
+        self.aids = list(aids or range(len(indptr) - 1))
+        self.indices = []  # a list of arrays of dtype lrs_idx_dt
+        if self.aids:
+            amin, amax = min(self.aids), max(self.aids)
+            ptr = indptr[amin:amax + 2]
+            indices = self.dstore['all_loss_ratios/indices'][
+                ptr[0]:ptr[-1]]
+            ptr -= ptr[0]
+            for aid in self.aids:
+                self.indices.append(
+                    indices[ptr[aid - amin]:ptr[aid - amin + 1]])
         self.data = None if lazy else self.get_all()
 
     # used in the loss curves exporter
@@ -390,14 +434,12 @@ class LossRatiosGetter(object):
         :param rlzi: a realization ordinal
         :returns: a dictionary aid -> array of shape (E, LI)
         """
-        data = self.dstore['all_loss_ratios/data']
-        dic = collections.defaultdict(list)  # aid -> ratios
-        for aid, idxs in zip(self.aids, self.indices):
-            for idx in idxs:
-                for rec in data[idx[0]: idx[1]]:  # dtype (rlzi, ratios)
-                    if rlzi == rec['rlzi']:
-                        dic[aid].append(rec['ratios'])
-        return {a: numpy.array(dic[a]) for a in dic}
+        dic = {}
+        for aid, arr in zip(self.aids, self.get_all()):
+            ratios = arr['ratios'][arr['rlzi'] == rlzi]
+            if len(ratios):
+                dic[aid] = ratios
+        return dic
 
     # used in the calculator
     def get_all(self):
@@ -411,7 +453,8 @@ class LossRatiosGetter(object):
         loss_ratio_data = []
         for aid, idxs in zip(self.aids, self.indices):
             if len(idxs):
-                arr = numpy.concatenate([data[idx[0]: idx[1]] for idx in idxs])
+                arr = numpy.concatenate(
+                    [data[idx['start']: idx['stop']] for idx in idxs])
             else:
                 # FIXME: a test for this case is missing
                 arr = numpy.array([], data.dtype)
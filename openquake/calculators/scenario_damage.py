@@ -16,11 +16,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
-import itertools
+import collections
 import logging
 import numpy
 
+from openquake.baselib.general import ceil, split_in_slices
 from openquake.risklib import scientific, riskmodels
+from openquake.risklib.riskinput import group_by_taxonomy
 from openquake.calculators import base
 
 U16 = numpy.uint16
@@ -28,29 +30,48 @@ U64 = numpy.uint64
 F32 = numpy.float32
 F64 = numpy.float64
 
+# maximum number of damage fractions kept in memory at once in a task
+MAX_FRACTIONS = 10 ** 6
 
-def dist_by_asset(data, multi_stat_dt, number):
+
+def dist_by_asset(data, multi_stat_dt, number, aids=None):
     """
     :param data: array of shape (N, R, L, 2, ...)
     :param multi_stat_dt: numpy dtype for statistical outputs
     :param number: expected number of units per asset
+    :param aids: the ordinals of the N assets (default range(N))
     :returns: array of shape (N, R) with records of type multi_stat_dt
     """
     N, R, L = data.shape[:3]
+    if aids is None:
+        aids = numpy.arange(N)
     out = numpy.zeros((N, R), multi_stat_dt)
     for l, lt in enumerate(multi_stat_dt.names):
         out_lt = out[lt]
-        for n, r in itertools.product(range(N), range(R)):
-            mean, stddev = data[n, r, l]
-            out_lt[n, r] = (mean, stddev)
-            # sanity check on the sum over all damage states
-            if abs(mean.sum() / number[n] - 1) > 1E-3:
-                logging.warn(
-                    'Asset #%d, rlz=%d, expected %s, got %s for %s damage',
-                    n, r, number[n], mean.sum(), lt)
+        out_lt['mean'] = data[:, :, l, 0]
+        out_lt['stddev'] = data[:, :, l, 1]
+        # sanity check on the sum over all damage states
+        tot = data[:, :, l, 0].sum(axis=-1)  # shape (N, R)
+        bad = numpy.abs(tot / number[:, None] - 1) > 1E-3
+        for n, r in zip(*numpy.where(bad)):
+            logging.warn(
+                'Asset #%d, rlz=%d, expected %s, got %s for %s damage',
+                aids[n], r, number[n], tot[n, r], lt)
     return out
 
 
+def _get_gmvs(hazard, sids, rlzi, m, eids):
+    # build an array of ground motion values of shape (S, E), with zeros
+    # for the sites and events without hazard; the values are placed by
+    # event, since the GMFs below the minimum_intensity are not stored
+    gmvs = numpy.zeros((len(sids), len(eids)), F32)
+    for s, sid in enumerate(sids):
+        haz = hazard[sid][rlzi]
+        if isinstance(haz, numpy.ndarray):
+            gmvs[s, numpy.searchsorted(eids, haz['eid'])] = haz['gmv'][:, m]
+    return gmvs
+
+
 def scenario_damage(riskinput, riskmodel, param, monitor):
     """
     Core function for a damage computation.
@@ -64,46 +85,102 @@ def scenario_damage(riskinput, riskmodel, param, monitor):
     :param param:
         dictionary of extra parameters
     :returns:
-        a dictionary {'d_asset': [(l, r, a, mean-stddev), ...],
-                      'd_event': damage array of shape R, L, E, D,
-                      'c_asset': [(l, r, a, mean-stddev), ...],
-                      'c_event': damage array of shape R, L, E}
-
-    `d_asset` and `d_tag` are related to the damage distributions
-    whereas `c_asset` and `c_tag` are the consequence distributions.
-    If there is no consequence model `c_asset` is an empty list and
-    `c_tag` is a zero-valued array.
+        a dictionary {'aids': sorted asset ordinals of shape A,
+                      'd_asset': damage array of shape A, R, L, 2, D,
+                      'd_event': damage array of shape E, R, L, D,
+                      'c_asset': consequence array of shape A, R, L, 2,
+                      'c_event': consequence array of shape E, R, L}
+
+    `d_asset` and `d_event` are related to the damage distributions
+    whereas `c_asset` and `c_event` are the consequence distributions.
+    If there is no consequence model `c_asset` and `c_event` are
+    zero-valued arrays.
+
+    The damage fractions of all the sites with assets of a given taxonomy
+    are computed at once, in blocks of events; the mean and standard
+    deviation of the fractions are accumulated with running statistics
+    and then multiplied by the number of units (or the values) of the
+    assets, so that the fractions by asset and event are never stored.
     """
     c_models = param['consequence_models']
     L = len(riskmodel.loss_types)
     R = riskinput.hazard_getter.num_rlzs
     D = len(riskmodel.damage_states)
     E = param['number_of_ground_motion_fields']
-    result = dict(d_asset=[], d_event=numpy.zeros((E, R, L, D), F64),
-                  c_asset=[], c_event=numpy.zeros((E, R, L), F64))
-    for outputs in riskmodel.gen_outputs(riskinput, monitor):
-        r = outputs.rlzi
-        for l, damages in enumerate(outputs):
-            loss_type = riskmodel.loss_types[l]
-            c_model = c_models.get(loss_type)
-            for a, fraction in enumerate(damages):
-                asset = outputs.assets[a]
-                taxo = riskmodel.taxonomy[asset.taxonomy]
-                damages = fraction * asset.number
-                result['d_event'][:, r, l] += damages  # shape (E, D)
-                if c_model:  # compute consequences
-                    means = [par[0] for par in c_model[taxo].params]
-                    # NB: we add a 0 in front for nodamage state
-                    c_ratio = numpy.dot(fraction, [0] + means)
-                    consequences = c_ratio * asset.value(loss_type)
-                    result['c_asset'].append(
-                        (l, r, asset.ordinal,
-                         scientific.mean_std(consequences)))
-                    result['c_event'][:, r, l] += consequences
-                    # TODO: consequences for the occupants
-                result['d_asset'].append(
-                    (l, r, asset.ordinal, scientific.mean_std(damages)))
-    result['gmdata'] = riskinput.gmdata
+    hazard_getter = riskinput.hazard_getter
+    with monitor('getting hazard'):
+        hazard_getter.init()
+        hazard = hazard_getter.get_hazard()
+    eids = hazard_getter.eids  # sorted event IDs
+    imti = {imt: m for m, imt in enumerate(hazard_getter.imtls)}
+    dic = collections.defaultdict(list)  # taxonomy -> [(sid, assets)]
+    for sid, assets in zip(hazard_getter.sids, riskinput.assets_by_site):
+        for taxonomy, tassets in group_by_taxonomy(assets):
+            dic[taxonomy].append((sid, tassets))
+    aids = numpy.sort(riskinput.aids)
+    A = len(aids)
+    result = dict(aids=aids,
+                  d_asset=numpy.zeros((A, R, L, 2, D), F32),
+                  d_event=numpy.zeros((E, R, L, D), F64),
+                  c_asset=numpy.zeros((A, R, L, 2), F32),
+                  c_event=numpy.zeros((E, R, L), F64))
+    with monitor('computing risk'):
+        for taxonomy in sorted(dic):
+            rm = riskmodel[taxonomy]
+            taxo = riskmodel.taxonomy[taxonomy]
+            for r in range(R):
+                pairs = [(sid, tassets) for sid, tassets in dic[taxonomy]
+                         if r in hazard[sid]]
+                if not pairs:
+                    continue
+                sids = [sid for sid, tassets in pairs]
+                S = len(sids)
+                assets = numpy.concatenate([ta for sid, ta in pairs])
+                idx = numpy.searchsorted(aids, assets['ordinal'])
+                site = numpy.repeat(numpy.arange(S),
+                                    [len(ta) for sid, ta in pairs])
+                number = assets['number']
+                nsite = numpy.bincount(site, number, S)
+                slices = split_in_slices(E, ceil(S * E * D, MAX_FRACTIONS))
+                for l, loss_type in enumerate(riskmodel.loss_types):
+                    c_model = c_models.get(loss_type)
+                    imt = rm.risk_functions[loss_type].imt
+                    gmvs = _get_gmvs(hazard, sids, r, imti[imt], eids)
+                    # sites and events without ground motion are not
+                    # damaged; the fragility functions may be undefined at 0
+                    nodata = gmvs == 0
+                    dstats = scientific.RunningStats((S, D))
+                    if c_model:
+                        # NB: we add a 0 in front for nodamage state
+                        coeffs = [0] + [par[0] for par in
+                                        c_model[taxo].params]
+                        avalues = riskmodels.get_values(loss_type, assets)
+                        vsite = numpy.bincount(site, avalues, S)
+                        cstats = scientific.RunningStats(S)
+                    for sl in slices:
+                        fractions = rm.get_fractions(loss_type, gmvs[:, sl])
+                        fractions[:, nodata[:, sl]] = 0
+                        fractions[0, nodata[:, sl]] = 1
+                        # fractions has shape (D, S, B)
+                        dstats.update(fractions.T)
+                        result['d_event'][sl, r, l] += numpy.einsum(
+                            'dsb,s->bd', fractions, nsite)
+                        if c_model:  # compute consequences
+                            c_ratio = numpy.einsum(
+                                'd,dsb->bs', coeffs, fractions)
+                            cstats.update(c_ratio)
+                            result['c_event'][sl, r, l] += c_ratio.dot(vsite)
+                            # TODO: consequences for the occupants
+                    mean, std = dstats.get()
+                    result['d_asset'][idx, r, l, 0] = (
+                        mean[site] * number[:, None])
+                    result['d_asset'][idx, r, l, 1] = (
+                        std[site] * number[:, None])
+                    if c_model:
+                        mean, std = cstats.get()
+                        result['c_asset'][idx, r, l, 0] = mean[site] * avalues
+                        result['c_asset'][idx, r, l, 1] = std[site] * avalues
+    result['gmdata'] = hazard_getter.gmdata
     return result
 
 
@@ -127,30 +204,57 @@ class ScenarioDamageCalculator(base.RiskCalculator):
         self.riskinputs = self.build_riskinputs('gmf', num_events=E)
         self.param['tags'] = list(self.assetcol.tagcol)
 
+        # the distributions by asset are saved by `combine` as soon as
+        # the tasks return, so that they are never kept in memory together
+        N = len(self.assetcol)
+        R = len(self.rlzs_assoc.realizations)
+        L = len(self.riskmodel.loss_types)
+        D = len(self.riskmodel.damage_states)
+        self.multi_stat_dt = numpy.dtype(
+            [(ltype, numpy.dtype([('mean', (F32, D)), ('stddev', (F32, D))]))
+             for ltype in self.riskmodel.loss_types])
+        self.datastore.create_dset(
+            'dmg_by_asset', self.multi_stat_dt, (N, R), fillvalue=None)
+        c_models = self.param['consequence_models']
+        self.with_consequences = any(
+            c_models.get(lt) for lt in self.riskmodel.loss_types)
+        if self.with_consequences:
+            stat_dt = numpy.dtype([('mean', F32), ('stddev', F32)])
+            self.datastore.create_dset(
+                'losses_by_asset', stat_dt, (N, R, L), fillvalue=None)
+
+    def combine(self, acc, res):
+        """
+        Save the distributions by asset returned by a task and
+        accumulate the distributions by event.
+        """
+        aids = res.pop('aids')
+        d_asset = res.pop('d_asset')
+        c_asset = res.pop('c_asset')
+        if len(aids):
+            number = self.assetcol.array['number'][aids]
+            idxs = aids.tolist()  # h5py accepts only lists of indices
+            self.datastore['dmg_by_asset'][idxs] = dist_by_asset(
+                d_asset, self.multi_stat_dt, number, aids)
+            if self.with_consequences:
+                dset = self.datastore['losses_by_asset']
+                c_dist = numpy.zeros(c_asset.shape[:-1], dset.dtype)
+                c_dist['mean'] = c_asset[..., 0]
+                c_dist['stddev'] = c_asset[..., 1]
+                dset[idxs] = c_dist
+        return acc + res
+
     def post_execute(self, result):
         """
         Compute stats for the aggregated distributions and save
         the results on the datastore.
         """
-        dstates = self.riskmodel.damage_states
         ltypes = self.riskmodel.loss_types
         L = len(ltypes)
         R = len(self.rlzs_assoc.realizations)
-        D = len(dstates)
-        N = len(self.assetcol)
         E = self.oqparam.number_of_ground_motion_fields
 
         # damage distributions
-        dt_list = []
-        for ltype in ltypes:
-            dt_list.append((ltype, numpy.dtype([('mean', (F32, D)),
-                                                ('stddev', (F32, D))])))
-        multi_stat_dt = numpy.dtype(dt_list)
-        d_asset = numpy.zeros((N, R, L, 2, D), F32)
-        for (l, r, a, stat) in result['d_asset']:
-            d_asset[a, r, l] = stat
-        self.datastore['dmg_by_asset'] = dist_by_asset(
-            d_asset, multi_stat_dt, self.assetcol.array['number'])
         dmg_dt = [(ds, F32) for ds in self.riskmodel.damage_states]
         d_event = numpy.zeros((E, R, L), dmg_dt)
         for d, ds in enumerate(self.riskmodel.damage_states):
@@ -158,14 +262,8 @@ class ScenarioDamageCalculator(base.RiskCalculator):
         self.datastore['dmg_by_event'] = d_event
 
         # consequence distributions
-        if result['c_asset']:
+        if self.with_consequences:
             dtlist = [('eid', U64), ('rlzi', U16), ('loss', (F32, L))]
-            stat_dt = numpy.dtype([('mean', F32), ('stddev', F32)])
-            c_asset = numpy.zeros((N, R, L), stat_dt)
-            for (l, r, a, stat) in result['c_asset']:
-                c_asset[a, r, l] = stat
-            multi_stat_dt = self.oqparam.loss_dt(stat_dt)
-            self.datastore['losses_by_asset'] = c_asset
             self.datastore['losses_by_event'] = numpy.fromiter(
                 ((eid, rlzi, F32(result['c_event'][eid, rlzi]))
                  for rlzi in range(R) for eid in range(E)), dtlist)
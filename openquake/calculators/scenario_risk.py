@@ -23,6 +23,7 @@ import numpy
 from openquake.baselib.python3compat import zip, encode
 from openquake.baselib.general import AccumDict
 from openquake.risklib import scientific
+from openquake.risklib.asset import get_agg_ids
 from openquake.calculators import base
 
 U16 = numpy.uint16
@@ -48,6 +49,7 @@ def scenario_risk(riskinput, riskmodel, param, monitor):
         a dictionary {
         'agg': array of shape (E, L, R, 2),
         'avg': list of tuples (lt_idx, rlz_idx, asset_ordinal, statistics)
+        'agg_loss_table': list with an array of losses by event and tags
         }
         where E is the number of simulated events, L the number of loss types,
         R the number of realizations  and statistics is an array of shape
@@ -59,23 +61,37 @@ def scenario_risk(riskinput, riskmodel, param, monitor):
     I = param['insured_losses'] + 1
     result = dict(agg=numpy.zeros((E, R, L * I), F32), avg=[],
                   all_losses=AccumDict(accum={}))
+    aggregate_by = param.get('aggregate_by')
+    aggl = []  # losses by event and aggregation ID
     for outputs in riskmodel.gen_outputs(riskinput, monitor):
         r = outputs.rlzi
         assets = outputs.assets
+        if aggregate_by:
+            agg_ids = get_agg_ids(assets, aggregate_by, param['agg_shape'])
+            n = len(assets) * E
         for l, losses in enumerate(outputs):
             if losses is None:  # this may happen
                 continue
             stats = numpy.zeros((len(assets), I), stat_dt)  # mean, stddev
-            for a, asset in enumerate(assets):
+            for a, aid in enumerate(assets['ordinal']):
                 stats['mean'][a] = losses[a].mean()
                 stats['stddev'][a] = losses[a].std(ddof=1)
-                result['avg'].append((l, r, asset.ordinal, stats[a]))
+                result['avg'].append((l, r, aid, stats[a]))
             agglosses = losses.sum(axis=0)  # shape E, I
             for i in range(I):
                 result['agg'][:, r, l + L * i] += agglosses[:, i]
+                if aggregate_by:
+                    aggl.append((numpy.tile(numpy.arange(E), len(assets)),
+                                 numpy.repeat(r, n), agg_ids.repeat(E),
+                                 numpy.repeat(l + L * i, n),
+                                 losses[:, :, i].ravel()))
             if param['asset_loss_table']:
-                aids = [asset.ordinal for asset in outputs.assets]
+                aids = assets['ordinal']
                 result['all_losses'][l, r] += AccumDict(zip(aids, losses))
+    if aggregate_by:
+        arrays = map(numpy.concatenate, zip(*aggl)) if aggl else [[]] * 5
+        result['agg_loss_table'] = [
+            scientific.agg_loss_table(*arrays, LI=L * I)]
     return result
 
 
@@ -108,6 +124,9 @@ class ScenarioRiskCalculator(base.RiskCalculator):
         self.param['number_of_ground_motion_fields'] = E
         self.param['insured_losses'] = self.oqparam.insured_losses
         self.param['asset_loss_table'] = self.oqparam.asset_loss_table
+        self.param['aggregate_by'] = self.oqparam.aggregate_by
+        self.param['agg_shape'] = self.assetcol.agg_shape(
+            self.oqparam.aggregate_by)
 
     def post_execute(self, result):
         """
@@ -144,6 +163,10 @@ class ScenarioRiskCalculator(base.RiskCalculator):
                  for rlzi in range(R) for eid in range(E)), dtlist)
             self.datastore['losses_by_event'] = lbe
 
+            # losses by event and tags
+            if 'agg_loss_table' in result:
+                base.save_agg_loss_table(self, result['agg_loss_table'])
+
             # all losses
             if self.oqparam.asset_loss_table:
                 array = numpy.zeros((A, E, R), loss_dt)
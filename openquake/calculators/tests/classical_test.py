@@ -15,14 +15,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+import unittest
 import numpy
 from nose.plugins.attrib import attr
 from openquake.baselib import parallel
+from openquake.baselib.general import AccumDict
+from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib import InvalidFile
 from openquake.calculators.views import view
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
 from openquake.calculators.tests import CalculatorTestCase, NOT_DARWIN
+from openquake.calculators.classical import combine_pmaps, get_nsites
 from openquake.qa_tests_data.classical import (
     case_1, case_2, case_3, case_4, case_5, case_6, case_7, case_8, case_9,
     case_10, case_11, case_12, case_13, case_14, case_15, case_16, case_17,
@@ -30,6 +34,39 @@ from openquake.qa_tests_data.classical import (
     case_26, case_27, case_28, case_29, case_30)
 
 
+def _pmap_by_grp(sids_by_grp):
+    acc = AccumDict()
+    for grp_id, sids in sids_by_grp.items():
+        acc[grp_id] = ProbabilityMap(1, 1)
+        for sid in sids:
+            acc[grp_id].setdefault(sid, .1)
+    acc.eff_ruptures = AccumDict({grp_id: 1 for grp_id in sids_by_grp})
+    acc.calc_times = AccumDict(accum=numpy.zeros(4))
+    return acc
+
+
+class CombinePmapsTestCase(unittest.TestCase):
+    def test_nsites(self):
+        # the number of sites of each task is kept in the combined result
+        res1 = _pmap_by_grp({0: [0, 1], 1: [2]})
+        res2 = _pmap_by_grp({0: [1, 2, 3]})
+        res3 = _pmap_by_grp({1: [0]})
+        res = combine_pmaps(combine_pmaps(res1, res2), res3)
+        self.assertEqual(get_nsites(res), [2, 1, 3, 1])
+        self.assertEqual(sorted(res[0].sids), [0, 1, 2, 3])
+        self.assertEqual(res.eff_ruptures, {0: 2, 1: 2})
+
+    def test_collapsing_error(self):
+        # the maximum error is kept in the combined result
+        res1 = _pmap_by_grp({0: [0]})
+        res2 = _pmap_by_grp({0: [1]})
+        res2.collapsing_error = .01
+        res3 = _pmap_by_grp({0: [2]})
+        res3.collapsing_error = .002
+        res = combine_pmaps(combine_pmaps(res1, res2), res3)
+        self.assertEqual(res.collapsing_error, .01)
+
+
 class ClassicalTestCase(CalculatorTestCase):
 
     def assert_curves_ok(self, expected, test_dir, delta=None, **kw):
@@ -67,6 +104,15 @@ class ClassicalTestCase(CalculatorTestCase):
         sitecol = extract(self.calc.datastore, 'sitecol')
         self.assertEqual(repr(sitecol), '<SiteCollection with 1/1 sites>')
 
+    @attr('qa', 'hazard', 'classical')
+    def test_case_1_preclassical(self):
+        # the results of count_ruptures are plain dicts and must not be
+        # combined as ProbabilityMaps
+        self.run_calc(case_1.__file__, 'job.ini',
+                      calculation_mode='preclassical')
+        self.assertNotIn('poes', self.calc.datastore)
+        self.assertEqual(len(self.calc.datastore['source_info']), 1)
+
     @attr('qa', 'hazard', 'classical')
     def test_wrong_smlt(self):
         with self.assertRaises(InvalidFile):
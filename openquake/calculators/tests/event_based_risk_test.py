@@ -24,7 +24,11 @@ import h5py
 from nose.plugins.attrib import attr
 
 from openquake.baselib.general import gettemp
+from openquake.baselib.datastore import DataStore
+from openquake.risklib.riskinput import indices_dt
 from openquake.calculators.views import view
+from openquake.calculators.getters import LossRatiosGetter
+from openquake.calculators.event_based_risk import build_csr, lrs_idx_dt
 from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
@@ -56,6 +60,46 @@ def check_total_losses(calc):
     numpy.testing.assert_allclose(data1, total, 1E-6)
 
 
+class LossRatiosGetterTestCase(unittest.TestCase):
+    # 4 assets, the asset 2 without losses; the rows 0-3 of the data are
+    # stored by a task and the rows 4-5 by another task
+    def setUp(self):
+        self.dstore = DataStore()
+        self.data = numpy.zeros(
+            6, [('rlzi', numpy.uint16), ('ratios', (numpy.float32, (1,)))])
+        self.data['rlzi'] = [0, 1, 0, 0, 1, 0]
+        self.data['ratios'][:, 0] = numpy.arange(6)
+        self.dstore['all_loss_ratios/data'] = self.data
+        self.indices = numpy.array(
+            [(1, 0, 2), (0, 2, 3), (3, 3, 4), (1, 4, 6)], lrs_idx_dt)
+
+    def tearDown(self):
+        self.dstore.clear()
+
+    def check(self, getter):
+        ratios = [arr['ratios'][:, 0] for arr in getter.get_all()]
+        numpy.testing.assert_equal(ratios, [[0, 1, 4, 5], [], [3]])
+        dic = getter.get(1)  # the ratios of the realization 1
+        self.assertEqual(list(dic), [1])
+        numpy.testing.assert_equal(dic[1][:, 0], [1, 4])
+
+    def test_csr(self):
+        indices, indptr = build_csr(self.indices, 4)
+        numpy.testing.assert_equal(indptr, [0, 1, 3, 3, 4])
+        numpy.testing.assert_equal(indices['aid'], [0, 1, 1, 3])
+        numpy.testing.assert_equal(indices['start'], [2, 0, 4, 3])
+        self.dstore['all_loss_ratios/indices'] = indices
+        self.dstore['all_loss_ratios/indptr'] = indptr
+        self.check(LossRatiosGetter(self.dstore, [1, 2, 3]))
+
+    def test_old_layout(self):
+        # one row of (start, stop) pairs per asset and no indptr
+        self.dstore.save_vlen('all_loss_ratios/indices', [
+            numpy.array(pairs, indices_dt)
+            for pairs in [[(2, 3)], [(0, 2), (4, 6)], [], [(3, 4)]]])
+        self.check(LossRatiosGetter(self.dstore, [1, 2, 3]))
+
+
 class EventBasedRiskTestCase(CalculatorTestCase):
 
     def check_attr(self, name, value):
@@ -83,7 +127,7 @@ class EventBasedRiskTestCase(CalculatorTestCase):
 
     @attr('qa', 'risk', 'event_based_risk')
     def test_case_1(self):
-        self.run_calc(case_1.__file__, 'job.ini')
+        self.run_calc(case_1.__file__, 'job.ini', aggregate_by='taxonomy')
         ekeys = [('agg_curves-stats', 'csv')]
         for ekey in ekeys:
             for fname in export(ekey, self.calc.datastore):
@@ -118,6 +162,34 @@ class EventBasedRiskTestCase(CalculatorTestCase):
             self.assertEqualFiles('expected/' + strip_calc_id(fname),
                                   fname)
 
+        # the losses aggregated by taxonomy add up to the event losses
+        table = self.calc.datastore['agg_loss_table'].value
+        lbe = self.calc.datastore['losses_by_event'].value
+        keys = lbe['eid'] * 2 + lbe['rlzi']  # 2 realizations
+        idx = numpy.searchsorted(keys, table['eid'] * 2 + table['rlzi'])
+        tot = numpy.zeros_like(lbe['loss'])
+        numpy.add.at(tot, idx, table['loss'])
+        numpy.testing.assert_allclose(tot, lbe['loss'], rtol=1E-5)
+
+    @attr('qa', 'risk', 'event_based_risk')
+    def test_case_1_top_losses(self):
+        # without asset_loss_table the loss maps are built from the top losses
+        self.run_calc(case_1.__file__, 'job.ini', asset_loss_table='false')
+        self.assertNotIn('all_loss_ratios', self.calc.datastore)
+        for fname in export(('loss_maps-stats', 'csv'), self.calc.datastore):
+            self.assertEqualFiles('expected/' + strip_calc_id(fname),
+                                  fname, delta=1E-5)
+
+        # if the top losses are too big the asset loss table is stored
+        with mock.patch('openquake.calculators.event_based_risk.'
+                        'MAX_TOP_LOSSES_BYTES', 0):
+            self.run_calc(case_1.__file__, 'job.ini',
+                          asset_loss_table='false')
+        self.assertIn('all_loss_ratios', self.calc.datastore)
+        for fname in export(('loss_maps-stats', 'csv'), self.calc.datastore):
+            self.assertEqualFiles('expected/' + strip_calc_id(fname),
+                                  fname, delta=1E-5)
+
     @attr('qa', 'risk', 'event_based_risk')
     def test_case_1g(self):
         # vulnerability function with PMF
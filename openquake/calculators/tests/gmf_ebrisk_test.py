@@ -55,7 +55,7 @@ class GmfEbRiskTestCase(CalculatorTestCase):
         self.assertEqual(len(alt), 3)
         self.assertEqual(set(alt['rlzi']), set([0]))  # single rlzi
         totloss = alt['loss'].sum()
-        aae(totloss, 1.5788584)
+        aae(totloss, 1.6626971)
 
     @attr('qa', 'risk', 'event_based_risk')
     def test_case_3(self):
@@ -80,7 +80,7 @@ class GmfEbRiskTestCase(CalculatorTestCase):
         self.assertEqual(len(alt), 20)
         self.assertEqual(set(alt['rlzi']), set([0]))  # single rlzi
         totloss = alt['loss'].sum()
-        aae(totloss, 20210.27, decimal=2)
+        aae(totloss, 20210.35, decimal=2)
 
     @attr('qa', 'risk', 'event_based_risk')
     def test_case_4(self):
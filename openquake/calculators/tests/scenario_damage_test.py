@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import unittest
 import numpy
 from nose.plugins.attrib import attr
 
@@ -26,6 +27,7 @@ from openquake.qa_tests_data.scenario_damage import (
     case_1, case_1c, case_1h, case_2, case_3, case_4, case_4b, case_5, case_5a,
     case_6, case_7)
 from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
+from openquake.calculators.scenario_damage import _get_gmvs, F32
 from openquake.calculators.extract import extract
 from openquake.calculators.export import export
 from openquake.calculators.views import view
@@ -151,3 +153,15 @@ RM       4,000
         # just run the npz export
         [npz] = export(('dmg_by_asset', 'npz'), self.calc.datastore)
         self.assertEqual(strip_calc_id(npz), 'dmg_by_asset.npz')
+
+
+class GetGmvsTestCase(unittest.TestCase):
+    def test_missing_events(self):
+        # site 1 has only 2 of the 3 events, in reverse order, since the
+        # GMFs below the minimum_intensity are not stored
+        dt = numpy.dtype([('eid', numpy.uint64), ('gmv', (F32, (2,)))])
+        haz0 = numpy.array([(0, [.1, .2]), (1, [.3, .4]), (2, [.5, .6])], dt)
+        haz1 = numpy.array([(2, [.7, .8]), (0, [.9, 1.])], dt)
+        hazard = {0: {0: haz0}, 1: {0: haz1}, 2: {0: 0}}
+        gmvs = _get_gmvs(hazard, [0, 1, 2], 0, 1, numpy.arange(3))
+        aae(gmvs, [[.2, .4, .6], [1., 0, .8], [0, 0, 0]])
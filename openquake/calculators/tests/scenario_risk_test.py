@@ -178,7 +178,8 @@ class ScenarioRiskTestCase(CalculatorTestCase):
     @attr('qa', 'risk', 'scenario_risk')
     def test_case_master(self):
         # a case with two GSIMs
-        self.run_calc(case_master.__file__, 'job.ini', exports='npz')
+        self.run_calc(case_master.__file__, 'job.ini', exports='npz',
+                      aggregate_by='taxonomy state')
 
         # check realizations
         [fname] = export(('realizations', 'csv'), self.calc.datastore)
@@ -198,6 +199,18 @@ class ScenarioRiskTestCase(CalculatorTestCase):
         self.assertEqual(obj.tags, [b'state=01'])
         aac(obj.array, [[1316.3723145, 1569.1348877]])
 
+        # check the losses aggregated by taxonomy and state in the tasks
+        table = self.calc.datastore['agg_loss_table'].value
+        T, S = self.calc.datastore.get_attr('agg_loss_table', 'shape')
+        E = self.calc.oqparam.number_of_ground_motion_fields
+        li = self.calc.oqparam.lti['structural']
+        by_taxo = numpy.zeros((T, 2))  # 2 realizations
+        numpy.add.at(by_taxo, (table['agg_id'] // S, table['rlzi']),
+                     table['loss'][:, li] / E)
+        self.assertEqual(by_taxo[0].sum(), 0)  # the taxonomy 0 is '?'
+        mean = self.calc.datastore['agglosses-rlzs'][:, li]['mean']
+        aac(by_taxo.sum(axis=0), mean, rtol=1E-5)
+
     @attr('qa', 'risk', 'scenario_risk')
     def test_case_7(self):
         # check independence from concurrent_tasks
@@ -159,6 +159,7 @@ class UcerfPSHACalculator(PSHACalculator):
         monitor.oqparam = oq = self.oqparam
         self.src_filter = SourceFilter(self.sitecol, oq.maximum_distance)
         self.nsites = []
+        self.collapsing_error = 0
         acc = AccumDict({
             grp_id: ProbabilityMap(len(oq.imtls.array), len(gsims))
             for grp_id, gsims in self.gsims_by_grp.items()})
@@ -855,7 +855,9 @@ class UCERFRiskCalculator(EbrCalculator):
     """
     Event based risk calculator for UCERF, parallelizing on the source models
     """
-    pre_execute = UCERFRuptureCalculator.__dict__['pre_execute']
+    def pre_execute(self):
+        UCERFRuptureCalculator.__dict__['pre_execute'](self)
+        self.init_loss_params()
 
     def gen_args(self):
         """
@@ -882,7 +884,10 @@ class UCERFRiskCalculator(EbrCalculator):
                              ses_ratio=oq.ses_ratio,
                              avg_losses=oq.avg_losses,
                              elt_dt=elt_dt,
-                             asset_loss_table=False,
+                             asset_loss_table=self.save_loss_ratios,
+                             top_losses=self.num_top,
+                             aggregate_by=oq.aggregate_by,
+                             agg_shape=self.agg_shape,
                              insured_losses=oq.insured_losses)
                 yield (ssm, self.csm.src_filter, param,
                        self.riskmodel, imts, oq.truncation_level,
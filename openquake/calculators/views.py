@@ -34,6 +34,7 @@ from openquake.baselib.general import group_array
 from openquake.hazardlib import valid
 from openquake.hazardlib.gsim.base import ContextMaker
 from openquake.commonlib import util, source, calc
+from openquake.risklib.riskinput import group_by_taxonomy
 from openquake.commonlib.writers import (
     build_header, scientificformat, FIVEDIGITS)
 from openquake.calculators import getters
@@ -536,8 +537,7 @@ def view_assets_by_site(token, dstore):
     data = ['taxonomy mean stddev min max num_sites num_assets'.split()]
     num_assets = AccumDict()
     for assets in assets_by_site:
-        num_assets += {k: [len(v)] for k, v in groupby(
-            assets, operator.attrgetter('taxonomy')).items()}
+        num_assets += {k: [len(v)] for k, v in group_by_taxonomy(assets)}
     for taxo in sorted(num_assets):
         val = numpy.array(num_assets[taxo])
         data.append(stats(taxonomies[taxo], val, val.sum()))
@@ -212,13 +212,9 @@ def make_hmap(pmap, imtls, poes):
     if len(pmap) == 0:
         return hmap  # empty hazard map
     for i, imt in enumerate(imtls):
-        curves = numpy.array([pmap[sid].array[imtls.slicedic[imt], 0]
-                              for sid in pmap.sids])
+        curves = pmap.array[:, imtls.slicedic[imt], 0]
         data = compute_hazard_maps(curves, imtls[imt], poes)  # array N x P
-        for sid, value in zip(pmap.sids, data):
-            array = hmap[sid].array
-            for j, val in enumerate(value):
-                array[i * P + j] = val
+        hmap.array[:, i * P: (i + 1) * P, 0] = data
     return hmap
 
 
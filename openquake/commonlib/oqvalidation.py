@@ -43,6 +43,7 @@ class OqParam(valid.ParamSet):
         z1pt0='reference_depth_to_1pt0km_per_sec',
         z2pt5='reference_depth_to_2pt5km_per_sec',
         backarc='reference_backarc')
+    aggregate_by = valid.Param(valid.namelist, [])
     asset_loss_table = valid.Param(valid.boolean, False)
     area_source_discretization = valid.Param(
         valid.NoneOr(valid.positivefloat), None)
@@ -63,6 +64,7 @@ class OqParam(valid.ParamSet):
     disagg_by_src = valid.Param(valid.boolean, False)
     disagg_outputs = valid.Param(valid.disagg_outputs, None)
     distance_bin_width = valid.Param(valid.positivefloat)
+    distance_cache_size = valid.Param(valid.positiveint, 0)  # MB
     mag_bin_width = valid.Param(valid.positivefloat)
     export_dir = valid.Param(valid.utf8, '.')
     export_multi_curves = valid.Param(valid.boolean, False)
@@ -104,6 +106,7 @@ class OqParam(valid.ParamSet):
     number_of_logic_tree_samples = valid.Param(valid.positiveint, 0)
     num_epsilon_bins = valid.Param(valid.positiveint)
     poes = valid.Param(valid.probabilities, [])
+    pointsource_distance = valid.Param(valid.positivefloat, None)  # km
     poes_disagg = valid.Param(valid.probabilities, [])
     quantile_hazard_curves = valid.Param(valid.probabilities, [])
     quantile_loss_curves = valid.Param(valid.probabilities, [])
@@ -260,10 +263,14 @@ class OqParam(valid.ParamSet):
             raise ValueError('asset_correlation != {0, 1} is no longer'
                              ' supported')
         elif (self.calculation_mode == 'event_based_risk' and
-              self.conditional_loss_poes and not self.asset_loss_table):
+              self.conditional_loss_poes and not self.asset_loss_table and
+              not self.return_periods):
+            # with explicit return_periods the loss maps are built from
+            # the largest losses kept in memory, see EbrCalculator
             raise InvalidFile(
                 '%s: asset_loss_table is not set, probably you want to remove'
-                ' conditional_loss_poes' % job_ini)
+                ' conditional_loss_poes or to set the return_periods'
+                % job_ini)
 
         # check for GMFs from file
         if (self.inputs.get('gmfs', '').endswith('.csv') and not self.sites and
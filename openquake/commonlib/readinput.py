@@ -602,8 +602,8 @@ def get_cost_calculator(oqparam):
 
 def get_exposure(oqparam):
     """
-    Read the full exposure in memory and build a list of
-    :class:`openquake.risklib.asset.Asset` instances.
+    Read the full exposure in memory and build a composite array of
+    assets.
 
     :param oqparam:
         an :class:`openquake.commonlib.oqvalidation.OqParam` instance
@@ -663,8 +663,9 @@ def get_sitecol_assetcol(oqparam, haz_sitecol):
         sitecol = haz_sitecol
         assets_by_site = exposure.assets_by_site
 
-    asset_refs = [exposure.asset_refs[asset.ordinal]
-                  for assets in assets_by_site for asset in assets]
+    asset_refs = numpy.concatenate(
+        [exposure.asset_refs[assets['ordinal']]
+         for assets in assets_by_site if len(assets)])
     assetcol = asset.AssetCollection(
         asset_refs, assets_by_site, exposure.tagcol, exposure.cost_calculator,
         oqparam.time_event, exposure.occupancy_periods)
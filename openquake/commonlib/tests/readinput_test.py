@@ -28,7 +28,7 @@ import numpy
 from numpy.testing import assert_allclose
 
 from openquake.baselib import general
-from openquake.hazardlib import valid, InvalidFile
+from openquake.hazardlib import valid, nrml, InvalidFile
 from openquake.risklib import asset
 from openquake.risklib.riskinput import ValidationError
 from openquake.commonlib import readinput, writers, oqvalidation
@@ -494,6 +494,46 @@ POLYGON((78.0 31.5, 89.5 31.5, 89.5 25.5, 78.0 25.5, 78.0 31.5))'''
         self.assertIn("'RM ' contains whitespace chars, line 11",
                       str(ctx.exception))
 
+    def test_csv_exposure(self):
+        dirname = tempfile.mkdtemp()
+        fname = os.path.join(dirname, 'exposure.xml')
+        with open(fname, 'w') as f:
+            f.write('''\
+<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns="http://openquake.org/xmlns/nrml/0.4">
+  <exposureModel id="ep" category="buildings">
+    <description>Exposure model for buildings</description>
+    <conversions>
+      <costTypes>
+        <costType name="structural" unit="USD" type="per_asset"/>
+      </costTypes>
+    </conversions>
+    <assets>expo.csv</assets>
+  </exposureModel>
+</nrml>''')
+        csvname = os.path.join(dirname, 'expo.csv')
+        with open(csvname, 'w') as f:
+            f.write('id,number,taxonomy,lon,lat,structural\n'
+                    'a1,3000,RM,81.2985,29.1098,1000\n'
+                    'a2,1,RC,83.082298,27.9006,500\n'
+                    'a3,2000,W,85.747703,27.9015,1000\n')
+        # read the CSV file in chunks of 2 assets
+        with mock.patch.object(asset.Exposure, 'csv_chunksize', 2):
+            exp = asset.Exposure.read(fname)
+        self.assertEqual(list(exp.asset_refs), [b'a1', b'a2', b'a3'])
+        assert_allclose(exp.assets['number'], [3000, 1, 2000])
+        assert_allclose(exp.assets['value-structural'], [1000, 500, 1000])
+        self.assertEqual(list(exp.assets['taxonomy']), [1, 2, 3])
+        self.assertEqual(exp.tagcol.taxonomy, ['?', 'RM', 'RC', 'W'])
+
+        # duplicated asset IDs are not accepted
+        with open(csvname, 'a') as f:
+            f.write('a2,1,RC,83.082298,27.9006,500\n')
+        with self.assertRaises(nrml.DuplicatedID) as ctx:
+            asset.Exposure.read(fname)
+        self.assertIn('a2', str(ctx.exception))
+        shutil.rmtree(dirname)
+
 
 class ReadCsvTestCase(unittest.TestCase):
     def test_get_mesh_csvdata_ok(self):
@@ -31,9 +31,14 @@ from openquake.baselib.parallel import Starmap
 from openquake.baselib.general import gettemp, groupby
 from openquake.baselib.python3compat import raise_
 from openquake.hazardlib.geo.utils import (
-    KM_TO_DEGREES, angular_distance, within, fix_lon, get_bounding_box)
+    KM_TO_DEGREES, EARTH_RADIUS, angular_distance, within, fix_lon,
+    get_bounding_box, spherical_to_cartesian)
 
 MAX_DISTANCE = 2000  # km, ultra big distance used if there is no filter
+# relative tolerance used when preselecting the sites with the KD-tree,
+# to stay on the safe side with respect to the approximations in the
+# computation of the distances (projections, great circle arcs, etc)
+KDTREE_TOLERANCE = .01
 src_group_id = operator.attrgetter('src_group_id')
 
 
@@ -188,6 +193,51 @@ class IntegrationDistance(collections.Mapping):
         return repr(self.dic)
 
 
+def preselect(sites, rupture, maxdist, filter_distance='rrup'):
+    """
+    Use the KD-tree of the complete site collection to discard the sites
+    that are certainly farther than the maximum distance from the rupture,
+    without computing the distances. The bounding sphere of the projection
+    of the rupture mesh on the surface is enlarged by `maxdist` and only
+    the sites inside it are kept.
+
+    :param sites: a (filtered) site collection
+    :param rupture: a rupture object
+    :param maxdist: the maximum distance in km
+    :param filter_distance: 'rrup' or 'rjb'
+    :returns:
+        a sorted array with the indices of the candidate sites in the
+        collection, or None if all the sites are candidates
+    """
+    mesh = rupture.surface.mesh
+    xyz = spherical_to_cartesian(mesh.lons.flatten(), mesh.lats.flatten())
+    factor = 1 + KDTREE_TOLERANCE
+    if filter_distance == 'rrup' and mesh.depths is not None:
+        # the distance between points below the surface can be shorter
+        # than the distance between their projections on the surface
+        factor *= EARTH_RADIUS / numpy.sqrt(
+            (EARTH_RADIUS - mesh.depths.max()) *
+            (EARTH_RADIUS - sites.complete.max_depth))
+    elif filter_distance not in ('rrup', 'rjb'):
+        raise ValueError('Cannot preselect by %r' % filter_distance)
+    center = xyz.mean(axis=0)
+    radius = numpy.sqrt(((xyz - center) ** 2).sum(axis=1)).max()
+    radius = (radius + maxdist) * factor + 1
+    kdtree = sites.complete.kdtree
+    far = numpy.maximum(center - kdtree.mins, kdtree.maxes - center)
+    if numpy.sqrt((far ** 2).sum()) <= radius:  # all the sites are close
+        return
+    sids = kdtree.query_ball_point(center, radius)
+    sids = numpy.sort(numpy.fromiter(sids, numpy.uint32, len(sids)))
+    if sites is sites.complete:
+        return sids
+    # keep only the candidates which are in the input collection
+    idx = numpy.searchsorted(sites.sids, sids)
+    ok = idx < len(sites)
+    ok[ok] = sites.sids[idx[ok]] == sids[ok]
+    return idx[ok]
+
+
 def prefilter(srcs, srcfilter, monitor):
     """
     :returns: a dict src_group_id -> sources
@@ -209,7 +259,10 @@ class SourceFilter(object):
         if sitecol is not None and len(sitecol) < len(sitecol.complete):
             raise ValueError('%s is not complete!' % sitecol)
         self.hdf5path = hdf5path
-        if hdf5path and (
+        if sitecol is not None and 'shared' in vars(sitecol):
+            # keep the sitecol in memory, it is pickled as a handle
+            self.__dict__['sitecol'] = sitecol
+        elif hdf5path and (
                 config.distribution.oq_distribute in ('no', 'processpool') or
                 config.directory.shared_dir):  # store the sitecol
             with hdf5.File(hdf5path, 'w') as h5:
@@ -21,7 +21,7 @@ Module :mod:`~openquake.hazardlib.calc.gmf` exports
 :func:`ground_motion_fields`.
 """
 import numpy
-import scipy.stats
+from scipy.special import ndtr, ndtri
 
 from openquake.hazardlib.const import StdDev
 from openquake.hazardlib.gsim.base import ContextMaker
@@ -106,33 +106,52 @@ class GmfComputer(object):
         """
         :param gsim: a GSIM instance
         :param num_events: the number of seismic events
-        :param seed: a random seed or None
+        :param seed:
+            a random seed or None; if None the seed of the rupture is used,
+            if any, otherwise a seed is drawn from the global numpy.random
+            state
         :returns: a 32 bit array of shape (num_imts, num_sites, num_events)
         """
         try:  # read the seed from self.rupture.rupture if possible
             seed = seed or self.rupture.rupture.seed
         except AttributeError:
             pass
-        if seed is not None:
-            numpy.random.seed(seed)
-        result = numpy.zeros(
-            (len(self.imts), len(self.sids), num_events), numpy.float32)
+        if seed is None:
+            # the seed is derived from the global numpy.random state, so that
+            # the results can still be reproduced with numpy.random.seed
+            seed = numpy.random.randint(2 ** 31)
+        # each rupture has its own random stream, so that the GMFs do not
+        # depend on the order in which the ruptures are processed
+        rng = numpy.random.RandomState(seed)
+        num_imts = len(self.imts)
+        num_sites = len(self.sids)
+        stddev_types = gsim.DEFINED_FOR_STANDARD_DEVIATION_TYPES
+        if self.truncation_level == 0:
+            size = 0
+        elif stddev_types == set([StdDev.TOTAL]):
+            size = num_sites * num_events  # total residuals only
+        else:
+            size = (num_sites + 1) * num_events  # intra and inter residuals
+        # draw the deviates for all the IMTs at once, in the same order
+        # as they would be drawn IMT by IMT
+        eps = sample_eps(rng, self.truncation_level, num_imts * size)
+        result = numpy.zeros((num_imts, num_sites, num_events), numpy.float32)
         for imti, imt in enumerate(self.imts):
-            result[imti] = self._compute(None, gsim, num_events, imt)
+            result[imti] = self._compute(
+                eps[imti * size: (imti + 1) * size], gsim, num_events, imt)
         return result
 
-    def _compute(self, seed, gsim, num_events, imt):
+    def _compute(self, eps, gsim, num_events, imt):
         """
-        :param seed: a random seed or None if the seed is already set
+        :param eps: an array of standard deviates, possibly truncated
         :param gsim: a GSIM instance
         :param num_events: the number of seismic events
         :param imt: an IMT instance
         :returns: a 32 bit array of shape (num_sites, num_events)
         """
         rctx = getattr(self.rupture, 'rupture', self.rupture)
-        if seed is not None:
-            numpy.random.seed(seed)
         dctx = self.dctx.roundup(gsim.minimum_distance)
+        num_sites = len(self.sids)
         if self.truncation_level == 0:
             assert self.correlation_model is None
             mean, _stddevs = gsim.get_mean_and_stddevs(
@@ -141,12 +160,7 @@ class GmfComputer(object):
             mean.shape += (1, )
             mean = mean.repeat(num_events, axis=1)
             return mean
-        elif self.truncation_level is None:
-            distribution = scipy.stats.norm()
-        else:
-            assert self.truncation_level > 0
-            distribution = scipy.stats.truncnorm(
-                - self.truncation_level, self.truncation_level)
+        assert self.truncation_level is None or self.truncation_level > 0
 
         if gsim.DEFINED_FOR_STANDARD_DEVIATION_TYPES == \
            set([StdDev.TOTAL]):
@@ -163,8 +177,8 @@ class GmfComputer(object):
             stddev_total = stddev_total.reshape(stddev_total.shape + (1, ))
             mean = mean.reshape(mean.shape + (1, ))
 
-            total_residual = stddev_total * distribution.rvs(
-                size=(len(self.sids), num_events))
+            total_residual = stddev_total * eps.reshape(
+                num_sites, num_events)
             gmf = gsim.to_imt_unit_values(mean + total_residual)
         else:
             mean, [stddev_inter, stddev_intra] = gsim.get_mean_and_stddevs(
@@ -173,8 +187,8 @@ class GmfComputer(object):
             stddev_intra = stddev_intra.reshape(stddev_intra.shape + (1, ))
             stddev_inter = stddev_inter.reshape(stddev_inter.shape + (1, ))
             mean = mean.reshape(mean.shape + (1, ))
-            intra_residual = stddev_intra * distribution.rvs(
-                size=(len(self.sids), num_events))
+            intra_residual = stddev_intra * eps[:-num_events].reshape(
+                num_sites, num_events)
 
             if self.correlation_model is not None:
                 ir = self.correlation_model.apply_correlation(
@@ -185,14 +199,39 @@ class GmfComputer(object):
                 for i, val in numpy.ndenumerate(ir):
                     intra_residual[i] = val
 
-            inter_residual = stddev_inter * distribution.rvs(
-                size=num_events)
+            inter_residual = stddev_inter * eps[-num_events:]
 
             gmf = gsim.to_imt_unit_values(
                 mean + intra_residual + inter_residual)
         return gmf
 
 
+def sample_eps(rng, truncation_level, size):
+    """
+    Draw standard normal deviates, truncated at +-truncation_level if
+    the truncation level is not None. The truncated deviates are obtained
+    by inverting the CDF, exactly as `scipy.stats.truncnorm.rvs` does, but
+    without the overhead of the scipy distribution machinery:
+
+    >>> from scipy.stats import truncnorm
+    >>> eps = sample_eps(numpy.random.RandomState(42), 3, 5)
+    >>> rvs = truncnorm(-3, 3).rvs(5, random_state=42)
+    >>> bool((eps == rvs).all())
+    True
+
+    :param rng: a :class:`numpy.random.RandomState` instance
+    :param truncation_level: a positive float or None
+    :param size: the number of deviates to draw
+    :returns: an array of `size` floats
+    """
+    if truncation_level is None:
+        return rng.standard_normal(size)
+    phi_a = ndtr(-truncation_level)
+    phi_b = ndtr(truncation_level)
+    q = rng.random_sample(size)
+    return ndtri(q * phi_b + phi_a * (1. - q))
+
+
 # this is not used in the engine; it is still useful for usage in IPython
 # when demonstrating hazardlib capabilities
 def ground_motion_fields(rupture, sites, imts, gsim, truncation_level,
@@ -206,7 +245,8 @@ def ground_motion_fields(rupture, sites, imts, gsim, truncation_level,
     .. note::
 
      This calculator is using random numbers. In order to reproduce the
-     same results numpy random numbers generator needs to be seeded, see
+     same results a seed must be passed or the numpy random numbers
+     generator needs to be seeded, see
      http://docs.scipy.org/doc/numpy/reference/generated/numpy.random.seed.html
 
     :param openquake.hazardlib.source.rupture.Rupture rupture:
@@ -231,7 +271,9 @@ def ground_motion_fields(rupture, sites, imts, gsim, truncation_level,
         non-correlated ground motion fields are calculated. Correlation model
         is not used if ``truncation_level`` is zero.
     :param int seed:
-        The seed used in the numpy random number generator
+        The seed used to build the :class:`numpy.random.RandomState`
+        generating the residuals; if None, it is drawn from the global
+        numpy random state
     :returns:
         Dictionary mapping intensity measure type objects (same
         as in parameter ``imts``) to 2d numpy arrays of floats,
@@ -62,6 +62,7 @@ from openquake.baselib.parallel import sequential_apply
 from openquake.baselib.general import DictArray, groupby, AccumDict
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib.gsim.base import ContextMaker
+from openquake.hazardlib.contexts import DistanceCache
 from openquake.hazardlib.calc.filters import SourceFilter
 from openquake.hazardlib.sourceconverter import SourceGroup
 
@@ -75,7 +76,7 @@ def classical(group, src_filter, gsims, param, monitor=Monitor()):
 
     :returns:
         a dictionary {grp_id: pmap} with attributes .grp_ids, .calc_times,
-        .eff_ruptures
+        .eff_ruptures, .collapsing_error
     """
     if getattr(group, 'src_interdep', None) == 'mutex':
         mutex_weight = {src.source_id: weight for src, weight in
@@ -88,13 +89,27 @@ def classical(group, src_filter, gsims, param, monitor=Monitor()):
     maxdist = src_filter.integration_distance
     imtls = param['imtls']
     trunclevel = param.get('truncation_level')
-    cmaker = ContextMaker(gsims, maxdist, param['filter_distance'], monitor)
+    cache_size = param.get('distance_cache_size')  # in MB
+    # the distance cache lives only for the duration of the task
+    cmaker = ContextMaker(
+        gsims, maxdist, param['filter_distance'], monitor,
+        param.get('pointsource_distance'),
+        DistanceCache(cache_size * 1024 ** 2) if cache_size else None)
     pmap = AccumDict({grp_id: ProbabilityMap(len(imtls.array), len(gsims))
                       for grp_id in grp_ids})
     # AccumDict of arrays with 4 elements weight, nsites, calc_time, split
     pmap.calc_times = AccumDict(accum=numpy.zeros(4))
     pmap.eff_ruptures = AccumDict()  # grp_id -> num_ruptures
+    # maximum PoE deviation due to the collapsing of the point sources,
+    # measured on the first point source of the task
+    pmap.collapsing_error = 0
+    check_collapsing = cmaker.pointsource_distance and not mutex_weight
     for src, s_sites in src_filter(group):  # filter now
+        if check_collapsing and hasattr(src, 'get_collapsed_source'):
+            with monitor('measuring collapsing error', measuremem=False):
+                pmap.collapsing_error = cmaker.get_collapsing_error(
+                    src, s_sites, imtls, trunclevel).max()
+            check_collapsing = False
         t0 = time.time()
         indep = group.rup_interdep == 'indep' if mutex_weight else True
         poemap = cmaker.poe_map(src, s_sites, imtls, trunclevel, indep)
@@ -114,6 +129,11 @@ def classical(group, src_filter, gsims, param, monitor=Monitor()):
                               for grp_id in src.src_group_ids}
     if mutex_weight and group.grp_probability is not None:
         pmap[group.id] *= group.grp_probability
+    if cmaker.distance_cache is not None:
+        # the misses are already measured by cmaker.miss_mon; the hits
+        # take no time, so they are reported only as counts
+        hit_mon = monitor('distance cache hits', measuremem=False)
+        hit_mon.counts = cmaker.distance_cache.hits
     return pmap
 
 
@@ -18,13 +18,29 @@
 
 import abc
 import sys
+import hashlib
+import collections
 import numpy
 
 from openquake.baselib.general import AccumDict
 from openquake.baselib.performance import Monitor
 from openquake.baselib.python3compat import raise_
-from openquake.hazardlib import imt as imt_module
 from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.hazardlib.geo import geodetic
+from openquake.hazardlib.geo.mesh import Mesh
+from openquake.hazardlib.geo.surface.planar import get_translated_distances
+from openquake.hazardlib.calc.filters import preselect
+
+# below this number of sites the distances are computed directly, without
+# preselecting the sites close to the rupture with the KD-tree
+KDTREE_MIN_SITES = 100
+
+# distances that can be computed for all the translations of a planar
+# rupture at once, see :meth:`ContextMaker.templated_poe_map`
+TEMPLATED_DISTANCES = {'rrup', 'rjb', 'rx', 'ry0', 'rhypo', 'repi', 'rvolc'}
+
+# maximum number of (translation, site) distances computed at once
+MAX_TEMPLATED_DISTANCES = 10 ** 5
 
 
 def get_distances(rupture, mesh, param):
@@ -58,6 +74,128 @@ def get_distances(rupture, mesh, param):
     return dist
 
 
+def get_templated_distances(rupture, lons, lats, mesh, param):
+    """
+    :param rupture: a reference rupture with a planar surface
+    :param lons: P longitudes of the epicenters of the translated ruptures
+    :param lats: P latitudes of the epicenters of the translated ruptures
+    :param mesh: a mesh of N points or a site collection
+    :param param: the kind of distance to compute
+    :returns: an array of distances of shape (P, N)
+    """
+    hypo = rupture.hypocenter
+    if param in ('rrup', 'rjb', 'rx', 'ry0'):
+        return get_translated_distances(
+            rupture.surface, hypo.longitude, hypo.latitude, lons, lats,
+            mesh, param)
+    elif param == 'rhypo':
+        depths = numpy.zeros_like(mesh.lons) if mesh.depths is None \
+            else mesh.depths
+        return geodetic.distance(lons[:, None], lats[:, None], hypo.depth,
+                                 mesh.lons, mesh.lats, depths)
+    elif param == 'repi':
+        return geodetic.geodetic_distance(
+            lons[:, None], lats[:, None], mesh.lons, mesh.lats)
+    elif param == 'rvolc':
+        # Volcanic distance not yet supported, defaulting to zero
+        return numpy.zeros((len(lons), len(mesh.lons)))
+    raise ValueError('Unknown distance measure %r' % param)
+
+
+def _get_dense(pmap, sids, shape):
+    # convert a (possibly empty) probability map into an array of PoEs
+    array = numpy.zeros((len(sids),) + shape)
+    if pmap:
+        ok = numpy.isin(sids, pmap.sids)
+        array[ok] = pmap.array[pmap.get_indices(sids[ok])]
+    return array
+
+
+class DistanceCache(object):
+    """
+    A cache of distance arrays with LRU eviction and bounded size in bytes.
+    The keys are built from the geometry of the rupture surface, the
+    hypocenter, the site IDs and the kind of distance, so that identical
+    ruptures do not recompute the same distances. Since the keys contain
+    the site IDs and not the coordinates, a cache must be used with a
+    single site collection, i.e. it must belong to a task and not be
+    shared across calculations. As a consequence, identical ruptures in
+    different branches of the logic tree hit the cache only when they are
+    computed in the same task. The hits are reported to the monitor as
+    "distance cache hits" at the end of the task.
+
+    :param maxbytes: the maximum size of the cached arrays in bytes
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.arrays = collections.OrderedDict()
+
+    def get_key(self, rupture, sids, param):
+        """
+        :param rupture: a rupture
+        :param sids: the IDs of the sites
+        :param param: the kind of distance
+        :returns: a key for the distance array
+        """
+        surface = rupture.surface
+        hypo = rupture.hypocenter
+        # hashing the site IDs is much faster than hashing the coordinates
+        sids_key = hashlib.md5(
+            numpy.ascontiguousarray(sids, numpy.uint32).tobytes()).hexdigest()
+        return (_get_mesh_key(surface.mesh), len(sids), sids_key,
+                param, type(surface).__name__,
+                getattr(surface, 'strike', None),
+                (hypo.longitude, hypo.latitude, hypo.depth))
+
+    def get(self, key):
+        """
+        :param key: a key returned by :meth:`get_key`
+        :returns: a copy of the cached array or None
+        """
+        try:
+            array = self.arrays[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.arrays.move_to_end(key)
+        return array.copy()
+
+    def add(self, key, array):
+        """
+        Store a copy of the array, discarding the least recently used
+        arrays if the cache is full.
+        """
+        if array.nbytes > self.maxbytes or key in self.arrays:
+            return
+        self.arrays[key] = array.copy()
+        self.nbytes += array.nbytes
+        while self.nbytes > self.maxbytes:  # discard the least recent
+            _, old = self.arrays.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __repr__(self):
+        return '<%s %d arrays, %d bytes, hits=%d, misses=%d>' % (
+            self.__class__.__name__, len(self), self.nbytes,
+            self.hits, self.misses)
+
+
+def _get_mesh_key(mesh):
+    # a digest of the coordinates of a mesh of points
+    md5 = hashlib.md5()
+    md5.update(numpy.ascontiguousarray(mesh.lons, float).tobytes())
+    md5.update(numpy.ascontiguousarray(mesh.lats, float).tobytes())
+    if mesh.depths is not None:
+        md5.update(numpy.ascontiguousarray(mesh.depths, float).tobytes())
+    return mesh.lons.shape, md5.hexdigest()
+
+
 class FarAwayRupture(Exception):
     """Raised if the rupture is outside the maximum distance for all sites"""
 
@@ -69,9 +207,15 @@ class ContextMaker(object):
     REQUIRES = ['DISTANCES', 'SITES_PARAMETERS', 'RUPTURE_PARAMETERS']
 
     def __init__(self, gsims, maximum_distance=None, filter_distance=None,
-                 monitor=Monitor()):
+                 monitor=Monitor(), pointsource_distance=None,
+                 distance_cache=None):
         self.gsims = gsims
         self.maximum_distance = maximum_distance or {}
+        # an optional DistanceCache used by :meth:`get_distances`
+        self.distance_cache = distance_cache
+        # beyond this epicentral distance the ruptures of point sources
+        # are collapsed, see :meth:`collapsed_poe_map`
+        self.pointsource_distance = pointsource_distance
         for req in self.REQUIRES:
             reqset = set()
             for gsim in gsims:
@@ -93,9 +237,36 @@ class ContextMaker(object):
             for gsim, rlzis in gsims.items():
                 for rlzi in rlzis:
                     self.gsim_by_rlzi[rlzi] = gsim
+        # the ruptures of area and point sources can be managed as
+        # translations of reference ruptures if the GSIMs do not need
+        # parameters depending on the position of the hypocenter
+        self.templated = (
+            self.REQUIRES_DISTANCES <= TEMPLATED_DISTANCES and not
+            self.REQUIRES_RUPTURE_PARAMETERS & {'hypo_lon', 'hypo_lat'})
         self.ir_mon = monitor('iter_ruptures', measuremem=False)
         self.ctx_mon = monitor('make_contexts', measuremem=False)
         self.poe_mon = monitor('get_poes', measuremem=False)
+        self.miss_mon = monitor('distance cache misses', measuremem=False)
+
+    def get_distances(self, rupture, mesh, param, sids):
+        """
+        :param rupture: a rupture
+        :param mesh: a mesh of points or a site collection
+        :param param: the kind of distance to compute
+        :param sids: the IDs of the sites in the mesh
+        :returns: an array of distances, possibly coming from the cache
+        """
+        cache = self.distance_cache
+        if cache is None:
+            return get_distances(rupture, mesh, param)
+        key = cache.get_key(rupture, sids, param)
+        dists = cache.get(key)
+        if dists is not None:  # the hits are counted by the cache
+            return dists
+        with self.miss_mon:
+            dists = get_distances(rupture, mesh, param)
+        cache.add(key, dists)
+        return dists
 
     def filter(self, sites, rupture):
         """
@@ -109,14 +280,32 @@ class ContextMaker(object):
         :returns:
             (filtered sites, distance context)
         """
-        distances = get_distances(rupture, sites, self.filter_distance)
-        if self.maximum_distance:
-            mask = distances <= self.maximum_distance(
-                rupture.tectonic_region_type, rupture.mag)
-            if mask.any():
-                sites, distances = sites.filter(mask), distances[mask]
-            else:
+        if not self.maximum_distance:
+            distances = self.get_distances(
+                rupture, sites, self.filter_distance, sites.sids)
+            return sites, DistancesContext([(self.filter_distance, distances)])
+        maxdist = self.maximum_distance(
+            rupture.tectonic_region_type, rupture.mag)
+        idx = None  # indices of the candidate sites, None for all sites
+        if (self.filter_distance in ('rrup', 'rjb') and
+                len(sites) >= KDTREE_MIN_SITES):
+            idx = preselect(sites, rupture, maxdist, self.filter_distance)
+            if idx is not None and len(idx) == 0:
                 raise FarAwayRupture(rupture.serial)
+        if idx is None:
+            mesh, sids = sites, sites.sids
+        else:  # compute the distances only for the candidate sites
+            mesh = Mesh(sites.lons[idx], sites.lats[idx], sites.depths[idx])
+            sids = sites.sids[idx]
+        distances = self.get_distances(
+            rupture, mesh, self.filter_distance, sids)
+        mask = distances <= maxdist
+        if not mask.any():
+            raise FarAwayRupture(rupture.serial)
+        elif idx is None:
+            sites, distances = sites.filter(mask), distances[mask]
+        else:
+            sites, distances = sites.filtered(idx[mask]), distances[mask]
         return sites, DistancesContext([(self.filter_distance, distances)])
 
     def add_rup_params(self, rupture):
@@ -168,13 +357,61 @@ class ContextMaker(object):
         """
         sites, dctx = self.filter(sites, rupture)
         for param in self.REQUIRES_DISTANCES - set([self.filter_distance]):
-            setattr(dctx, param, get_distances(rupture, sites, param))
+            setattr(dctx, param,
+                    self.get_distances(rupture, sites, param, sites.sids))
         self.add_rup_params(rupture)
         # NB: returning a SitesContext make sures that the GSIM cannot
         # access site parameters different from the ones declared
         sctx = SitesContext(sites, self.REQUIRES_SITES_PARAMETERS)
         return sctx, dctx
 
+    def get_rup_key(self, rupture):
+        """
+        :param rupture: a rupture with the .REQUIRES_RUPTURE_PARAMETERS set
+        :returns: a tuple with the values of the required rupture parameters
+        """
+        return tuple(getattr(rupture, param)
+                     for param in sorted(self.REQUIRES_RUPTURE_PARAMETERS))
+
+    def gen_rup_blocks(self, ruptures):
+        """
+        Group the ruptures in blocks with the same required rupture
+        parameters (i.e. same magnitude, rake, dip, etc); the GSIMs give the
+        same results if called on a block or rupture by rupture.
+
+        :param ruptures: a list of ruptures with attributes .sctx and .dctx
+        :yields: lists of ruptures
+        """
+        blocks = {}  # the ruptures will be yielded in order of first key
+        for rup in ruptures:
+            blocks.setdefault(self.get_rup_key(rup), []).append(rup)
+        return iter(blocks.values())
+
+    def make_block_contexts(self, ruptures):
+        """
+        Stack the contexts of a block of ruptures with the same required
+        rupture parameters, so that the GSIMs can be called once per block.
+
+        :param ruptures: a non-empty list of ruptures with .sctx and .dctx
+        :returns: (stacked SitesContext, RuptureContext, DistancesContext)
+        """
+        rup = ruptures[0]
+        rctx = RuptureContext()
+        for param in self.REQUIRES_RUPTURE_PARAMETERS:
+            setattr(rctx, param, getattr(rup, param))
+        if len(ruptures) == 1:
+            return rup.sctx, rctx, rup.dctx
+        sctx = SitesContext()
+        sctx.sids = numpy.concatenate([r.sctx.sids for r in ruptures])
+        for param in self.REQUIRES_SITES_PARAMETERS:
+            setattr(sctx, param, numpy.concatenate(
+                [getattr(r.sctx, param) for r in ruptures]))
+        dctx = DistancesContext(
+            (param, numpy.concatenate([getattr(r.dctx, param)
+                                       for r in ruptures]))
+            for param in self.REQUIRES_DISTANCES)
+        return sctx, rctx, dctx
+
     def make_pmap(self, ruptures, imtls, trunclevel, rup_indep):
         """
         :param src: a source object
@@ -184,18 +421,19 @@ class ContextMaker(object):
         :param rup_indep: True if the ruptures are independent
         :returns: a ProbabilityMap instance
         """
-        sids = set()
-        for rup in ruptures:
-            sids.update(rup.sctx.sids)
+        sids = numpy.unique(
+            numpy.concatenate([rup.sctx.sids for rup in ruptures]))
         pmap = ProbabilityMap.build(
             len(imtls.array), len(self.gsims), sids, initvalue=rup_indep)
-        for rup in ruptures:
-            pnes = self._make_pnes(rup, imtls, trunclevel)
-            for sid, pne in zip(rup.sctx.sids, pnes):
+        array = pmap.array
+        for block in self.gen_rup_blocks(ruptures):
+            for rup, pnes in zip(
+                    block, self._make_pnes(block, imtls, trunclevel)):
+                idx = pmap.get_indices(rup.sctx.sids)
                 if rup_indep:
-                    pmap[sid].array *= pne
+                    array[idx] *= pnes
                 else:
-                    pmap[sid].array += pne * rup.weight
+                    array[idx] += pnes * rup.weight
         tildemap = ~pmap
         tildemap.eff_ruptures = len(ruptures)
         return tildemap
@@ -209,6 +447,16 @@ class ContextMaker(object):
         :param rup_indep: True if the ruptures are independent
         :returns: a ProbabilityMap instance
         """
+        if (rup_indep and self.pointsource_distance and
+                hasattr(src, 'get_collapsed_source')):
+            return self.collapsed_poe_map(src, sites, imtls, trunclevel)
+        return self._poe_map(src, sites, imtls, trunclevel, rup_indep)
+
+    def _poe_map(self, src, sites, imtls, trunclevel, rup_indep):
+        # compute the probability map without collapsing the ruptures
+        if (rup_indep and self.templated and
+                hasattr(src, 'get_rupture_templates')):
+            return self.templated_poe_map(src, sites, imtls, trunclevel)
         with self.ir_mon:
             all_ruptures = list(src.iter_ruptures())
         # all_ruptures can be empty only in UCERF
@@ -233,20 +481,158 @@ class ContextMaker(object):
             raise_(etype, msg, tb)
         return pmap
 
+    def collapsed_poe_map(self, src, sites, imtls, trunclevel):
+        """
+        Compute the probability map of a point source by using all of its
+        ruptures for the sites within the `pointsource_distance` from the
+        epicenter and the ruptures of the collapsed source (see
+        :meth:`openquake.hazardlib.source.point.PointSource.get_collapsed_source`)
+        for the sites farther away.
+
+        :param src: a source with a method .get_collapsed_source
+        :param sites: a filtered SiteCollection
+        :param imtls: intensity measure and levels
+        :param trunclevel: truncation level
+        :returns: a ProbabilityMap instance
+        """
+        dists = src.location.distance_to_mesh(sites, with_depths=False)
+        close = dists <= self.pointsource_distance
+        pmap = ProbabilityMap(len(imtls.array), len(self.gsims))
+        pmap.eff_ruptures = 0
+        with self.ir_mon:
+            collapsed = src.get_collapsed_source()
+        for mask, source in [(close, src), (~close, collapsed)]:
+            if not mask.any():
+                continue
+            pm = self._poe_map(
+                source, sites.filter(mask), imtls, trunclevel, True)
+            if pm:
+                pmap |= pm
+                pmap.eff_ruptures += pm.eff_ruptures
+        return pmap if pmap.eff_ruptures else {}
+
+    def get_collapsing_error(self, src, sites, imtls, trunclevel):
+        """
+        Measure the accuracy of :meth:`collapsed_poe_map` with respect to
+        the computation with all the ruptures of the source.
+
+        :param src: a source with a method .get_collapsed_source
+        :param sites: a filtered SiteCollection
+        :param imtls: intensity measure and levels
+        :param trunclevel: truncation level
+        :returns:
+            an array of shape N with the maximum absolute difference in
+            the PoEs for each site
+        """
+        shape = (len(imtls.array), len(self.gsims))
+        exact = _get_dense(
+            self._poe_map(src, sites, imtls, trunclevel, True),
+            sites.sids, shape)
+        approx = _get_dense(
+            self.collapsed_poe_map(src, sites, imtls, trunclevel),
+            sites.sids, shape)
+        return numpy.abs(exact - approx).max(axis=(1, 2))
+
+    def templated_poe_map(self, src, sites, imtls, trunclevel):
+        """
+        Compute the probability map of an area or point source with
+        independent ruptures. The ruptures are not instantiated: the
+        distances are computed for all the translations of each reference
+        rupture at once and the GSIMs are called once per reference rupture
+        on the stacked contexts.
+
+        :param src: a source with a method .get_rupture_templates
+        :param sites: a filtered SiteCollection
+        :param imtls: intensity measure and levels
+        :param trunclevel: truncation level
+        :returns: a ProbabilityMap instance
+        """
+        with self.ir_mon:
+            epicenters, ref_ruptures = src.get_rupture_templates()
+        lons, lats = epicenters.lons.flatten(), epicenters.lats.flatten()
+        N = len(sites)
+        pnes = numpy.ones((N, len(imtls.array), len(self.gsims)))
+        hit = numpy.zeros(N, bool)
+        eff_ruptures = 0
+        block_size = max(1, MAX_TEMPLATED_DISTANCES // N)
+        try:
+            for rup in ref_ruptures:
+                self.add_rup_params(rup)
+                rctx = RuptureContext()
+                for param in self.REQUIRES_RUPTURE_PARAMETERS:
+                    setattr(rctx, param, getattr(rup, param))
+                for start in range(0, len(lons), block_size):
+                    sl = slice(start, start + block_size)
+                    with self.ctx_mon:
+                        sctx, dctx, counts = self._make_templated_contexts(
+                            rup, lons[sl], lats[sl], sites)
+                    if not len(sctx.sids):
+                        continue
+                    with self.poe_mon:
+                        poes = numpy.zeros(
+                            (len(sctx.sids), len(imtls.array),
+                             len(self.gsims)))
+                        for i, gsim in enumerate(self.gsims):
+                            dc = dctx.roundup(gsim.minimum_distance)
+                            gsim.get_all_poes(sctx, rctx, dc, imtls,
+                                              trunclevel, poes[:, :, i])
+                        rup_pnes = rup.get_probability_no_exceedance(poes)
+                        stop = 0
+                        for count in counts[counts > 0]:
+                            start, stop = stop, stop + count
+                            pnes[sctx.idx[start:stop]] *= rup_pnes[start:stop]
+                    hit[sctx.idx] = True
+                    eff_ruptures += (counts > 0).sum()
+        except Exception as err:
+            etype, err, tb = sys.exc_info()
+            msg = '%s (source id=%s)' % (str(err), src.source_id)
+            raise_(etype, msg, tb)
+        if not eff_ruptures:
+            return {}
+        pmap = ProbabilityMap.from_array(pnes[hit], sites.sids[hit])
+        tildemap = ~pmap
+        tildemap.eff_ruptures = eff_ruptures
+        return tildemap
+
+    def _make_templated_contexts(self, rupture, lons, lats, sites):
+        # build the stacked contexts for the translations of the given
+        # rupture to the given epicenters; the sites are ordered by
+        # translation and the number of sites per translation is returned
+        dists = get_templated_distances(
+            rupture, lons, lats, sites, self.filter_distance)  # shape (P, N)
+        if self.maximum_distance:
+            maxdist = self.maximum_distance(
+                rupture.tectonic_region_type, rupture.mag)
+            mask = dists <= maxdist
+        else:
+            mask = numpy.ones(dists.shape, bool)
+        counts = mask.sum(axis=1)
+        idx = mask.nonzero()[1]
+        sctx = SitesContext()
+        sctx.idx = idx  # indices in the site collection
+        sctx.sids = sites.sids[idx]
+        for param in self.REQUIRES_SITES_PARAMETERS:
+            setattr(sctx, param, getattr(sites, param)[idx])
+        dctx = DistancesContext([(self.filter_distance, dists[mask])])
+        if len(idx):
+            for param in self.REQUIRES_DISTANCES - {self.filter_distance}:
+                setattr(dctx, param, get_templated_distances(
+                    rupture, lons, lats, sites, param)[mask])
+        return sctx, dctx, counts
+
     # NB: it is important for this to be fast since it is inside an inner loop
-    def _make_pnes(self, rupture, imtls, trunclevel):
-        pne_array = numpy.zeros(
-            (len(rupture.sctx.sids), len(imtls.array), len(self.gsims)))
+    def _make_pnes(self, ruptures, imtls, trunclevel):
+        # yield an array of shape (N, L, G) for each rupture in the block
+        sctx, rctx, dctx = self.make_block_contexts(ruptures)
+        poes = numpy.zeros((len(sctx.sids), len(imtls.array), len(self.gsims)))
         for i, gsim in enumerate(self.gsims):
-            dctx = rupture.dctx.roundup(gsim.minimum_distance)
-            pnos = []  # list of arrays nsites x nlevels
-            for imt in imtls:
-                poes = gsim.get_poes(
-                    rupture.sctx, rupture, dctx,
-                    imt_module.from_string(imt), imtls[imt], trunclevel)
-                pnos.append(rupture.get_probability_no_exceedance(poes))
-            pne_array[:, :, i] = numpy.concatenate(pnos, axis=1)
-        return pne_array
+            dc = dctx.roundup(gsim.minimum_distance)
+            gsim.get_all_poes(sctx, rctx, dc, imtls, trunclevel, poes[:, :, i])
+        start = 0
+        for rup in ruptures:
+            stop = start + len(rup.sctx.sids)
+            yield rup.get_probability_no_exceedance(poes[start:stop])
+            start = stop
 
     def disaggregate(self, sitecol, ruptures, iml4, truncnorm, epsilons,
                      monitor=Monitor()):
@@ -373,7 +759,7 @@ class DistancesContext(BaseContext):
         for dist, array in vars(self).items():
             small_distances = array < minimum_distance
             if small_distances.any():
-                array = array[:]  # make a copy first
+                array = array.copy()  # make a copy first
                 array[small_distances] = minimum_distance
             setattr(ctx, dist, array)
         return ctx
@@ -19,6 +19,12 @@ spatially-distributed ground-shaking intensities.
 """
 import abc
 import numpy
+from scipy.spatial import cKDTree
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
+
+from openquake.hazardlib.geo.geodetic import (
+    geodetic_distance, spherical_to_cartesian)
 
 
 class BaseCorrelationModel(metaclass=abc.ABCMeta):
@@ -102,9 +108,22 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         Boolean value to indicate whether "Case 1" or "Case 2" from page 1700
         should be applied. ``True`` value means that Vs 30 values show or are
         expected to show clustering ("Case 2"), ``False`` means otherwise.
+    :param tolerance:
+        If None (the default) the full correlation matrix is decomposed.
+        Otherwise the correlation matrix is never built: each site is
+        correlated only to the nearest preceding sites (at most
+        ``max_neighbours``) having a correlation coefficient larger than
+        ``tolerance``; the memory is then proportional to the number of
+        sites and not to its square.
+    :param max_neighbours:
+        Maximum number of neighbours used when ``tolerance`` is given
     """
-    def __init__(self, vs30_clustering):
+    block_size = 1000  # number of sites processed at once
+
+    def __init__(self, vs30_clustering, tolerance=None, max_neighbours=30):
         self.vs30_clustering = vs30_clustering
+        self.tolerance = tolerance
+        self.max_neighbours = max_neighbours
         self.cache = {}  # imt -> correlation model
 
     def _get_correlation_matrix(self, sites, imt):
@@ -116,6 +135,107 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         """
         return numpy.linalg.cholesky(self._get_correlation_matrix(sites, imt))
 
+    def get_nearest_neighbours_factor(self, sites, imt):
+        """
+        Build the nearest neighbours approximation of the correlation model
+        (also known as Vecchia approximation): the correlated residual of
+        the site `i` is the best linear predictor given the residuals of
+        the (at most `max_neighbours`) closest sites preceding `i` within
+        the correlation range, plus an independent term. This is exact if
+        all the preceding sites are within the range and are neighbours.
+
+        :param sites:
+            :class:`~openquake.hazardlib.site.SiteCollection` instance
+        :param imt:
+            Intensity measure type object
+        :returns:
+            a pair (LU factorization of the sparse matrix I - B, stddevs)
+            such that the correlated residuals are the solution of the
+            linear system (I - B) z = stddevs * eps
+        """
+        b = _jb_range(imt, self.vs30_clustering)
+        max_dist = -b * numpy.log(self.tolerance) / 3.  # correlation range
+        num_sites = len(sites)
+        k = min(self.max_neighbours, num_sites - 1)
+        # find the closest preceding sites by looking at the 2k+1 closest
+        # sites; the chord distance is smaller than the geodetic distance,
+        # so no site within the correlation range is lost
+        xyz = spherical_to_cartesian(sites.lons, sites.lats)
+        _, idxs = cKDTree(xyz).query(
+            xyz, 2 * k + 1, distance_upper_bound=max_dist)
+        idxs = idxs.reshape(num_sites, -1)  # in case of a single site
+        ok = idxs < numpy.arange(num_sites)[:, None]  # preceding sites
+        ok &= ok.cumsum(axis=1) <= k
+        rows, cols = ok.nonzero()
+        nbrs = numpy.zeros((num_sites, k), int)
+        valid = numpy.zeros((num_sites, k), bool)
+        pos = ok.cumsum(axis=1)[rows, cols] - 1
+        nbrs[rows, pos] = idxs[rows, cols]
+        valid[rows, pos] = True
+        coeffs = numpy.zeros((num_sites, k))
+        stddevs = numpy.ones(num_sites)
+        eye = numpy.eye(k)
+        lons, lats = sites.lons, sites.lats
+        for start in range(0, num_sites, self.block_size):
+            sl = slice(start, start + self.block_size)
+            nb, vd = nbrs[sl], valid[sl]
+            ci = numpy.exp(-3. / b * geodetic_distance(
+                lons[sl, None], lats[sl, None], lons[nb], lats[nb])) * vd
+            vv = vd[:, :, None] & vd[:, None, :]
+            cnn = numpy.exp(-3. / b * geodetic_distance(
+                lons[nb][:, :, None], lats[nb][:, :, None],
+                lons[nb][:, None, :], lats[nb][:, None, :])) * vv
+            # the missing neighbours are replaced by independent dummies
+            # having no correlation with the site; the small jitter on the
+            # diagonal avoids singular matrices in case of duplicated sites
+            cnn += eye * (~vv) + eye * 1E-10
+            coeffs[sl] = numpy.linalg.solve(cnn, ci[:, :, None])[:, :, 0]
+            var = 1. - (coeffs[sl] * ci).sum(axis=1)
+            stddevs[sl] = numpy.sqrt(var.clip(0., 1.))
+        rows, cols = valid.nonzero()
+        diag = numpy.arange(num_sites)
+        matrix = csc_matrix(
+            (numpy.concatenate([numpy.ones(num_sites), -coeffs[rows, cols]]),
+             (numpy.concatenate([diag, rows]),
+              numpy.concatenate([diag, nbrs[rows, cols]]))),
+            shape=(num_sites, num_sites))
+        # the matrix is lower triangular with ones on the diagonal,
+        # so the factorization is trivial if there is no pivoting
+        return splu(matrix, permc_spec='NATURAL',
+                    diag_pivot_thresh=0), stddevs
+
+    def apply_correlation(self, sites, imt, residuals):
+        """
+        See :meth:`BaseCorrelationModel.apply_correlation`. If the
+        `tolerance` is set, the nearest neighbours approximation is used.
+        """
+        if self.tolerance is None:
+            return super().apply_correlation(sites, imt, residuals)
+        try:
+            lu, stddevs = self.cache[imt]
+        except KeyError:
+            lu, stddevs = self.cache[imt] = (
+                self.get_nearest_neighbours_factor(sites.complete, imt))
+        # as in the dense case, the sites not in the collection
+        # give no contribution
+        eps = numpy.zeros((len(stddevs), residuals.shape[1]))
+        eps[sites.sids] = residuals * stddevs[sites.sids, None]
+        return lu.solve(eps)[sites.sids]
+
+
+def _jb_range(imt, vs30_clustering):
+    # the parameter b of the JB2009 model, in km
+    # formulae are from page 1700
+    if imt.period < 1:
+        if not vs30_clustering:
+            # case 1, eq. (17)
+            return 8.5 + 17.2 * imt.period
+        else:
+            # case 2, eq. (18)
+            return 40.7 - 15.0 * imt.period
+    # both cases, eq. (19)
+    return 22.0 + 3.7 * imt.period
+
 
 def jbcorrelation(sites_or_distances, imt, vs30_clustering=False):
         """
@@ -133,17 +253,7 @@ def jbcorrelation(sites_or_distances, imt, vs30_clustering=False):
         else:
             distances = sites_or_distances
 
-        # formulae are from page 1700
-        if imt.period < 1:
-            if not vs30_clustering:
-                # case 1, eq. (17)
-                b = 8.5 + 17.2 * imt.period
-            else:
-                # case 2, eq. (18)
-                b = 40.7 - 15.0 * imt.period
-        else:
-            # both cases, eq. (19)
-            b = 22.0 + 3.7 * imt.period
+        b = _jb_range(imt, vs30_clustering)
 
         # eq. (20)
         return numpy.exp((- 3.0 / b) * distances)
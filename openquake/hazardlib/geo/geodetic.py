@@ -21,6 +21,7 @@ Module :mod:`openquake.hazardlib.geo.geodetic` contains functions for geodetic
 transformations, optimized for massive calculations.
 """
 import numpy
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 from openquake.baselib.python3compat import round
 
@@ -30,6 +31,10 @@ EARTH_RADIUS = 6371.0
 #: Maximum elevation on Earth in km.
 EARTH_ELEVATION = -8.848
 
+#: Above this number of pairs of points the closest points are found with
+#: a KD-tree instead of computing the full matrix of distances
+KDTREE_MIN_PAIRS = 10 ** 5
+
 
 def geodetic_distance(lons1, lats1, lons2, lats2, diameter=2*EARTH_RADIUS):
     """
@@ -233,7 +238,26 @@ def min_geodetic_distance(a, b):
         a = spherical_to_cartesian(a[0].flatten(), a[1].flatten())
     if isinstance(b, tuple):
         b = spherical_to_cartesian(b[0].flatten(), b[1].flatten())
-    return cdist(a, b).min(axis=0)
+    return min_idx_dst(a, b)[1]
+
+
+def min_idx_dst(a, b):
+    """
+    Find the closest point of the first set for each point of the second
+    set. For small sets the full matrix of distances is computed, otherwise
+    a KD-tree is built on the first set, so that the memory occupation is
+    O(P + Q) instead of O(P * Q).
+
+    :param a: an array of cartesian coordinates of shape (P, 3)
+    :param b: an array of cartesian coordinates of shape (Q, 3)
+    :returns: Q indices in the first set and Q distances in km
+    """
+    if len(a) * len(b) <= KDTREE_MIN_PAIRS:
+        dists = cdist(a, b)
+        idx = dists.argmin(axis=0)
+        return idx, dists[idx, numpy.arange(len(b))]
+    dists, idx = cKDTree(a).query(b)
+    return idx, dists
 
 
 def distance_matrix(lons, lats, diameter=2*EARTH_RADIUS):
@@ -21,7 +21,6 @@ Module :mod:`openquake.hazardlib.geo.mesh` defines classes :class:`Mesh` and
 its subclass :class:`RectangularMesh`.
 """
 import numpy
-from scipy.spatial.distance import cdist
 import shapely.geometry
 import shapely.ops
 
@@ -254,14 +253,13 @@ class Mesh(object):
         in another mesh.
 
         :returns:
-            numpy array of distances in km of shape (self.size, mesh.size)
+            numpy array of distances in km of shape (mesh.size,)
 
         Method doesn't make any assumptions on arrangement of the points
-        in either mesh and instead calculates the distance from each point of
-        this mesh to each point of the target mesh and returns the lowest found
-        for each.
+        in either mesh; for large meshes the closest points are found with
+        a KD-tree, see :func:`openquake.hazardlib.geo.geodetic.min_idx_dst`.
         """
-        return cdist(self.xyz, mesh.xyz).min(axis=0)
+        return geodetic.min_idx_dst(self.xyz, mesh.xyz)[1]
 
     def get_closest_points(self, mesh):
         """
@@ -271,7 +269,7 @@ class Mesh(object):
             :class:`Mesh` object of the same shape as `mesh` with closest
             points from this one at respective indices.
         """
-        min_idx = cdist(self.xyz, mesh.xyz).argmin(axis=0)  # lose shape
+        min_idx = geodetic.min_idx_dst(self.xyz, mesh.xyz)[0]  # lose shape
         if hasattr(mesh, 'shape'):
             min_idx = min_idx.reshape(mesh.shape)
         lons = self.lons.take(min_idx)
@@ -29,6 +29,7 @@ from openquake.hazardlib.geo import utils
 from openquake.hazardlib.geo.surface import (
     PlanarSurface, SimpleFaultSurface, ComplexFaultSurface)
 from openquake.hazardlib.geo.surface.gridded import GriddedSurface
+from openquake.hazardlib.geo.surface.planar import PlanarSurfaceArray
 
 
 class MultiSurface(BaseSurface):
@@ -120,6 +121,12 @@ class MultiSurface(BaseSurface):
             direction
         """
         self.surfaces = surfaces
+        # if all the surfaces are planar the distances are computed for
+        # all of them at once
+        if all(isinstance(surf, PlanarSurface) for surf in surfaces):
+            self.planar_array = PlanarSurfaceArray.from_surfaces(surfaces)
+        else:
+            self.planar_array = None
         self.areas = None
         self.edge_set = self._get_edge_set(tol)
         self.cartesian_edges = []
@@ -167,9 +174,7 @@ class MultiSurface(BaseSurface):
         <.base.BaseSurface.get_min_distance>`
         for spec of input and result values.
         """
-        dists = [surf.get_min_distance(mesh) for surf in self.surfaces]
-
-        return numpy.min(dists, axis=0)
+        return numpy.min(self._get_distances(mesh, 'rrup'), axis=0)
 
     def get_closest_points(self, mesh):
         """
@@ -185,9 +190,8 @@ class MultiSurface(BaseSurface):
         # an arbitrary shape. By flattening we obtain a ``distances`` matrix
         # for which the first dimension represents the different surfaces
         # and the second dimension the mesh points.
-        dists = numpy.array(
-            [surf.get_min_distance(mesh).flatten() for surf in self.surfaces]
-        )
+        dists = self._get_distances(mesh, 'rrup').reshape(
+            len(self.surfaces), -1)
 
         # find for each point in mesh the index of closest surface
         idx = dists == numpy.min(dists, axis=0)
@@ -226,9 +230,18 @@ class MultiSurface(BaseSurface):
         """
         # for each point in mesh compute the Joyner-Boore distance to all the
         # surfaces and return the shortest one.
-        dists = [
-            surf.get_joyner_boore_distance(mesh) for surf in self.surfaces]
-        return numpy.min(dists, axis=0)
+        return numpy.min(self._get_distances(mesh, 'rjb'), axis=0)
+
+    def _get_distances(self, mesh, param):
+        # an array of shape (S,) + mesh.lons.shape with the distances
+        # from each of the S surfaces
+        if self.planar_array is not None:
+            return self.planar_array.get_distances(mesh, param)
+        elif param == 'rrup':
+            return numpy.array(
+                [surf.get_min_distance(mesh) for surf in self.surfaces])
+        return numpy.array(
+            [surf.get_joyner_boore_distance(mesh) for surf in self.surfaces])
 
     def get_top_edge_depth(self):
         """
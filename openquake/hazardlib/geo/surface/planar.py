@@ -622,3 +622,205 @@ class PlanarSurface(BaseSurface):
         """
         return [self.corner_lons.take([0, 1, 3, 2, 0])], \
                [self.corner_lats.take([0, 1, 3, 2, 0])]
+
+
+class PlanarSurfaceArray(object):
+    """
+    A sequence of P planar surfaces stored in contiguous arrays, so that
+    the distances from a mesh of N points can be computed for all the
+    surfaces at once with broadcast arithmetic; the computation is
+    performed in chunks of surfaces, to keep the memory occupation bounded.
+
+    :param strikes: an array of P strikes
+    :param corner_lons: an array of shape (P, 4)
+    :param corner_lats: an array of shape (P, 4)
+    :param corner_depths: an array of shape (P, 4)
+    :param lengths: an array of P lengths
+    :param widths: an array of P widths
+
+    The corners are in the order top left, top right, bottom left,
+    bottom right, as in :class:`PlanarSurface`.
+    """
+    #: Maximum number of (surface, point) pairs processed at once
+    MAX_DISTANCES = 10 ** 5
+
+    def __init__(self, strikes, corner_lons, corner_lats, corner_depths,
+                 lengths, widths):
+        self.strikes = numpy.array(strikes, float)
+        self.corner_lons = numpy.array(corner_lons, float)
+        self.corner_lats = numpy.array(corner_lats, float)
+        self.corner_depths = numpy.array(corner_depths, float)
+        self.lengths = numpy.array(lengths, float)
+        self.widths = numpy.array(widths, float)
+
+    @classmethod
+    def from_surfaces(cls, surfaces):
+        """
+        :param surfaces: a non-empty list of :class:`PlanarSurface` instances
+        :returns: a :class:`PlanarSurfaceArray` instance
+        """
+        return cls([surf.strike for surf in surfaces],
+                   [surf.corner_lons for surf in surfaces],
+                   [surf.corner_lats for surf in surfaces],
+                   [surf.corner_depths for surf in surfaces],
+                   [surf.length for surf in surfaces],
+                   [surf.width for surf in surfaces])
+
+    def __len__(self):
+        return len(self.strikes)
+
+    def __getitem__(self, aslice):
+        return self.__class__(
+            self.strikes[aslice], self.corner_lons[aslice],
+            self.corner_lats[aslice], self.corner_depths[aslice],
+            self.lengths[aslice], self.widths[aslice])
+
+    def get_distances(self, mesh, param):
+        """
+        :param mesh: a mesh of points (or a site collection)
+        :param param: the kind of distance ('rrup', 'rjb', 'rx' or 'ry0')
+        :returns: an array of distances of shape (P,) + mesh.lons.shape
+        """
+        if param not in ('rrup', 'rjb', 'rx', 'ry0'):
+            raise ValueError('Unknown distance measure %r' % param)
+        lons = mesh.lons.flatten()
+        lats = mesh.lats.flatten()
+        if param == 'rrup':
+            points = mesh.xyz
+        elif param == 'rjb':
+            points = geo_utils.spherical_to_cartesian(lons, lats)
+        P = len(self)
+        dists = numpy.zeros((P, len(lons)))
+        chunksize = max(1, self.MAX_DISTANCES // (len(lons) or 1))
+        for start in range(0, P, chunksize):
+            surfs = self[start:start + chunksize]
+            if param == 'rrup':
+                dst = _get_min_distances(surfs, points)
+            elif param == 'rjb':
+                dst = _get_joyner_boore_distances(surfs, lons, lats, points)
+            elif param == 'rx':
+                dst = geodetic.distance_to_arc(
+                    surfs.corner_lons[:, 0:1], surfs.corner_lats[:, 0:1],
+                    surfs.strikes[:, None], lons, lats)
+            else:
+                dst = _get_ry0_distances(surfs, lons, lats)
+            dists[start:start + chunksize] = dst
+        return dists.reshape((P,) + mesh.lons.shape)
+
+    def get_min_distance(self, mesh):
+        """
+        :returns: the rrup distances, of shape (P,) + mesh.lons.shape
+        """
+        return self.get_distances(mesh, 'rrup')
+
+    def get_joyner_boore_distance(self, mesh):
+        """
+        :returns: the rjb distances, of shape (P,) + mesh.lons.shape
+        """
+        return self.get_distances(mesh, 'rjb')
+
+    def get_rx_distance(self, mesh):
+        """
+        :returns: the rx distances, of shape (P,) + mesh.lons.shape
+        """
+        return self.get_distances(mesh, 'rx')
+
+    def get_ry0_distance(self, mesh):
+        """
+        :returns: the ry0 distances, of shape (P,) + mesh.lons.shape
+        """
+        return self.get_distances(mesh, 'ry0')
+
+
+def get_translated_distances(surface, lon0, lat0, lons, lats, mesh, param):
+    """
+    Compute the distances between the points of a mesh and the P surfaces
+    obtained by translating a planar surface from (lon0, lat0) to each of
+    the given locations, as :meth:`PlanarSurface.translate` would do. The
+    translated surfaces are not instantiated: their corners are stored
+    in a :class:`PlanarSurfaceArray`.
+
+    :param surface: a :class:`PlanarSurface` instance
+    :param lon0: longitude of the reference location
+    :param lat0: latitude of the reference location
+    :param lons: P longitudes of the target locations
+    :param lats: P latitudes of the target locations
+    :param mesh: a mesh of N points (or a site collection)
+    :param param: the kind of distance ('rrup', 'rjb', 'rx' or 'ry0')
+    :returns: an array of distances of shape (P, N)
+    """
+    azimuths = geodetic.azimuth(lon0, lat0, lons, lats)
+    distances = geodetic.geodetic_distance(lon0, lat0, lons, lats)
+    # corners of the translated surfaces, arrays of shape (P, 4)
+    clons, clats = geodetic.point_at(
+        surface.corner_lons, surface.corner_lats,
+        azimuths[:, None], distances[:, None])
+    P = len(clons)
+    surfaces = PlanarSurfaceArray(
+        numpy.repeat(surface.strike, P), clons, clats,
+        numpy.tile(surface.corner_depths, (P, 1)),
+        numpy.repeat(surface.length, P), numpy.repeat(surface.width, P))
+    return surfaces.get_distances(mesh, param)
+
+
+def _get_min_distances(surfs, points):
+    # broadcast version of PlanarSurface._init_plane and get_min_distance
+    tl, tr, bl, br = geo_utils.spherical_to_cartesian(
+        surfs.corner_lons, surfs.corner_lats,
+        surfs.corner_depths).transpose(1, 0, 2)
+    normal = geo_utils.normalized(numpy.cross(tl - tr, tl - bl))  # (P, 3)
+    d = - (normal * tl).sum(axis=-1)  # shape P
+    uv1 = geo_utils.normalized(tr - tl)
+    uv2 = numpy.cross(normal, uv1)
+    # project the N points on the P planes
+    dists = (normal[:, None] * points).sum(axis=-1) + d[:, None]  # (P, N)
+    projs = points + normal[:, None] * (- dists)[:, :, None]
+    vectors2d = projs - tl[:, None]
+    xx = (vectors2d * uv1[:, None]).sum(axis=-1)
+    yy = (vectors2d * uv2[:, None]).sum(axis=-1)
+    lengths = surfs.lengths[:, None]
+    widths = surfs.widths[:, None]
+    mxx = numpy.select([xx < 0, xx > lengths], [xx, xx - lengths], default=0)
+    myy = numpy.select([yy < 0, yy > widths], [yy, yy - widths], default=0)
+    dists2d_squares = mxx ** 2 + myy ** 2
+    return numpy.sqrt(dists ** 2 + dists2d_squares)
+
+
+def _get_joyner_boore_distances(surfs, lons, lats, points):
+    # broadcast version of PlanarSurface.get_joyner_boore_distance
+    arcs_lons = surfs.corner_lons[:, None, [0, 2, 0, 1]]  # shape (P, 1, 4)
+    arcs_lats = surfs.corner_lats[:, None, [0, 2, 0, 1]]
+    downdip_azimuths = (surfs.strikes + 90) % 360
+    arcs_azimuths = numpy.array([surfs.strikes, surfs.strikes,
+                                 downdip_azimuths, downdip_azimuths]).T
+    dists_to_arcs = geodetic.distance_to_arc(
+        arcs_lons, arcs_lats, arcs_azimuths[:, None],
+        lons.reshape((1, -1, 1)), lats.reshape((1, -1, 1)))  # P, N, 4
+    # distances to the projections of the corners, shape (P, N)
+    corners = geo_utils.spherical_to_cartesian(
+        surfs.corner_lons, surfs.corner_lats)  # (P, 4, 3)
+    vectors = corners[:, :, None] - points  # shape (P, 4, N, 3)
+    dists_to_corners = numpy.sqrt(
+        (vectors ** 2).sum(axis=-1)).min(axis=1)
+    ds1, ds2, ds3, ds4 = numpy.sign(dists_to_arcs).transpose(2, 0, 1)
+    dists_to_arcs = numpy.abs(dists_to_arcs).reshape(
+        dists_to_arcs.shape[:2] + (2, 2)).min(axis=-1)
+    return numpy.select(
+        [(ds1 == ds2) & (ds3 == ds4), ds1 == ds2, ds3 == ds4],
+        [dists_to_corners, dists_to_arcs[..., 0], dists_to_arcs[..., 1]],
+        default=0)
+
+
+def _get_ry0_distances(surfs, lons, lats):
+    # broadcast version of PlanarSurface.get_ry0_distance
+    downdip_azimuths = ((surfs.strikes + 90.) % 360)[:, None]
+    dst1 = geodetic.distance_to_arc(
+        surfs.corner_lons[:, 0:1], surfs.corner_lats[:, 0:1],
+        downdip_azimuths, lons, lats)
+    dst2 = geodetic.distance_to_arc(
+        surfs.corner_lons[:, 1:2], surfs.corner_lats[:, 1:2],
+        downdip_azimuths, lons, lats)
+    idx = numpy.sign(dst1) == numpy.sign(dst2)
+    dst = numpy.zeros_like(dst1)
+    dst[idx] = numpy.fmin(numpy.abs(dst1[idx]), numpy.abs(dst2[idx]))
+    return dst
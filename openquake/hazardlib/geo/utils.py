@@ -22,7 +22,6 @@ to several geographical primitives and some other low-level spatial operations.
 """
 import math
 import logging
-import operator
 import collections
 
 import numpy
@@ -130,7 +129,8 @@ class _GeographicObjects(object):
         Associated a list of assets by site to the site collection used
         to instantiate GeographicObjects.
 
-        :param assets_by_sites: a list of lists of assets
+        :param assets_by_sites: a list of composite arrays of assets, with
+            fields ordinal, lon, lat
         :param assoc_dist: the maximum distance for association
         :param mode: 'strict', 'warn' or 'filter'
         :returns: (filtered site collection, filtered assets by site)
@@ -139,11 +139,11 @@ class _GeographicObjects(object):
         self.objects.filtered  # self.objects must be a SiteCollection
         assets_by_sid = collections.defaultdict(list)
         for assets in assets_by_site:
-            lon, lat = assets[0].location
+            lon, lat = assets[0]['lon'], assets[0]['lat']
             obj, distance = self.get_closest(lon, lat)
             if distance <= assoc_dist:
                 # keep the assets, otherwise discard them
-                assets_by_sid[obj['sids']].extend(assets)
+                assets_by_sid[obj['sids']].append(assets)
             elif mode == 'strict':
                 raise SiteAssociationError(
                     'There is nothing closer than %s km '
@@ -156,9 +156,10 @@ class _GeographicObjects(object):
             raise SiteAssociationError(
                 'Could not associate any site to any assets within the '
                 'asset_hazard_distance of %s km' % assoc_dist)
-        assets_by_site = [
-            sorted(assets_by_sid[sid], key=operator.attrgetter('ordinal'))
-            for sid in sids]
+        assets_by_site = []
+        for sid in sids:
+            assets = numpy.concatenate(assets_by_sid[sid])
+            assets_by_site.append(assets[assets['ordinal'].argsort()])
         return self.objects.filtered(sids), assets_by_site
 
 
@@ -167,8 +168,8 @@ def assoc(objects, sitecol, assoc_dist, mode):
     Associate geographic objects to a site collection.
 
     :param objects:
-        something with .lons, .lats or ['lon'] ['lat'], or a list of lists
-        of objects with a .location attribute (i.e. assets_by_site)
+        something with .lons, .lats or ['lon'] ['lat'], or a list of
+        composite arrays with fields ['lon'] ['lat'] (i.e. assets_by_site)
     :param assoc_dist:
         the maximum distance for association
     :param mode:
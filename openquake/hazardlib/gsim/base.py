@@ -309,6 +309,71 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
             else:
                 return _truncnorm_sf(truncation_level, values)
 
+    def get_mean_std(self, sctx, rctx, dctx, imts):
+        """
+        Calculate the means and the total standard deviations for several
+        IMTs in one call. GSIMs able to compute all the IMTs at once can
+        override this method to save the repeated computation of the terms
+        not depending on the IMT.
+
+        :param sctx: a :class:`SitesContext` instance
+        :param rctx: a :class:`RuptureContext` instance
+        :param dctx: a :class:`DistancesContext` instance
+        :param imts: a list of M intensity measure type objects
+        :returns: an array of shape (2, N, M) with means and stddevs
+        """
+        arrays = []
+        for imt in imts:
+            self._check_imt(imt)
+            mean, [stddev] = self.get_mean_and_stddevs(
+                sctx, rctx, dctx, imt, [const.StdDev.TOTAL])
+            arrays.append((mean, stddev))
+        # some GSIMs return scalars or arrays of length 1 for some IMTs,
+        # so the arrays are broadcast to the number of sites
+        N = max(numpy.size(array) for pair in arrays for array in pair)
+        mean_std = numpy.zeros((2, N, len(imts)))
+        for m, (mean, stddev) in enumerate(arrays):
+            mean_std[0, :, m] = mean
+            mean_std[1, :, m] = stddev
+        return mean_std
+
+    def get_all_poes(self, sctx, rctx, dctx, imtls, truncation_level,
+                     out=None):
+        """
+        Calculate the PoEs for all the IMTs and levels in `imtls` at once.
+        The results are the same as the ones obtained by calling
+        :meth:`get_poes` for each IMT, but the means and stddevs are
+        computed by a single call to :meth:`get_mean_std` and the
+        survival function is evaluated in a single vectorized pass.
+
+        :param sctx: a :class:`SitesContext` instance
+        :param rctx: a :class:`RuptureContext` instance
+        :param dctx: a :class:`DistancesContext` instance
+        :param imtls: a DictArray imt -> levels with L levels in total
+        :param truncation_level: None, zero or a positive number
+        :param out: if given, an array of shape (N, L) to fill
+        :returns: an array of shape (N, L)
+        """
+        base_get_poes = GroundShakingIntensityModel.get_poes
+        if truncation_level == 0 or type(self).get_poes is not base_get_poes:
+            # zero truncation or custom get_poes, compute IMT by IMT
+            poes = [self.get_poes(sctx, rctx, dctx,
+                                  imt_module.from_string(imt), imtls[imt],
+                                  truncation_level) for imt in imtls]
+            if out is None:
+                return numpy.concatenate(poes, axis=1)
+            for imt, poe in zip(imtls, poes):
+                out[:, imtls.slicedic[imt]] = poe
+            return out
+        if truncation_level is not None and truncation_level < 0:
+            raise ValueError('truncation level must be zero, positive number '
+                             'or None')
+        assert const.StdDev.TOTAL in self.DEFINED_FOR_STANDARD_DEVIATION_TYPES
+        mean_std = self.get_mean_std(
+            sctx, rctx, dctx, [imt_module.from_string(imt) for imt in imtls])
+        loglevels = imtls.new(self.to_distribution_values(imtls.array))
+        return _get_poes(mean_std, loglevels, truncation_level, out)
+
     def disaggregate_pne(self, rupture, sctx, dctx, imt, iml,
                          truncnorm, epsilons):
         """
@@ -494,6 +559,37 @@ def _norm_sf(values):
     return ndtr(- values)
 
 
+def _get_poes(mean_std, loglevels, truncation_level, out=None):
+    """
+    Compute the PoEs for all the IMTs and levels, by performing the
+    operations of :func:`_norm_sf` and :func:`_truncnorm_sf` in place.
+
+    :param mean_std: an array of shape (2, N, M)
+    :param loglevels: a DictArray with M IMTs and L levels in total
+    :param truncation_level: None or a positive number
+    :param out: if given, an array of shape (N, L) to fill
+    :returns: an array of shape (N, L)
+    """
+    N = mean_std.shape[1]
+    if out is None:
+        out = numpy.zeros((N, len(loglevels.array)))
+    for m, imt in enumerate(loglevels):
+        sl = loglevels.slicedic[imt]
+        out[:, sl] = loglevels[imt]
+        out[:, sl] -= mean_std[0, :, m, None]
+        out[:, sl] /= mean_std[1, :, m, None]
+    if truncation_level is None:
+        numpy.negative(out, out)
+        ndtr(out, out)
+    else:
+        phi_b = ndtr(truncation_level)
+        ndtr(out, out)
+        numpy.subtract(phi_b, out, out)
+        out /= phi_b * 2 - 1
+        out.clip(0., 1., out)
+    return out
+
+
 class GMPE(GroundShakingIntensityModel):
     """
     Ground-Motion Prediction Equation is a subclass of generic
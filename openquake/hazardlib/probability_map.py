@@ -15,9 +15,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import weakref
+import collections.abc
 from openquake.baselib.python3compat import zip
 import numpy
 
+U32 = numpy.uint32
 F32 = numpy.float32
 F64 = numpy.float64
 BYTES_PER_FLOAT = 8
@@ -98,10 +101,10 @@ class ProbabilityCurve(object):
         return curve[0]
 
 
-class ProbabilityMap(dict):
+class ProbabilityMap(collections.abc.MutableMapping, dict):
     """
-    A dictionary site_id -> ProbabilityCurve. It defines the complement
-    operator `~`, performing the complement on each curve
+    A dictionary-like object site_id -> ProbabilityCurve. It defines the
+    complement operator `~`, performing the complement on each curve
 
     ~p = 1 - p
 
@@ -109,12 +112,27 @@ class ProbabilityMap(dict):
 
     m = m1 | m2 = {sid: m1[sid] | m2[sid] for sid in all_sids}
 
-    Such operators are implemented efficiently at the numpy level, by
-    dispatching on the underlying array. Moreover there is a classmethod
-    .build(L, I, sids, initvalue) to build initialized instances of
-    :class:`ProbabilityMap`. The map can be represented as 3D array of shape
-    (shape_x, shape_y, shape_z) = (N, L, I), where N is the number of site IDs,
-    L the total number of hazard levels and I the number of GSIMs.
+    The map is stored as a 3D array of shape (shape_x, shape_y, shape_z) =
+    (N, L, I), where N is the number of site IDs, L the total number of
+    hazard levels and I the number of GSIMs, plus an array of N sorted
+    site IDs. The ProbabilityCurves returned by `pmap[sid]` and by
+    `pmap.setdefault` are views over the rows of the underlying array, so
+    that `pmap[sid].array *= x` changes the map in place, while the
+    operators work on all the rows at once by using fancy indexing. The
+    curves still alive are rebound to the new rows when the underlying
+    array is reallocated, so a curve can be kept and updated in place;
+    however the arrays extracted from a curve (`pmap[sid].array`) are
+    plain numpy views and are not updated. For compatibility the class
+    is a subclass of `dict`, but the curves are not stored in the dict.
+    Moreover there is a classmethod .build(L, I, sids, initvalue) to build
+    initialized instances of :class:`ProbabilityMap`.
+
+    >>> pmap = ProbabilityMap.build(3, 1, [2, 0], initvalue=.1)
+    >>> pmap.sids
+    array([0, 2], dtype=uint32)
+    >>> (pmap | pmap).array[:, :, 0]
+    array([[0.19, 0.19, 0.19],
+           [0.19, 0.19, 0.19]])
     """
     @classmethod
     def build(cls, shape_y, shape_z, sids, initvalue=0.):
@@ -125,10 +143,11 @@ class ProbabilityMap(dict):
         :param initvalue: the initial value of the probability (default 0)
         :returns: a ProbabilityMap dictionary
         """
-        dic = cls(shape_y, shape_z)
-        for sid in sids:
-            dic.setdefault(sid, initvalue)
-        return dic
+        self = cls(shape_y, shape_z)
+        self._sids = _check_unique(numpy.array(sorted(sids), U32))
+        self._array = numpy.empty((len(self._sids), shape_y, shape_z), F64)
+        self._array.fill(initvalue)
+        return self
 
     @classmethod
     def from_array(cls, array, sids):
@@ -144,13 +163,137 @@ class ProbabilityMap(dict):
         if len(array.shape) == 2:  # shape (N, L) -> (N, L, 1)
             array = array.reshape(array.shape + (1,))
         self = cls(*array.shape[1:])
-        for sid, poes in zip(sids, array):
-            self[sid] = ProbabilityCurve(poes)
+        sids = numpy.array(sids, U32)
+        idx = sids.argsort(kind='mergesort')
+        self._sids = _check_unique(sids[idx])
+        self._array = array[idx]  # fancy indexing, so this is a copy
         return self
 
     def __init__(self, shape_y, shape_z=1):
         self.shape_y = shape_y
         self.shape_z = shape_z
+        self._sids = numpy.zeros(0, U32)
+        self._array = numpy.zeros((0, shape_y, shape_z), F64)
+        self._extra = {}  # curves added one by one, not yet in the array
+        # curves returned to the user, to be rebound on reallocation
+        self._views = weakref.WeakValueDictionary()
+
+    def _rebind(self):
+        # make the curves still alive point to the new underlying array
+        for sid, pc in list(self._views.items()):
+            try:
+                pc.array = self._array[self._idx(sid)]
+            except KeyError:  # the site was deleted
+                del self._views[sid]
+
+    def _insert(self, sids, array):
+        # insert new rows in the underlying array, keeping the sids sorted
+        sids = numpy.concatenate([self._sids, sids])
+        idx = sids.argsort(kind='mergesort')
+        self._sids = sids[idx]
+        self._array = numpy.concatenate([self._array, array])[idx]
+
+    def _consolidate(self):
+        # move the curves added one by one into the underlying array
+        if not self._extra:
+            return
+        sids = numpy.array(sorted(self._extra), U32)
+        array = numpy.array([self._extra[sid].array for sid in sids], F64)
+        self._insert(sids, array.reshape(-1, self.shape_y, self.shape_z))
+        # the curves in _extra are now views over the array, too
+        self._views.update(self._extra)
+        self._extra.clear()
+        self._rebind()
+
+    def _idx(self, sid):
+        # index of the site ID in the underlying array, or KeyError
+        idx = self._sids.searchsorted(sid)
+        if idx < len(self._sids) and self._sids[idx] == sid:
+            return idx
+        raise KeyError(sid)
+
+    def get_indices(self, sids):
+        """
+        :param sids: an array of site IDs contained in the map
+        :returns: the indices of the corresponding rows of `.array`
+        """
+        self._consolidate()
+        return self._sids.searchsorted(sids)
+
+    def __getitem__(self, sid):
+        try:
+            return self._extra[sid]
+        except KeyError:
+            pass
+        try:
+            return self._views[sid]
+        except KeyError:
+            pc = self._views[sid] = ProbabilityCurve(
+                self._array[self._idx(sid)])
+            return pc
+
+    def __setitem__(self, sid, curve):
+        try:
+            idx = self._idx(sid)
+        except KeyError:
+            self._extra[sid] = curve
+        else:
+            self._array[idx] = curve.array.reshape(
+                self.shape_y, self.shape_z)
+
+    def __delitem__(self, sid):
+        try:
+            del self._extra[sid]
+        except KeyError:
+            idx = self._idx(sid)
+            self._sids = numpy.delete(self._sids, idx)
+            self._array = numpy.delete(self._array, idx, axis=0)
+            self._rebind()
+
+    def __contains__(self, sid):
+        if sid in self._extra:
+            return True
+        try:
+            self._idx(sid)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        self._consolidate()
+        return iter(self._sids.tolist())
+
+    def __len__(self):
+        return len(self._sids) + len(self._extra)
+
+    def __repr__(self):
+        return '<%s %d, %d, %d>' % (self.__class__.__name__, len(self),
+                                    self.shape_y, self.shape_z)
+
+    def __reduce__(self):
+        # the curves are not stored in the underlying dict, so the default
+        # pickling of dict subclasses cannot be used
+        return self.__class__, (self.shape_y, self.shape_z), \
+            self.__getstate__()
+
+    def __getstate__(self):
+        self._consolidate()
+        state = self.__dict__.copy()
+        del state['_views']  # weak references cannot be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views = weakref.WeakValueDictionary()
+
+    def copy(self):
+        """
+        :returns: a copy of the map, not sharing the underlying array
+        """
+        new = self.__class__(self.shape_y, self.shape_z)
+        new._sids = self.sids.copy()
+        new._array = self._array.copy()
+        return new
 
     def setdefault(self, sid, value):
         """
@@ -166,20 +309,22 @@ class ProbabilityMap(dict):
             array = numpy.empty((self.shape_y, self.shape_z), F64)
             array.fill(value)
             pc = ProbabilityCurve(array)
-            self[sid] = pc
+            self._extra[sid] = pc
             return pc
 
     @property
     def sids(self):
         """The ordered keys of the map as a numpy.uint32 array"""
-        return numpy.array(sorted(self), numpy.uint32)
+        self._consolidate()
+        return self._sids
 
     @property
     def array(self):
         """
         The underlying array of shape (N, L, I)
         """
-        return numpy.array([self[sid].array for sid in sorted(self)])
+        self._consolidate()
+        return self._array
 
     @property
     def nbytes(self):
@@ -205,10 +350,7 @@ class ProbabilityMap(dict):
         """
         curves = numpy.zeros(nsites, imtls.dt)
         for imt in curves.dtype.names:
-            curves_by_imt = curves[imt]
-            for sid in self:
-                curves_by_imt[sid] = self[sid].array[
-                    imtls.slicedic[imt], idx]
+            curves[imt][self.sids] = self._array[:, imtls.slicedic[imt], idx]
         return curves
 
     # used when exporting to npy
@@ -252,28 +394,22 @@ class ProbabilityMap(dict):
         """
         assert self.shape_z == 1, self.shape_z
         curves = numpy.zeros(len(sids), imtls.dt)
+        sids = numpy.array(sids, U32)
+        ok = numpy.isin(sids, self.sids)  # the other poes will be zeros
+        idx = self._sids.searchsorted(sids[ok])
         for imt in curves.dtype.names:
-            curves_by_imt = curves[imt]
-            for i, sid in numpy.ndenumerate(sids):
-                try:
-                    pcurve = self[sid]
-                except KeyError:
-                    pass  # the poes will be zeros
-                else:
-                    curves_by_imt[i] = pcurve.array[imtls.slicedic[imt], 0]
+            curves[imt][ok] = self._array[idx, imtls.slicedic[imt], 0]
         return curves
 
     def filter(self, sids):
         """
         Extracs a submap of self for the given sids.
         """
-        dic = self.__class__(self.shape_y, self.shape_z)
-        for sid in sids:
-            try:
-                dic[sid] = self[sid]
-            except KeyError:
-                pass
-        return dic
+        new = self.__class__(self.shape_y, self.shape_z)
+        ok = numpy.isin(self.sids, numpy.array(list(sids), U32))
+        new._sids = self._sids[ok]
+        new._array = self._array[ok]
+        return new
 
     def extract(self, inner_idx):
         """
@@ -281,69 +417,76 @@ class ProbabilityMap(dict):
         specified by the index `inner_idx`.
         """
         out = self.__class__(self.shape_y, 1)
-        for sid in self:
-            curve = self[sid]
-            array = curve.array[:, inner_idx].reshape(-1, 1)
-            out[sid] = ProbabilityCurve(array)
+        out._sids = self.sids.copy()
+        out._array = self._array[:, :, [inner_idx]]
         return out
 
     def __ior__(self, other):
-        self_sids = set(self)
-        other_sids = set(other)
-        for sid in self_sids & other_sids:
-            self[sid] = self[sid] | other[sid]
-        for sid in other_sids - self_sids:
-            self[sid] = other[sid]
+        if not len(other):
+            return self
+        self._consolidate()
+        other._consolidate()
+        old = numpy.isin(other._sids, self._sids)
+        if not old.all():  # copy the curves of the new sites
+            self._insert(other._sids[~old], other._array[~old])
+            self._rebind()
+        idx = self._sids.searchsorted(other._sids[old])
+        self._array[idx] = 1. - (1. - self._array[idx]) * (
+            1. - other._array[old])
         return self
 
     def __or__(self, other):
         new = self.__class__(self.shape_y, self.shape_z)
-        new.update(self)
+        new._sids = self.sids.copy()
+        new._array = self._array.copy()
         new |= other
         return new
 
     __ror__ = __or__
 
     def __mul__(self, other):
-        try:
-            other.get
-            is_pmap = True
-            sids = set(self) | set(other)
-        except AttributeError:  # no .get method, assume a float
-            is_pmap = False
-            assert 0. <= other <= 1., other  # must be a probability
-            sids = set(self)
         new = self.__class__(self.shape_y, self.shape_z)
-        for sid in sids:
-            prob = other.get(sid, 1) if is_pmap else other
-            new[sid] = self.get(sid, 1) * prob
+        if isinstance(other, ProbabilityMap):
+            # the missing curves are considered equal to 1
+            sids = numpy.union1d(self.sids, other.sids).astype(U32)
+            array = numpy.ones((len(sids), self.shape_y, self.shape_z), F64)
+            array[sids.searchsorted(self._sids)] = self._array
+            array[sids.searchsorted(other._sids)] *= other._array
+            new._sids, new._array = sids, array
+        else:  # assume a float
+            assert 0. <= other <= 1., other  # must be a probability
+            new._sids = self.sids.copy()
+            new._array = self._array * other
         return new
 
+    __rmul__ = __mul__
+
     def __invert__(self):
         new = self.__class__(self.shape_y, self.shape_z)
-        for sid in self:
-            if (self[sid].array != 1.).any():
-                new[sid] = ~self[sid]  # store only nonzero probabilities
+        # store only nonzero probabilities
+        ok = (self.array != 1.).reshape(len(self._sids), -1).any(axis=1)
+        new._sids = self._sids[ok]
+        new._array = 1. - self._array[ok]
         return new
 
     def __toh5__(self):
         # converts to an array of shape (num_sids, shape_y, shape_z)
-        size = len(self)
-        sids = self.sids
-        shape = (size, self.shape_y, self.shape_z)
-        array = numpy.zeros(shape, F64)
-        for i, sid in numpy.ndenumerate(sids):
-            array[i] = self[sid].array
-        return dict(array=array, sids=sids), {}
+        return dict(array=self.array, sids=self.sids), {}
 
     def __fromh5__(self, dic, attrs):
         # rebuild the map from sids and probs arrays
         array = dic['array']
-        sids = dic['sids']
-        self.shape_y = array.shape[1]
-        self.shape_z = array.shape[2]
-        for sid, prob in zip(sids, array):
-            self[sid] = ProbabilityCurve(prob)
+        self.__init__(array.shape[1], array.shape[2])
+        self._sids = numpy.array(dic['sids'], U32)
+        self._array = numpy.array(array)  # keep the stored dtype
+
+
+def _check_unique(sids):
+    # sids is a sorted array of site IDs
+    if len(sids) > 1 and (sids[1:] == sids[:-1]).any():
+        raise ValueError('Duplicated site IDs: %s' % numpy.unique(
+            sids[1:][sids[1:] == sids[:-1]]))
+    return sids
 
 
 def get_shape(pmaps):
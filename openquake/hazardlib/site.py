@@ -19,10 +19,15 @@
 """
 Module :mod:`openquake.hazardlib.site` defines :class:`Site`.
 """
+import pickle
 import numpy
+from scipy.spatial import cKDTree
 from shapely import geometry
-from openquake.baselib.general import split_in_blocks, not_equal
-from openquake.hazardlib.geo.utils import fix_lon, cross_idl
+from openquake.baselib.general import (
+    split_in_blocks, not_equal, cached_property)
+from openquake.baselib.parallel import SharedArray
+from openquake.hazardlib.geo.utils import (
+    fix_lon, cross_idl, spherical_to_cartesian)
 from openquake.hazardlib.geo.mesh import Mesh
 
 
@@ -205,6 +210,27 @@ class SiteCollection(object):
 
     xyz = Mesh.xyz
 
+    @cached_property
+    def kdtree(self):
+        """
+        :returns:
+            a :class:`scipy.spatial.cKDTree` on the cartesian coordinates
+            of the sites projected on the earth surface; it is built
+            lazily and cached on the instance; it is not pickled, so each
+            unpickled copy of the collection builds its own tree, unless
+            the collection is shared (see :meth:`share`)
+        """
+        if 'shared_kdtree' in vars(self):  # restore the published tree
+            return pickle.loads(memoryview(self.shared_kdtree.array))
+        return cKDTree(spherical_to_cartesian(self.lons, self.lats))
+
+    @cached_property
+    def max_depth(self):
+        """
+        :returns: the maximum site depth, or zero for sites above sea level
+        """
+        return max(self.depths.max(), 0) if len(self) else 0
+
     def filtered(self, indices):
         """
         :param indices:
@@ -216,7 +242,9 @@ class SiteCollection(object):
         if len(indices) == len(self):
             return self
         new = object.__new__(self.__class__)
-        indices = numpy.uint32(sorted(indices))
+        if not isinstance(indices, numpy.ndarray):  # i.e. a list or a dict
+            indices = list(indices)
+        indices = numpy.sort(numpy.uint32(indices))
         new.array = self.array[indices]
         new.complete = self.complete
         return new
@@ -229,6 +257,23 @@ class SiteCollection(object):
         self.array['sids'] = numpy.arange(len(self), dtype=numpy.uint32)
         self.complete = self
 
+    def share(self):
+        """
+        Publish the array of a complete site collection in shared memory
+        (see :class:`openquake.baselib.parallel.SharedArray`), so that
+        pickling the collection, or a collection filtered from it,
+        transfers only a lightweight handle. After that the collection is
+        read-only. The KD-tree is published too, already built, so
+        that the workers restore it instead of building it again.
+        """
+        assert self.complete is self, 'Only complete collections are shared'
+        if 'shared' not in vars(self):
+            self.shared = SharedArray(self.array)
+            self.array = self.shared.array
+            data = pickle.dumps(self.kdtree, pickle.HIGHEST_PROTOCOL)
+            self.shared_kdtree = SharedArray(
+                numpy.frombuffer(data, numpy.uint8))
+
     def __init__(self, sites):
         """
         Build a complete SiteCollection from a list of Site objects
@@ -355,8 +400,19 @@ class SiteCollection(object):
         return mask.nonzero()[0]
 
     def __getstate__(self):
+        if 'shared' in vars(self):  # send only the handles
+            return dict(shared=self.shared, shared_kdtree=self.shared_kdtree)
         return dict(array=self.array, complete=self.complete)
 
+    def __setstate__(self, state):
+        if 'shared' in state:  # attach to the shared array
+            self.shared = state['shared']
+            self.shared_kdtree = state['shared_kdtree']
+            self.array = self.shared.array
+            self.complete = self
+        else:
+            self.__dict__.update(state)
+
     def __getitem__(self, sid):
         """
         Return a site record
@@ -93,10 +93,27 @@ class AreaSource(ParametricSeismicSource):
         of points the polygon discretizes to.
         """
         polygon_mesh = self.polygon.discretize(self.area_discretization)
-        rate_scaling_factor = 1.0 / len(polygon_mesh)
-
         # take the very first point of the polygon mesh
         [epicenter0] = polygon_mesh[0:1]
+        ref_ruptures = self._get_reference_ruptures(
+            epicenter0, 1.0 / len(polygon_mesh))
+
+        # for each of the epicenter positions generate as many ruptures
+        # as we generated "reference" ones: new ruptures differ only
+        # in hypocenter and surface location
+        for epicenter in polygon_mesh:
+            for mag, rake, hc_depth, surface, occ_rate in ref_ruptures:
+                # translate the surface from first epicenter position
+                # to the target one preserving it's geometry
+                surface = surface.translate(epicenter0, epicenter)
+                hypocenter = deepcopy(epicenter)
+                hypocenter.depth = hc_depth
+                rupture = ParametricProbabilisticRupture(
+                    mag, rake, self.tectonic_region_type, hypocenter,
+                    surface, occ_rate, self.temporal_occurrence_model)
+                yield rupture
+
+    def _get_reference_ruptures(self, epicenter0, rate_scaling_factor):
         # generate "reference ruptures" -- all the ruptures that have the same
         # epicenter location (first point of the polygon's mesh) but different
         # magnitudes, nodal planes, hypocenters' depths and occurrence rates
@@ -113,21 +130,29 @@ class AreaSource(ParametricSeismicSource):
                         self, mag, np, hypocenter)
                     ref_ruptures.append((mag, np.rake, hc_depth,
                                          surface, occurrence_rate))
+        return ref_ruptures
 
-        # for each of the epicenter positions generate as many ruptures
-        # as we generated "reference" ones: new ruptures differ only
-        # in hypocenter and surface location
-        for epicenter in polygon_mesh:
-            for mag, rake, hc_depth, surface, occ_rate in ref_ruptures:
-                # translate the surface from first epicenter position
-                # to the target one preserving it's geometry
-                surface = surface.translate(epicenter0, epicenter)
-                hypocenter = deepcopy(epicenter)
-                hypocenter.depth = hc_depth
-                rupture = ParametricProbabilisticRupture(
-                    mag, rake, self.tectonic_region_type, hypocenter,
-                    surface, occ_rate, self.temporal_occurrence_model)
-                yield rupture
+    def get_rupture_templates(self):
+        """
+        The ruptures of an area source are translations of the ruptures
+        generated at the first point of the polygon mesh.
+
+        :returns:
+            the mesh of the epicenters and the list of the reference
+            ruptures, located at the first epicenter
+        """
+        polygon_mesh = self.polygon.discretize(self.area_discretization)
+        [epicenter0] = polygon_mesh[0:1]
+        ruptures = []
+        for mag, rake, hc_depth, surface, occ_rate in \
+                self._get_reference_ruptures(
+                    epicenter0, 1.0 / len(polygon_mesh)):
+            hypocenter = geo.Point(epicenter0.longitude, epicenter0.latitude,
+                                   hc_depth)
+            ruptures.append(ParametricProbabilisticRupture(
+                mag, rake, self.tectonic_region_type, hypocenter,
+                surface, occ_rate, self.temporal_occurrence_model))
+        return polygon_mesh, ruptures
 
     def count_ruptures(self):
         """
@@ -16,9 +16,12 @@
 """
 Module :mod:`openquake.hazardlib.source.point` defines :class:`PointSource`.
 """
+import copy
 import math
+import numpy
 from openquake.baselib.slots import with_slots
-from openquake.hazardlib.geo import Point, geodetic
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.geo import Point, Mesh, geodetic
 from openquake.hazardlib.geo.surface.planar import PlanarSurface
 from openquake.hazardlib.source.base import ParametricSeismicSource
 from openquake.hazardlib.source.rupture import ParametricProbabilisticRupture
@@ -175,6 +178,54 @@ class PointSource(ParametricSeismicSource):
         return self._iter_ruptures_at_location(
             self.temporal_occurrence_model, self.location)
 
+    def get_rupture_templates(self):
+        """
+        :returns:
+            the mesh of the epicenters (here a single point) and the list of
+            the ruptures located at the first epicenter; see
+            :meth:`openquake.hazardlib.source.area.AreaSource.get_rupture_templates`
+        """
+        epicenters = Mesh(numpy.array([self.location.longitude]),
+                          numpy.array([self.location.latitude]))
+        return epicenters, list(self.iter_ruptures())
+
+    def get_collapsed_source(self):
+        """
+        Far away from the source the ruptures differing only by strike, dip
+        and hypocenter depth produce nearly the same distances. This method
+        returns a copy of the source where the nodal planes with the same
+        rake are merged into the most probable one and the hypocenter depths
+        are merged into their weighted mean; the total occurrence rate of
+        each magnitude is unchanged.
+
+        :returns:
+            a :class:`PointSource` with less ruptures, or the source itself
+            if there is nothing to collapse
+        """
+        nps = self.nodal_plane_distribution.data
+        hcs = self.hypocenter_distribution.data
+        if len(hcs) == 1 and len(set(np.rake for _, np in nps)) == len(nps):
+            return self
+        by_rake = {}  # rake -> [total probability, most probable plane]
+        for np_prob, np in nps:
+            if np.rake not in by_rake:
+                by_rake[np.rake] = [np_prob, np_prob, np]
+            else:
+                acc = by_rake[np.rake]
+                acc[0] += np_prob
+                if np_prob > acc[1]:
+                    acc[1:] = [np_prob, np]
+        depth = sum(hc_prob * hc_depth for hc_prob, hc_depth in hcs)
+        # avoid going outside the seismogenic layer due to roundoff
+        depth = min(max(depth, self.upper_seismogenic_depth),
+                    self.lower_seismogenic_depth)
+        src = copy.copy(self)
+        src.nodal_plane_distribution = PMF(
+            [(prob, np) for prob, _, np in by_rake.values()])
+        src.hypocenter_distribution = PMF([(1, depth)])
+        src.num_ruptures = src.count_ruptures()
+        return src
+
     def _iter_ruptures_at_location(self, temporal_occurrence_model, location,
                                    rate_scaling_factor=1):
         """
@@ -88,25 +88,21 @@ def compute_pmap_stats(pmaps, stats, weights):
     :returns:
         a probability map with S internal values
     """
-    sids = set()
     p0 = next(iter(pmaps))
     L = p0.shape_y
     for pmap in pmaps:
-        sids.update(pmap)
         assert pmap.shape_y == L, (pmap.shape_y, L)
+    sids = numpy.unique(numpy.concatenate(
+        [pmap.sids for pmap in pmaps])).astype(numpy.uint32)
     if len(sids) == 0:
         raise ValueError('All empty probability maps!')
-    sids = numpy.array(sorted(sids), numpy.uint32)
     nstats = len(stats)
     curves = numpy.zeros((len(pmaps), len(sids), L), numpy.float64)
     for i, pmap in enumerate(pmaps):
-        for j, sid in enumerate(sids):
-            if sid in pmap:
-                curves[i][j] = pmap[sid].array[:, 0]
+        curves[i][sids.searchsorted(pmap.sids)] = pmap.array[:, :, 0]
     out = p0.__class__.build(L, nstats, sids)
     for i, array in enumerate(compute_stats(curves, stats, weights)):
-        for j, sid in numpy.ndenumerate(sids):
-            out[sid].array[:, i] = array[j]
+        out.array[:, :, i] = array
     return out
 
 
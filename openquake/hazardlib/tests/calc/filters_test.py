@@ -17,13 +17,19 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import unittest
+import numpy
 from numpy.testing import assert_almost_equal as aae
 from openquake.baselib.general import gettemp
 from openquake.hazardlib import nrml
+from openquake.hazardlib.const import TRT
 from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.surface import PlanarSurface
 from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source.rupture import BaseRupture
+from openquake.hazardlib.contexts import get_distances
 from openquake.hazardlib.calc.filters import (
-    IntegrationDistance, MAX_DISTANCE, SourceFilter, angular_distance)
+    IntegrationDistance, MAX_DISTANCE, SourceFilter, angular_distance,
+    preselect)
 
 
 class AngularDistanceTestCase(unittest.TestCase):
@@ -50,6 +56,39 @@ class IntegrationDistanceTestCase(unittest.TestCase):
         aae(bb, [-2.7395804, 7.30204, 2.7395804, 12.69796])
 
 
+class PreselectTestCase(unittest.TestCase):
+    def setUp(self):
+        lons, lats = numpy.meshgrid(numpy.linspace(-5, 5, 51),
+                                    numpy.linspace(-5, 5, 51))
+        depths = numpy.linspace(-3, 1, lons.size)
+        self.sitecol = SiteCollection.from_points(
+            lons.flatten(), lats.flatten(), depths)
+
+    def rupture(self, top, bottom):
+        surface = PlanarSurface.from_corner_points(
+            Point(0, 0, top), Point(.5, .5, top),
+            Point(.7, .3, bottom), Point(.2, -.2, bottom))
+        return BaseRupture(6, 0, TRT.ACTIVE_SHALLOW_CRUST,
+                           Point(.3, .1, top), surface)
+
+    def test(self):
+        sites = self.sitecol.filtered(range(0, len(self.sitecol), 2))
+        for rup in (self.rupture(1, 20), self.rupture(300, 600)):
+            for dist in ('rrup', 'rjb'):
+                for maxdist in (10, 100, 400):
+                    for sc in (self.sitecol, sites):
+                        close, = (get_distances(rup, sc, dist) <= maxdist
+                                  ).nonzero()
+                        idx = preselect(sc, rup, maxdist, dist)
+                        # the candidates contain all the close sites
+                        self.assertEqual(
+                            len(numpy.setdiff1d(close, idx)), 0)
+                        self.assertLess(len(idx), len(sc))
+        # all sites are close
+        self.assertIsNone(preselect(
+            self.sitecol, self.rupture(1, 20), 2000, 'rjb'))
+
+
 class SourceFilterTestCase(unittest.TestCase):
     def test_get_bounding_boxes(self):
         maxdist = IntegrationDistance({'default': [
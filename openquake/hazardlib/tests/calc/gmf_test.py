@@ -0,0 +1,86 @@
+# The Hazard Library
+# Copyright (C) 2018 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import numpy
+from openquake.hazardlib.const import TRT
+from openquake.hazardlib.geo import Point, PlanarSurface
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.imt import PGA, SA
+from openquake.hazardlib.source.rupture import BaseRupture
+from openquake.hazardlib.gsim.boore_atkinson_2008 import BooreAtkinson2008
+from openquake.hazardlib.correlation import JB2009CorrelationModel
+from openquake.hazardlib.calc.gmf import ground_motion_fields
+
+aae = numpy.testing.assert_array_equal
+
+
+def make_rupture(lon):
+    surface = PlanarSurface.from_corner_points(
+        Point(lon, 0, 1), Point(lon + .1, 0, 1),
+        Point(lon + .1, 0, 10), Point(lon, 0, 10))
+    return BaseRupture(6, 0, TRT.ACTIVE_SHALLOW_CRUST,
+                       Point(lon + .05, 0, 5), surface)
+
+
+class GmfTestCase(unittest.TestCase):
+    sites = SiteCollection([Site(Point(.01 * i, .1), 760, True, 100, 1)
+                            for i in range(5)])
+    imts = [PGA(), SA(.1)]
+
+    def gmfs(self, rupture, seed, truncation_level=3, corr=None):
+        return ground_motion_fields(
+            rupture, self.sites, self.imts, BooreAtkinson2008(),
+            truncation_level, 4, corr, seed)
+
+    def test_independent_streams(self):
+        # the GMFs of a rupture depend only on its seed, not on the
+        # global random state nor on the ruptures computed before
+        rup1, rup2 = make_rupture(0), make_rupture(.1)
+        gmf1 = self.gmfs(rup1, 42)
+        gmf2 = self.gmfs(rup2, 43)
+        numpy.random.seed(1)
+        state = numpy.random.get_state()
+        gmf2b = self.gmfs(rup2, 43)  # computed in the reverse order
+        gmf1b = self.gmfs(rup1, 42)
+        for imt in self.imts:
+            aae(gmf1b[imt], gmf1[imt])
+            aae(gmf2b[imt], gmf2[imt])
+        # the global random state is untouched
+        self.assertEqual(numpy.random.get_state()[2], state[2])
+        aae(numpy.random.get_state()[1], state[1])
+
+    def test_global_seed(self):
+        # without a seed the GMFs can be reproduced by seeding numpy
+        rup = make_rupture(0)
+        numpy.random.seed(42)
+        gmf1 = self.gmfs(rup, None)
+        numpy.random.seed(42)
+        gmf2 = self.gmfs(rup, None)
+        for imt in self.imts:
+            aae(gmf1[imt], gmf2[imt])
+
+    def test_truncation(self):
+        rup = make_rupture(0)
+        mean = self.gmfs(rup, 42, truncation_level=0)
+        for imt in self.imts:
+            self.assertEqual(mean[imt].shape, (5, 4))
+            # without residuals all the events have the same ground motion
+            aae(mean[imt], mean[imt][:, [0]].repeat(4, axis=1))
+        for corr in (None, JB2009CorrelationModel(False)):
+            untruncated = self.gmfs(rup, 42, None, corr)
+            truncated = self.gmfs(rup, 42, 3, corr)
+            for imt in self.imts:
+                self.assertFalse((untruncated[imt] == truncated[imt]).all())
@@ -134,3 +134,33 @@ class JB2009ApplyCorrelationTestCase(unittest.TestCase):
         actual_corrcoef = cormo._get_correlation_matrix(self.SITECOL, PGA())
         numpy.testing.assert_almost_equal(inferred_corrcoef, actual_corrcoef,
                                           decimal=2)
+
+
+class JB2009NearestNeighboursTestCase(unittest.TestCase):
+    SITECOL = SiteCollection([
+        Site(Point(2 + .03 * (i % 7), -40 + .04 * (i // 7)), 1, True, 1, 1)
+        for i in range(40)])
+
+    def test_exact(self):
+        # with all the preceding sites as neighbours the approximation
+        # is exact, also for a subset of the sites
+        dense = JB2009CorrelationModel(vs30_clustering=False)
+        sparse = JB2009CorrelationModel(vs30_clustering=False,
+                                        tolerance=1E-12, max_neighbours=40)
+        residuals = numpy.random.RandomState(42).normal(size=(40, 5))
+        for imt in (PGA(), SA(period=1.)):
+            aaae(sparse.apply_correlation(self.SITECOL, imt, residuals),
+                 dense.apply_correlation(self.SITECOL, imt, residuals))
+        sites = self.SITECOL.filtered([3, 7, 8, 20])
+        aaae(sparse.apply_correlation(sites, PGA(), residuals[:4]),
+             dense.apply_correlation(sites, PGA(), residuals[:4]))
+
+    def test_approx(self):
+        cormo = JB2009CorrelationModel(vs30_clustering=False,
+                                       tolerance=.01, max_neighbours=10)
+        residuals = numpy.random.RandomState(42).normal(size=(40, 100000))
+        corr = cormo.apply_correlation(self.SITECOL, PGA(), residuals)
+        self.assertAlmostEqual(corr.std(), 1, delta=0.01)
+        actual_corrcoef = cormo._get_correlation_matrix(self.SITECOL, PGA())
+        numpy.testing.assert_allclose(
+            numpy.corrcoef(corr), actual_corrcoef, atol=.03)
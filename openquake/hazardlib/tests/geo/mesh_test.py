@@ -16,12 +16,14 @@
 import unittest
 import math
 
+import mock
 import numpy
+from scipy.spatial.distance import cdist
 
 from openquake.hazardlib.geo.point import Point
 from openquake.hazardlib.geo.polygon import Polygon
 from openquake.hazardlib.geo.mesh import Mesh, RectangularMesh
-from openquake.hazardlib.geo import utils as geo_utils
+from openquake.hazardlib.geo import utils as geo_utils, geodetic
 
 from openquake.hazardlib.tests import assert_angles_equal
 from openquake.hazardlib.tests.geo import _mesh_test_data
@@ -266,6 +268,26 @@ class MeshGetMinDistanceTestCase(unittest.TestCase):
                    expected_distance_indices=[3, 3, 3, 0, 0, 3, 3, 3, 3])
 
 
+class MeshGetMinDistanceKDTreeTestCase(MeshGetMinDistanceTestCase):
+    # the same tests, with the closest points found by using a KD-tree
+    def setUp(self):
+        patcher = mock.patch.object(geodetic, 'KDTREE_MIN_PAIRS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_as_distance_matrix(self):
+        rng = numpy.random.RandomState(42)
+        mesh = Mesh(rng.rand(30, 20), rng.rand(30, 20), rng.rand(30, 20))
+        target_mesh = Mesh(rng.rand(500) * 3 - 1, rng.rand(500) * 3 - 1)
+        dists = cdist(mesh.xyz, target_mesh.xyz)
+        aac(mesh.get_min_distance(target_mesh), dists.min(axis=0))
+        closest = mesh.get_closest_points(target_mesh)
+        idx = dists.argmin(axis=0)
+        numpy.testing.assert_equal(closest.lons, mesh.lons.flat[idx])
+        numpy.testing.assert_equal(closest.lats, mesh.lats.flat[idx])
+        numpy.testing.assert_equal(closest.depths, mesh.depths.flat[idx])
+
+
 class MeshGetDistanceMatrixTestCase(unittest.TestCase):
     def test_zeroes(self):
         mesh = Mesh(numpy.zeros(1000), numpy.zeros(1000), None)
@@ -240,3 +240,37 @@ class SurfacePropertiesTestCase(_BaseMultiTestCase):
                                            Point(0.0, -1.0, 10.0))])
         middle_point = surf.get_middle_point()
         self.assertTrue(Point(0.5, 0.0, 5.0) == middle_point)
+
+
+class PlanarDistancesTestCase(unittest.TestCase):
+    # when all the surfaces are planar the distances are computed with a
+    # PlanarSurfaceArray; they must agree with the surface by surface ones
+    def setUp(self):
+        self.surfaces = [
+            PlanarSurface(0, 90, Point(0, 0, 0), Point(0, .2, 0),
+                          Point(0, .2, 10), Point(0, 0, 10)),
+            PlanarSurface.from_corner_points(
+                Point(0, .2, 0), Point(.2, .3, 0),
+                Point(.25, .22, 10), Point(.05, .12, 10))]
+        self.mesh = Mesh(numpy.array([-.1, .1, .3, .5]),
+                         numpy.array([0, .2, .2, .6]), None)
+
+    def test_distances(self):
+        surf = MultiSurface(self.surfaces)
+        self.assertIsNotNone(surf.planar_array)
+        for meth in ('get_min_distance', 'get_joyner_boore_distance'):
+            expected = numpy.min([getattr(s, meth)(self.mesh)
+                                  for s in self.surfaces], axis=0)
+            numpy.testing.assert_allclose(
+                getattr(surf, meth)(self.mesh), expected)
+
+    def test_closest_points(self):
+        surf = MultiSurface(self.surfaces)
+        closest = surf.get_closest_points(self.mesh)
+        expected = [self.surfaces[0].get_closest_points(self.mesh),
+                    self.surfaces[1].get_closest_points(self.mesh)]
+        idx = numpy.argmin([s.get_min_distance(self.mesh)
+                            for s in self.surfaces], axis=0)
+        for i, j in enumerate(idx):
+            self.assertAlmostEqual(closest.lons[i], expected[j].lons[i])
+            self.assertAlmostEqual(closest.lats[i], expected[j].lats[i])
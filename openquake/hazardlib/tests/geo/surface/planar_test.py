@@ -20,7 +20,8 @@ import numpy
 from openquake.hazardlib.geo import Point
 from openquake.hazardlib.geo.mesh import Mesh
 from openquake.hazardlib.geo import utils as geo_utils
-from openquake.hazardlib.geo.surface.planar import PlanarSurface
+from openquake.hazardlib.geo.surface.planar import (
+    PlanarSurface, PlanarSurfaceArray)
 from openquake.hazardlib.tests.geo.surface import _planar_test_data as tdata
 
 aac = numpy.testing.assert_allclose
@@ -530,3 +531,36 @@ class PlanarSurfaceGetMiddlePointTestCase(unittest.TestCase):
         aac(midpoint.longitude, 0.0, atol=1E-4)
         aac(midpoint.latitude, 0.044966, atol=1E-4)
         aac(midpoint.depth, -4.0, atol=1E-4)
+
+
+class PlanarSurfaceArrayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.surfaces = [
+            PlanarSurface.from_corner_points(
+                Point(10, 45, 2), Point(10.2, 45.1, 2),
+                Point(10.25, 45.02, 12), Point(10.05, 44.92, 12)),
+            PlanarSurface(0, 90, Point(10, 45, 0), Point(10, 45.2, 0),
+                          Point(10, 45.2, 10), Point(10, 45, 10)),
+            PlanarSurface.from_corner_points(*tdata.TEST_7_RUPTURE_6_CORNERS)]
+        lons, lats = numpy.meshgrid(numpy.linspace(9.5, 10.5, 7),
+                                    numpy.linspace(44.5, 45.5, 5))
+        self.mesh = Mesh(lons, lats, numpy.zeros_like(lons))
+
+    def test_same_distances(self):
+        # the distances must be the same as computed surface by surface,
+        # also when the surfaces are processed in chunks
+        array = PlanarSurfaceArray.from_surfaces(self.surfaces)
+        for maxdist in (10 ** 5, 40):
+            array.MAX_DISTANCES = maxdist
+            for meth in ('get_min_distance', 'get_joyner_boore_distance',
+                         'get_rx_distance', 'get_ry0_distance'):
+                dists = getattr(array, meth)(self.mesh)
+                self.assertEqual(dists.shape, (3, 5, 7))
+                for surf, dist in zip(self.surfaces, dists):
+                    aac(dist.flatten(),
+                        getattr(surf, meth)(self.mesh).flatten(), atol=1E-9)
+
+    def test_unknown_distance(self):
+        array = PlanarSurfaceArray.from_surfaces(self.surfaces)
+        with self.assertRaises(ValueError):
+            array.get_distances(self.mesh, 'rhypo')
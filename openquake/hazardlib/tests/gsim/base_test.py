@@ -28,10 +28,26 @@ from openquake.hazardlib.gsim.base import (
     GMPE, IPE, CoeffsTable, SitesContext, RuptureContext, DistancesContext,
     NotVerifiedWarning, DeprecationWarning)
 from openquake.hazardlib.geo.point import Point
-from openquake.hazardlib.imt import PGA, PGV, SA
+from openquake.hazardlib.imt import PGA, PGV, SA, from_string
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.source.rupture import BaseRupture
 from openquake.hazardlib.gsim.base import ContextMaker
+from openquake.hazardlib.gsim.sadigh_1997 import SadighEtAl1997
+from openquake.hazardlib.gsim.abrahamson_silva_1997 import (
+    AbrahamsonSilva1997)
+from openquake.hazardlib.source import (
+    AreaSource, PointSource, SimpleFaultSource)
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.geo import (
+    NodalPlane, Polygon, PlanarSurface, Line)
+from openquake.hazardlib.contexts import DistanceCache, get_distances
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.baselib.general import DictArray
+from openquake.baselib.performance import Monitor
+from openquake.hazardlib.calc.filters import SourceFilter
+from openquake.hazardlib.calc.hazard_curve import classical
 
 aac = numpy.testing.assert_allclose
 
@@ -399,6 +415,261 @@ class ContextTestCase(unittest.TestCase):
         self.assertTrue(sctx1 != rctx)
 
 
+class RoundupTestCase(unittest.TestCase):
+    def test_no_aliasing(self):
+        # the roundup for a GSIM must not change the distances seen by
+        # the other GSIMs; this was the case in scenario/case_9, where
+        # the distances rounded up to 10 km were seen by a GSIM with
+        # minimum_distance=5
+        rrup = numpy.array([1., 7., 20.])
+        dctx = DistancesContext([('rrup', rrup)])
+        aac(dctx.roundup(10).rrup, [10., 10., 20.])
+        aac(dctx.roundup(5).rrup, [5., 7., 20.])
+        aac(rrup, [1., 7., 20.])
+        self.assertIs(dctx.roundup(0), dctx)
+
+
+class BlockContextsTestCase(unittest.TestCase):
+    def test_same_pnes(self):
+        # the poes computed on a block of ruptures must be the same as
+        # the ones computed rupture by rupture
+        sites = SiteCollection([
+            Site(Point(.1 * i, .05 * i), 760., True, 100., 5.)
+            for i in range(10)])
+        src = AreaSource(
+            '1', 'area', const.TRT.ACTIVE_SHALLOW_CRUST,
+            TruncatedGRMFD(5., 7., .5, 4., 1.), 2., WC1994(), 1.,
+            PoissonTOM(50.), 0., 20.,
+            PMF([(.5, NodalPlane(0, 90, 0)), (.5, NodalPlane(90, 60, 90))]),
+            PMF([(.5, 5.), (.5, 10.)]),
+            Polygon([Point(0, 0), Point(0, 1), Point(1, 1), Point(1, 0)]),
+            20.)
+        cmaker = ContextMaker([SadighEtAl1997(), AbrahamsonSilva1997()])
+        rups = list(src.iter_ruptures())
+        for rup in rups:
+            rup.sctx, rup.dctx = cmaker.make_contexts(sites, rup)
+        imtls = DictArray({'PGA': [.01, .1, .2], 'SA(0.1)': [.01, .1]})
+        blocks = list(cmaker.gen_rup_blocks(rups))
+        self.assertEqual(len(blocks), 8)  # 4 magnitudes x 2 nodal planes
+        self.assertEqual(sum(len(block) for block in blocks), len(rups))
+        for block in blocks:
+            pnes = list(cmaker._make_pnes(block, imtls, 3))
+            for rup, pne in zip(block, pnes):
+                [expected] = cmaker._make_pnes([rup], imtls, 3)
+                aac(pne, expected, rtol=1E-12)
+
+    def test_all_poes(self):
+        # get_all_poes must give the same results as get_poes IMT by IMT
+        sites = SiteCollection([
+            Site(Point(.1 * i, .05 * i), 760., True, 100., 5.)
+            for i in range(10)])
+        rup = BaseRupture(6., 0., const.TRT.ACTIVE_SHALLOW_CRUST,
+                          Point(.5, .5, 10.), PlanarSurface.from_corner_points(
+                              Point(.4, .5, 5.), Point(.6, .5, 5.),
+                              Point(.6, .5, 15.), Point(.4, .5, 15.)))
+        imtls = DictArray({'PGA': [.01, .1, .2], 'SA(0.1)': [.01, .1]})
+        for gsim in (SadighEtAl1997(), AbrahamsonSilva1997()):
+            sctx, dctx = ContextMaker([gsim]).make_contexts(sites, rup)
+            for trunclevel in (None, 0, 3):
+                expected = numpy.concatenate([
+                    gsim.get_poes(sctx, rup, dctx, from_string(imt),
+                                  imtls[imt], trunclevel)
+                    for imt in imtls], axis=1)
+                poes = gsim.get_all_poes(sctx, rup, dctx, imtls, trunclevel)
+                numpy.testing.assert_array_equal(poes, expected)
+
+    def test_mean_std_broadcast(self):
+        # GSIMs may return a constant stddev for some IMTs
+        def get_mean_and_stddevs(sctx, rctx, dctx, imt, stddev_types):
+            if imt == PGA():
+                return numpy.zeros(3), [numpy.array([.5])]
+            return numpy.ones(3), [.7]
+        gsim = SadighEtAl1997()
+        with mock.patch.object(gsim, 'get_mean_and_stddevs',
+                               get_mean_and_stddevs):
+            mean_std = gsim.get_mean_std(None, None, None, [PGA(), SA(.1)])
+        self.assertEqual(mean_std.shape, (2, 3, 2))
+        aac(mean_std[0], [[0, 1]] * 3)
+        aac(mean_std[1], [[.5, .7]] * 3)
+
+    def test_all_poes_total_stddev(self):
+        gsim = SadighEtAl1997()
+        gsim.DEFINED_FOR_STANDARD_DEVIATION_TYPES = set(
+            [const.StdDev.INTER_EVENT])
+        with self.assertRaises(AssertionError):
+            gsim.get_all_poes(None, None, None, DictArray({'PGA': [.1]}), 3)
+
+
+class TemplatedPoeMapTestCase(unittest.TestCase):
+    def test_same_pmap(self):
+        # the probability map computed from the translations of the
+        # reference ruptures must be the same as the one computed
+        # rupture by rupture
+        sites = SiteCollection([
+            Site(Point(.1 * i, .05 * i), 760., True, 100., 5.)
+            for i in range(10)])
+        src = AreaSource(
+            '1', 'area', const.TRT.ACTIVE_SHALLOW_CRUST,
+            TruncatedGRMFD(5., 7., .5, 4., 1.), 2., WC1994(), 1.,
+            PoissonTOM(50.), 0., 20.,
+            PMF([(.5, NodalPlane(0, 90, 0)), (.5, NodalPlane(90, 60, 90))]),
+            PMF([(.5, 5.), (.5, 10.)]),
+            Polygon([Point(0, 0), Point(0, 1), Point(1, 1), Point(1, 0)]),
+            20.)
+        imtls = DictArray({'PGA': [.01, .1, .2], 'SA(0.1)': [.01, .1]})
+        cmaker = ContextMaker([SadighEtAl1997(), AbrahamsonSilva1997()],
+                              lambda trt, mag: 50.)
+        self.assertTrue(cmaker.templated)
+        # use small blocks of translations
+        with mock.patch('openquake.hazardlib.contexts.'
+                        'MAX_TEMPLATED_DISTANCES', 25):
+            pmap = cmaker.poe_map(src, sites, imtls, 3)
+        cmaker.templated = False
+        expected = cmaker.poe_map(src, sites, imtls, 3)
+        self.assertEqual(pmap.eff_ruptures, expected.eff_ruptures)
+        self.assertEqual(sorted(pmap), sorted(expected))
+        for sid in expected:
+            aac(pmap[sid].array, expected[sid].array, rtol=1E-12)
+
+
+class CollapsedPoeMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sites = SiteCollection([
+            Site(Point(.2 * i, 0), 760., True, 100., 5.) for i in range(10)])
+        self.src = PointSource(
+            '1', 'point', const.TRT.ACTIVE_SHALLOW_CRUST,
+            TruncatedGRMFD(5., 7., .5, 4., 1.), 2., WC1994(), 1.,
+            PoissonTOM(50.), 0., 20., Point(0, 0),
+            PMF([(.3, NodalPlane(0, 90, 0)), (.3, NodalPlane(45, 60, 0)),
+                 (.4, NodalPlane(90, 60, 90))]),
+            PMF([(.5, 5.), (.5, 10.)]))
+        self.imtls = DictArray({'PGA': [.01, .1, .2], 'SA(0.1)': [.01, .1]})
+
+    def test_collapsed_source(self):
+        collapsed = self.src.get_collapsed_source()
+        self.assertEqual(self.src.count_ruptures(), 24)
+        self.assertEqual(collapsed.count_ruptures(), 8)
+        self.assertEqual(collapsed.nodal_plane_distribution.data,
+                         [(.6, NodalPlane(0, 90, 0)),
+                          (.4, NodalPlane(90, 60, 90))])
+        self.assertEqual(collapsed.hypocenter_distribution.data, [(1, 7.5)])
+        # the total rate is preserved
+        self.assertAlmostEqual(
+            sum(r.occurrence_rate for r in self.src.iter_ruptures()),
+            sum(r.occurrence_rate for r in collapsed.iter_ruptures()))
+
+    def test_collapsing_error(self):
+        cmaker = ContextMaker([SadighEtAl1997()], lambda trt, mag: 300.,
+                              pointsource_distance=50.)
+        pmap = cmaker.poe_map(self.src, self.sites, self.imtls, 3)
+        self.assertEqual(pmap.eff_ruptures, 24 + 8)
+        errors = cmaker.get_collapsing_error(
+            self.src, self.sites, self.imtls, 3)
+        # the sites within 50 km are computed exactly
+        aac(errors[:3], 0)
+        self.assertGreater(errors[3:].max(), 0)
+        self.assertLess(errors[3:].max(), .02)
+
+    def test_classical_task(self):
+        # the task reports the error on its first point source
+        self.src.src_group_id = 0
+        param = dict(imtls=self.imtls, filter_distance='rrup',
+                     pointsource_distance=50.)
+        res = classical([self.src], SourceFilter(self.sites, {}),
+                        [SadighEtAl1997()], param)
+        cmaker = ContextMaker([SadighEtAl1997()], pointsource_distance=50.)
+        errors = cmaker.get_collapsing_error(
+            self.src, self.sites, self.imtls, None)
+        self.assertEqual(res.collapsing_error, errors.max())
+        self.assertGreater(res.collapsing_error, 0)
+
+    def test_no_collapsing(self):
+        # with a large pointsource_distance the result is the exact one
+        cmaker = ContextMaker([SadighEtAl1997()], lambda trt, mag: 300.,
+                              pointsource_distance=1000.)
+        pmap = cmaker.poe_map(self.src, self.sites, self.imtls, 3)
+        cmaker.pointsource_distance = None
+        expected = cmaker.poe_map(self.src, self.sites, self.imtls, 3)
+        self.assertEqual(sorted(pmap), sorted(expected))
+        for sid in expected:
+            aac(pmap[sid].array, expected[sid].array)
+
+
+class DistanceCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sites = SiteCollection([
+            Site(Point(.1 * i, .05 * i), 760., True, 100., 5.)
+            for i in range(5)])
+        self.src = SimpleFaultSource(
+            'sf', 'fault', const.TRT.ACTIVE_SHALLOW_CRUST,
+            TruncatedGRMFD(5., 6.5, .5, 4., 1.), 2., WC1994(), 1.,
+            PoissonTOM(50.), 0., 15., Line([Point(0, 0), Point(.5, .1)]),
+            60., 90.)
+        self.imtls = DictArray({'PGA': [.01, .1, .2]})
+
+    def test_same_pmap(self):
+        gsims = [AbrahamsonSilva1997()]  # requires rrup and rjb
+        expected = ContextMaker(gsims, lambda trt, mag: 100.).poe_map(
+            self.src, self.sites, self.imtls, 3)
+        cache = DistanceCache(10 ** 6)
+        cmaker = ContextMaker(gsims, lambda trt, mag: 100.,
+                              distance_cache=cache)
+        for _ in range(2):  # the second time all the distances are cached
+            pmap = cmaker.poe_map(self.src, self.sites, self.imtls, 3)
+            self.assertEqual(sorted(pmap), sorted(expected))
+            for sid in expected:
+                aac(pmap[sid].array, expected[sid].array)
+        self.assertGreater(cache.hits, 0)
+        self.assertEqual(cache.hits, cache.misses)
+        self.assertEqual(cmaker.miss_mon.counts, cache.misses)
+
+    def test_eviction(self):
+        ruptures = list(self.src.iter_ruptures())[:10]
+        nbytes = len(self.sites) * 8  # the size of a distance array
+        cache = DistanceCache(3 * nbytes)
+        for rup in ruptures:
+            key = cache.get_key(rup, self.sites.sids, 'rrup')
+            self.assertIsNone(cache.get(key))
+            cache.add(key, get_distances(rup, self.sites, 'rrup'))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 3 * nbytes)
+        # only the last ruptures are still in the cache
+        for rup in ruptures[-3:]:
+            key = cache.get_key(rup, self.sites.sids, 'rrup')
+            aac(cache.get(key), get_distances(rup, self.sites, 'rrup'))
+        self.assertIsNone(cache.get(
+            cache.get_key(ruptures[0], self.sites.sids, 'rrup')))
+        self.assertEqual(cache.misses, 11)
+
+    def test_filtered_sites(self):
+        # the filtered site collections built for each rupture are new
+        # objects, but they hit the cache since the keys use the site IDs
+        rup = next(self.src.iter_ruptures())
+        cache = DistanceCache(10 ** 6)
+        cmaker = ContextMaker([AbrahamsonSilva1997()],
+                              distance_cache=cache)
+        sites = self.sites.filtered([1, 3])
+        cmaker.get_distances(rup, sites, 'rrup', sites.sids)
+        sites = self.sites.filtered([1, 3])
+        aac(cmaker.get_distances(rup, sites, 'rrup', sites.sids),
+            get_distances(rup, sites, 'rrup'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_monitor(self):
+        # the same source twice in a task, the second time all hits
+        self.src.src_group_id = 0
+        param = dict(imtls=self.imtls, filter_distance='rrup',
+                     distance_cache_size=1)
+        mon = Monitor()
+        classical([self.src, self.src], SourceFilter(self.sites, {}),
+                  [AbrahamsonSilva1997()], param, mon)
+        counts = {child.operation: child.counts for child in mon.children}
+        self.assertGreater(counts['distance cache misses'], 0)
+        self.assertEqual(counts['distance cache hits'],
+                         counts['distance cache misses'])
+
+
 class GsimInstantiationTestCase(unittest.TestCase):
     def test_deprecated(self):
         # check that a deprecation warning is raised when a deprecated
@@ -0,0 +1,97 @@
+# The Hazard Library
+# Copyright (C) 2018 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import pickle
+import unittest
+import numpy
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, ProbabilityCurve)
+
+aac = numpy.testing.assert_allclose
+
+
+class ProbabilityMapTestCase(unittest.TestCase):
+
+    def test_setdefault(self):
+        pmap = ProbabilityMap.build(2, 1, [5, 1], initvalue=.1)
+        pmap.setdefault(3, .2).array[0] = .3  # the curve is a view
+        pmap[0] = ProbabilityCurve(numpy.array([[.4], [.4]]))
+        self.assertEqual(list(pmap), [0, 1, 3, 5])
+        aac(pmap.array[:, :, 0], [[.4, .4], [.1, .1], [.3, .2], [.1, .1]])
+        del pmap[1]
+        self.assertEqual(list(pmap.sids), [0, 3, 5])
+        self.assertNotIn(1, pmap)
+
+    def test_or(self):
+        pmap1 = ProbabilityMap.build(2, 1, [0, 1], initvalue=.1)
+        pmap2 = ProbabilityMap.build(2, 1, [1, 2], initvalue=.2)
+        pmap = pmap1 | pmap2
+        self.assertEqual(list(pmap), [0, 1, 2])
+        aac(pmap.array[:, :, 0], [[.1, .1], [.28, .28], [.2, .2]])
+        # the operands are unchanged
+        aac(pmap1.array, .1)
+        aac(pmap2.array, .2)
+
+    def test_mul_and_invert(self):
+        pmap1 = ProbabilityMap.build(2, 1, [0, 1], initvalue=.5)
+        pmap2 = ProbabilityMap.build(2, 1, [1, 2], initvalue=.5)
+        pmap = pmap1 * pmap2
+        aac(pmap.array[:, :, 0], [[.5, .5], [.25, .25], [.5, .5]])
+        pmap[0].array[:] = 1.  # this curve is dropped by the complement
+        inv = ~pmap
+        self.assertEqual(list(inv), [1, 2])
+        aac(inv.array[:, :, 0], [[.75, .75], [.5, .5]])
+
+    def test_from_array(self):
+        array = numpy.array([[.1, .2], [.3, .4], [.5, .6]])
+        pmap = ProbabilityMap.from_array(array, [7, 2, 4])
+        self.assertEqual(list(pmap.sids), [2, 4, 7])
+        aac(pmap[7].array[:, 0], [.1, .2])
+        aac(pmap.filter([4, 7]).array[:, :, 0], [[.5, .6], [.1, .2]])
+
+    def test_duplicated_sids(self):
+        with self.assertRaises(ValueError):
+            ProbabilityMap.build(2, 1, [5, 1, 5])
+        with self.assertRaises(ValueError):
+            ProbabilityMap.from_array(numpy.zeros((2, 2)), [3, 3])
+
+    def test_curves_survive_reallocation(self):
+        pmap = ProbabilityMap.build(2, 1, [1, 5], initvalue=.1)
+        pc1 = pmap[1]
+        pc3 = pmap.setdefault(3, .2)
+        pmap[0] = ProbabilityCurve(numpy.array([[.4], [.4]]))
+        self.assertEqual(list(pmap.sids), [0, 1, 3, 5])  # consolidation
+        pmap |= ProbabilityMap.build(2, 1, [2, 6], initvalue=.5)
+        del pmap[5]
+        pc1.array[:] = .7
+        pc3.array[:] = .8
+        self.assertIs(pmap[1], pc1)
+        aac(pmap.array[:, :, 0], [[.4, .4], [.7, .7], [.5, .5],
+                                  [.8, .8], [.5, .5]])
+
+    def test_dict_compatibility(self):
+        pmap = ProbabilityMap.build(2, 1, [1, 5], initvalue=.1)
+        pmap.setdefault(3, .2)
+        self.assertIsInstance(pmap, dict)
+        self.assertEqual(sorted(dict(pmap)), [1, 3, 5])
+        new = pmap.copy()
+        new[1].array[:] = .9
+        aac(pmap[1].array, .1)  # the copy does not share the array
+        self.assertEqual(list(new), [1, 3, 5])
+        pmap2 = pickle.loads(pickle.dumps(pmap))
+        self.assertEqual(list(pmap2), [1, 3, 5])
+        aac(pmap2.array, pmap.array)
+        pmap2[1].array[:] = .3
+        aac(pmap2.array[0], .3)
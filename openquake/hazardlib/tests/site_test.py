@@ -17,6 +17,7 @@ import os
 import pickle
 import unittest
 import tempfile
+import mock
 
 import numpy
 from shapely import wkt
@@ -289,3 +290,24 @@ class SitePickleTestCase(unittest.TestCase):
         site1 = Site(point, 760.0, True, 100.0, 5.0)
         site2 = pickle.loads(pickle.dumps(site1))
         self.assertEqual(site1, site2)
+
+    def test_shared_collection(self):
+        sitecol = SiteCollection.from_points(
+            numpy.arange(1000.) / 100, numpy.zeros(1000))
+        filtered = sitecol.filtered([1, 3])
+        sitecol.share()
+        try:
+            size = len(pickle.dumps(sitecol))
+            self.assertLess(size, 500)  # only the handle is pickled
+            sc = pickle.loads(pickle.dumps(filtered))
+            self.assertEqual(list(sc.sids), [1, 3])
+            self.assertEqual(sc.complete, sitecol)
+            self.assertFalse(sc.complete.array.flags.writeable)
+            # the KD-tree is shipped with the collection, not rebuilt
+            with mock.patch('openquake.hazardlib.site.cKDTree') as ckdtree:
+                tree = sc.complete.kdtree
+            self.assertFalse(ckdtree.called)
+            self.assertEqual(tree.query_ball_point(tree.data[3], 1E-6), [3])
+        finally:
+            sitecol.shared.close()
+            sitecol.shared_kdtree.close()
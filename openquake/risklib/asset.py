@@ -240,7 +240,6 @@ U32 = numpy.uint32
 F32 = numpy.float32
 U64 = numpy.uint64
 TWO16 = 2 ** 16
-by_taxonomy = operator.attrgetter('taxonomy')
 
 
 class TagCollection(object):
@@ -380,12 +379,27 @@ class AssetCollection(object):
         :returns: dict tag -> asset ordinals
         """
         aids_by_tag = general.AccumDict(accum=set())
-        for aid, ass in enumerate(self):
-            for tagname, tagidx in zip(self.tagnames, ass.tagidxs):
+        for tagname in self.tagnames:
+            tagidxs = self.array[decode(tagname)]
+            aids = tagidxs.argsort(kind='mergesort')
+            uniq, starts = numpy.unique(tagidxs[aids], return_index=True)
+            for tagidx, group in zip(uniq, numpy.split(aids, starts[1:])):
                 tag = self.tagcol.get_tag(tagname, tagidx)
-                aids_by_tag[tag].add(aid)
+                aids_by_tag[tag] = set(group.tolist())
         return aids_by_tag
 
+    def agg_shape(self, aggregate_by):
+        """
+        :param aggregate_by: a list of tag names
+        :returns: the number of tag values for each tag name
+        """
+        unknown = set(aggregate_by) - set(map(decode, self.tagnames))
+        if unknown:
+            raise ValueError('Unknown tag names in aggregate_by: %s' %
+                             ' '.join(sorted(unknown)))
+        return tuple(len(getattr(self.tagcol, tagname))
+                     for tagname in aggregate_by)
+
     @property
     def taxonomies(self):
         """
@@ -410,14 +424,71 @@ class AssetCollection(object):
             lst.append(encode(unit))
         return numpy.array(lst)
 
+    def get_risk_array(self, aids=None):
+        """
+        :param aids: asset indices to consider (None means all)
+        :returns:
+            a composite array with fields ordinal, site_id, number, the
+            tags, the occupants and the columns value-<lt>, deductible-<lt>,
+            insurance_limit-<lt>, retrofitted, already computed by the cost
+            calculator; the deductibles and the insurance limits are
+            fractions of the asset values
+        """
+        if aids is None:
+            aids = numpy.arange(len(self.array), dtype=U32)
+        array = self.array[aids]
+        calc = self.cost_calculator
+        number, area = array['number'], array['area']
+        lts = [lt for lt in self.loss_types if lt != 'occupants']
+        values = {lt: array['value-' + lt] for lt in lts}
+        deducs = {name[self.D:]: array[name] for name in self.deduc}
+        limits = {name[self.I:]: array[name] for name in self.i_lim}
+        copied = ['site_id', 'number'] + [
+            decode(name) for name in self.tagnames] + [
+                name for name in array.dtype.names
+                if name.startswith('occupants_')]
+        dtlist = [('ordinal', U32)] + [
+            (name, array.dtype[name]) for name in copied] + [
+                ('value-' + lt, float) for lt in lts] + [
+                    (name, float) for name in self.deduc + self.i_lim +
+                    self.retro]
+        risk = numpy.zeros(len(array), dtlist)
+        risk['ordinal'] = aids
+        for name in copied:
+            risk[name] = array[name]
+        for lt in lts:
+            risk['value-' + lt] = calc(lt, values, area, number)
+        for name in self.deduc:
+            lt = name[self.D:]
+            val = calc(lt, deducs, area, number)
+            risk[name] = val / risk['value-' + lt] if calc.deduct_abs else val
+        for name in self.i_lim:
+            lt = name[self.I:]
+            val = calc(lt, limits, area, number)
+            risk[name] = val / risk['value-' + lt] if calc.limit_abs else val
+        if self.retro:
+            risk['retrofitted'] = calc(
+                'structural', {'structural': array['retrofitted']},
+                area, number)
+        return risk
+
     def assets_by_site(self):
         """
-        :returns: numpy array of lists with the assets by each site
+        :returns:
+            numpy array of composite arrays with the assets by each site,
+            as returned by :meth:`get_risk_array`
         """
-        assets_by_site = [[] for sid in range(self.tot_sites)]
-        for i, ass in enumerate(self.array):
-            assets_by_site[ass['site_id']].append(self[i])
-        return numpy.array(assets_by_site)
+        risk = self.get_risk_array()
+        # stable sort, so that the assets of a site are ordered by ordinal
+        risk = risk[risk['site_id'].argsort(kind='mergesort')]
+        assets_by_site = numpy.empty(self.tot_sites, object)
+        for sid in range(self.tot_sites):
+            assets_by_site[sid] = risk[:0]
+        sids, starts = numpy.unique(risk['site_id'], return_index=True)
+        stops = numpy.append(starts[1:], len(risk))
+        for sid, start, stop in zip(sids, starts, stops):
+            assets_by_site[sid] = risk[start:stop]
+        return assets_by_site
 
     def reduce(self, sitecol):
         """
@@ -458,14 +529,14 @@ class AssetCollection(object):
         :param aids: asset indices where to compute the values (None means all)
         :returns: a structured array of asset values by loss type
         """
-        if aids is None:
-            aids = range(len(self))
+        risk = self.get_risk_array(aids)
         loss_dt = numpy.dtype([(str(lt), F32) for lt in self.loss_types])
-        vals = numpy.zeros(len(aids), loss_dt)  # asset values by loss_type
-        for i, aid in enumerate(aids):
-            asset = self[aid]
-            for lt in self.loss_types:
-                vals[i][lt] = asset.value(lt, self.time_event)
+        vals = numpy.zeros(len(risk), loss_dt)  # asset values by loss_type
+        for lt in self.loss_types:
+            if lt == 'occupants':
+                vals[lt] = risk['occupants_' + str(self.time_event)]
+            else:
+                vals[lt] = risk['value-' + lt]
         return vals
 
     def __iter__(self):
@@ -530,80 +601,106 @@ class AssetCollection(object):
         return '<%s with %d asset(s)>' % (self.__class__.__name__, len(self))
 
 
+def get_agg_ids(assets, aggregate_by, shape):
+    """
+    :param assets: a composite array with the tag indices of the assets
+    :param aggregate_by: a list of tag names
+    :param shape: the number of tag values for each tag name
+    :returns: an array of aggregation IDs, one per asset, i.e. the
+              ordinals of the combinations of the tag indices
+    """
+    return numpy.ravel_multi_index(
+        [assets[tagname] for tagname in aggregate_by], shape)
+
+
 def build_asset_array(assets_by_site, tagnames=()):
     """
-    :param assets_by_site: a list of lists of assets
+    :param assets_by_site:
+        a list of composite arrays of assets, as returned by
+        :meth:`Exposure.get_mesh_assets_by_site`
     :param tagnames: a list of tag names
-    :param time_event: a time event string (or None)
-    :returns: an array `assetcol`
+    :returns: an array `assetcol` and the occupancy periods
     """
     for assets in assets_by_site:
         if len(assets):
-            first_asset = assets[0]
+            exposure_dt = assets.dtype
             break
     else:  # no break
         raise ValueError('There are no assets!')
-    loss_types = []
-    occupancy_periods = []
-    for name in sorted(first_asset.values):
-        if name.startswith('occupants_'):
-            period = name.split('_', 1)[1]
-            if period != 'None':
-                # see scenario_risk test_case_2d
-                occupancy_periods.append(period)
-            loss_types.append(name)
-            # discard occupants for different time periods
-        else:
-            loss_types.append('value-' + name)
-    deductible_d = first_asset.deductibles or {}
-    limit_d = first_asset.insurance_limits or {}
-    deductibles = ['deductible-%s' % name for name in deductible_d]
-    limits = ['insurance_limit-%s' % name for name in limit_d]
-    retro = ['retrofitted'] if first_asset._retrofitted else []
-    float_fields = loss_types + deductibles + limits + retro
-    int_fields = [(str(name), U16) for name in tagnames]
-    tagi = {str(name): i for i, name in enumerate(tagnames)}
+    float_fields = [name for name in exposure_dt.names
+                    if exposure_dt[name] == float and name not in (
+                        'lon', 'lat')]
+    # see scenario_risk test_case_2d for occupants_None
+    occupancy_periods = [name.split('_', 1)[1] for name in float_fields
+                         if name.startswith('occupants_') and
+                         name != 'occupants_None']
     asset_dt = numpy.dtype(
         [('lon', F32), ('lat', F32), ('site_id', U32),
          ('number', F32), ('area', F32)] + [
-             (str(name), float) for name in float_fields] + int_fields)
+             (name, float) for name in float_fields] + [
+                 (str(name), U16) for name in tagnames])
     num_assets = sum(len(assets) for assets in assets_by_site)
     assetcol = numpy.zeros(num_assets, asset_dt)
-    asset_ordinal = 0
-    fields = set(asset_dt.fields)
-    for sid, assets_ in enumerate(assets_by_site):
-        for asset in assets_:
-            asset.ordinal = asset_ordinal
-            record = assetcol[asset_ordinal]
-            asset_ordinal += 1
-            for field in fields:
-                if field == 'number':
-                    value = asset.number
-                elif field == 'area':
-                    value = asset.area
-                elif field == 'site_id':
-                    value = sid
-                elif field == 'lon':
-                    value = asset.location[0]
-                elif field == 'lat':
-                    value = asset.location[1]
-                elif field.startswith('occupants_'):
-                    value = asset.values[field]
-                elif field == 'retrofitted':
-                    value = asset._retrofitted
-                elif field in tagnames:
-                    value = asset.tagidxs[tagi[field]]
-                else:
-                    try:
-                        name, lt = field.split('-')
-                    except ValueError:  # no - in field
-                        name, lt = 'value', field
-                    # the line below retrieve one of `deductibles` or
-                    # `insurance_limits` ("s" suffix)
-                    value = getattr(asset, name + 's')[lt]
-                record[field] = value
+    start = 0
+    for sid, assets in enumerate(assets_by_site):
+        stop = start + len(assets)
+        if stop == start:
+            continue
+        for field in asset_dt.names:
+            if field == 'site_id':
+                assetcol[field][start:stop] = sid
+            else:
+                assetcol[field][start:stop] = assets[field]
+        start = stop
     return assetcol, ' '.join(occupancy_periods)
 
+
+def _get_exposure_dt(value_names, deductibles=(), limits=(),
+                     retrofitted=False, tagnames=()):
+    # the dtype of the arrays of assets read from the exposure
+    value_fields = [name if name.startswith('occupants_') else 'value-' + name
+                    for name in sorted(value_names)]
+    float_fields = value_fields + [
+        'deductible-%s' % name for name in deductibles] + [
+            'insurance_limit-%s' % name for name in limits] + (
+                ['retrofitted'] if retrofitted else [])
+    return numpy.dtype(
+        [('ordinal', U32), ('lon', float), ('lat', float),
+         ('number', F32), ('area', F32)] + [
+             (str(name), float) for name in float_fields] + [
+                 (str(name), U16) for name in tagnames])
+
+
+def _assets_to_array(assets, tagnames):
+    # convert a list of Asset objects into a composite array; the fields
+    # are determined by the first asset
+    first = assets[0]
+    dt = _get_exposure_dt(
+        first.values, first.deductibles or {}, first.insurance_limits or {},
+        first._retrofitted, tagnames)
+    array = numpy.zeros(len(assets), dt)
+    for asset, record in zip(assets, array):
+        for field in dt.names:
+            if field in ('ordinal', 'number', 'area'):
+                value = getattr(asset, field)
+            elif field == 'lon':
+                value = asset.location[0]
+            elif field == 'lat':
+                value = asset.location[1]
+            elif field.startswith('occupants_'):
+                value = asset.values[field]
+            elif field == 'retrofitted':
+                value = asset._retrofitted
+            elif field in tagnames:
+                value = asset.tagidxs[tagnames.index(field)]
+            else:
+                name, lt = field.split('-')
+                # the line below retrieve one of `values`, `deductibles` or
+                # `insurance_limits` ("s" suffix)
+                value = getattr(asset, name + 's')[lt]
+            record[field] = value
+    return array
+
 # ########################### exposure ############################ #
 
 cost_type_dt = numpy.dtype([('name', hdf5.vstr),
@@ -710,13 +807,14 @@ class Exposure(object):
               'deductible_is_absolute', 'retrofitted',
               'area', 'assets', 'asset_refs',
               'cost_calculator', 'tagcol']
+    csv_chunksize = 100000  # number of CSV rows converted in one go
 
     @classmethod
     def read(cls, fname, calculation_mode='', region_constraint='',
              ignore_missing_costs=(), asset_nodes=False):
         """
         Call `Exposure.read(fname)` to get an :class:`Exposure` instance
-        keeping all the assets in memory or
+        keeping all the assets in memory as a composite array or
         `Exposure.read(fname, asset_nodes=True)` to get an iterator over
         Node objects (one Node for each asset).
         """
@@ -731,18 +829,23 @@ class Exposure(object):
         exposure, assets = _get_exposure(param['fname'])
         param['relevant_cost_types'] = set(exposure.cost_types['name']) - set(
             ['occupants'])
-        nodes = assets if assets else exposure._read_csv(
-            assets.text, os.path.dirname(param['fname']))
+        dirname = os.path.dirname(param['fname'])
         if asset_nodes:  # this is useful for the GED4ALL import script
-            return nodes
-        exposure._populate_from(nodes, param)
+            return assets if assets else exposure._read_csv(
+                assets.text, dirname)
+        if assets:
+            exposure._populate_from(assets, param)
+        else:  # read the CSV files in chunks, without building nodes
+            exposure._populate_from_csv(assets.text, dirname, param)
         if param['region'] and param['out_of_region']:
             logging.info('Discarded %d assets outside the region',
                          param['out_of_region'])
         if len(exposure.assets) == 0:
             raise RuntimeError('Could not find any asset within the region!')
         # sanity checks
-        values = any(len(ass.values) + ass.number for ass in exposure.assets)
+        names = exposure.assets.dtype.names
+        values = any(name.startswith(('value-', 'occupants_'))
+                     for name in names) or exposure.assets['number'].any()
         assert values, 'Could not find any value??'
         return exposure
 
@@ -765,14 +868,12 @@ class Exposure(object):
         fields.extend(self.tagcol.tagnames)
         return set(fields)
 
-    def _read_csv(self, csvnames, dirname):
+    def _check_csv_header(self, fnames):
         """
-        :param csvnames: names of csv files, space separated
-        :param dirname: the directory where the csv files are
-        :yields: asset nodes
+        :param fnames: paths of the csv files
+        :raises: InvalidFile if a header is invalid
         """
         expected_header = self._csv_header()
-        fnames = [os.path.join(dirname, f) for f in csvnames.split()]
         for fname in fnames:
             with open(fname) as f:
                 fields = next(csv.reader(f))
@@ -785,6 +886,15 @@ class Exposure(object):
                     raise InvalidFile(
                         'Unexpected header in %s\nExpected: %s\nGot: %s' %
                         (fname, sorted(expected_header), sorted(header)))
+
+    def _read_csv(self, csvnames, dirname):
+        """
+        :param csvnames: names of csv files, space separated
+        :param dirname: the directory where the csv files are
+        :yields: asset nodes
+        """
+        fnames = [os.path.join(dirname, f) for f in csvnames.split()]
+        self._check_csv_header(fnames)
         occupancy_periods = self.occupancy_periods.split()
         for fname in fnames:
             with open(fname) as f:
@@ -817,14 +927,102 @@ class Exposure(object):
                             logging.info('Read %d assets', i)
                     yield asset
 
+    def _populate_from_csv(self, csvnames, dirname, param):
+        """
+        Convert the rows of the CSV files into composite arrays of assets,
+        `csv_chunksize` rows at the time, and populate .assets and
+        .asset_refs; the tags are added to the tag collection on the fly.
+
+        :param csvnames: names of csv files, space separated
+        :param dirname: the directory where the csv files are
+        :param param: a dictionary of parameters, as in `Exposure.read`
+        """
+        fnames = [os.path.join(dirname, f) for f in csvnames.split()]
+        self._check_csv_header(fnames)
+        occupancy_periods = self.occupancy_periods.split()
+        relevant_cost_types = sorted(param['relevant_cost_types'])
+        value_names = set(relevant_cost_types)
+        # calculators of 'damage' kind do not consider the number
+        # as the number of occupants
+        param['number_occupants'] = (
+            'damage' not in param['calculation_mode'] and
+            'occupants' in self.cost_types['name'])
+        if occupancy_periods or param['number_occupants']:
+            value_names.add('occupants_None')
+        for period in occupancy_periods:
+            value_names.add('occupants_' + period)
+        tagnames = self.tagcol.tagnames
+        dt = _get_exposure_dt(value_names, tagnames=tagnames)
+        value_fields = dt.names[5:len(dt.names) - len(tagnames)]
+        arrays = []
+        refs = []
+        rows = []
+        idx = 0
+        for fname in fnames:
+            with open(fname) as f:
+                for i, dic in enumerate(csv.DictReader(f), 1):
+                    with context(fname, Node('asset', lineno=i)):
+                        row = self._csv_row(
+                            idx, dic, relevant_cost_types, occupancy_periods,
+                            value_fields, param)
+                    refs.append(dic['id'].encode('utf8'))
+                    idx += 1
+                    if row is not None:
+                        rows.append(row)
+                    if len(refs) == self.csv_chunksize:
+                        arrays.append(numpy.array(rows, dt))
+                        self.asset_refs.append(numpy.array(refs))
+                        refs, rows = [], []
+                    if i % 100000 == 0:
+                        logging.info('Read %d assets', i)
+        arrays.append(numpy.array(rows, dt))
+        self.asset_refs.append(numpy.array(refs))
+        self.assets = numpy.concatenate(arrays)
+        self.asset_refs = numpy.concatenate(self.asset_refs)
+        # check for duplicated IDs
+        uniq, counts = numpy.unique(self.asset_refs, return_counts=True)
+        if (counts > 1).any():
+            raise nrml.DuplicatedID(decode(uniq[counts > 1][0]))
+
+    def _csv_row(self, idx, dic, cost_types, occupancy_periods,
+                 value_fields, param):
+        # convert a CSV row into a tuple of the exposure dtype, or None
+        # if the asset is outside the region
+        lon = valid.longitude(dic['lon'])
+        lat = valid.latitude(dic['lat'])
+        if param['region'] and not geometry.Point(lon, lat).within(
+                param['region']):
+            param['out_of_region'] += 1
+            return
+        number = valid.positivefloat(dic['number'])
+        values = {'value-' + ct: float(dic[ct]) for ct in cost_types}
+        if param['number_occupants']:
+            values['occupants_None'] = number
+        tot_occupants = 0
+        for period in occupancy_periods:
+            occupants = values['occupants_' + period] = float(dic[period])
+            tot_occupants += occupants
+        if occupancy_periods:  # store average occupants
+            values['occupants_None'] = tot_occupants / len(occupancy_periods)
+        tags = {tagname: dic[tagname] for tagname in self.tagcol.tagnames}
+        return (idx, lon, lat, number, float(dic.get('area', 1))) + tuple(
+            values[field] for field in value_fields) + tuple(
+                self.tagcol.add_tags(tags))
+
     def _populate_from(self, asset_nodes, param):
         asset_refs = set()
+        assets = []
         for idx, asset_node in enumerate(asset_nodes):
             asset_id = asset_node['id']
             if asset_id in asset_refs:
                 raise nrml.DuplicatedID(asset_id)
             asset_refs.add(asset_id)
-            self._add_asset(idx, asset_node, param)
+            asset = self._add_asset(idx, asset_node, param)
+            if asset is not None:
+                assets.append(asset)
+        self.assets = (_assets_to_array(assets, self.tagcol.tagnames)
+                       if assets else numpy.zeros(0, _get_exposure_dt(())))
+        self.asset_refs = numpy.array(self.asset_refs)
 
     def _add_asset(self, idx, asset_node, param):
         values = {}
@@ -910,19 +1108,27 @@ class Exposure(object):
         if occupancies:  # store average occupants
             values['occupants_None'] = tot_occupants / len(occupancies)
         area = float(asset_node.get('area', 1))
-        ass = Asset(idx, idxs, number, location, values, area,
-                    deductibles, insurance_limits, retrofitted,
-                    self.cost_calculator)
-        self.assets.append(ass)
+        return Asset(idx, idxs, number, location, values, area,
+                     deductibles, insurance_limits, retrofitted,
+                     self.cost_calculator)
 
     def get_mesh_assets_by_site(self):
         """
-        :returns: (Mesh instance, assets_by_site list)
+        :returns:
+            (Mesh instance, assets_by_site list), where the mesh contains the
+            distinct locations of the assets, ordered by longitude and
+            latitude, and assets_by_site a list of composite arrays
         """
-        assets_by_loc = general.groupby(self, key=lambda a: a.location)
-        mesh = geo.Mesh.from_coords(list(assets_by_loc))
-        assets_by_site = [
-            assets_by_loc[lonlat] for lonlat in zip(mesh.lons, mesh.lats)]
+        lonlats = numpy.zeros(len(self.assets), [('lon', float),
+                                                 ('lat', float)])
+        lonlats['lon'] = self.assets['lon']
+        lonlats['lat'] = self.assets['lat']
+        locations, inv = numpy.unique(lonlats, return_inverse=True)
+        mesh = geo.Mesh(locations['lon'], locations['lat'])
+        # the assets on the same location are kept in the original order
+        assets = self.assets[inv.argsort(kind='mergesort')]
+        assets_by_site = numpy.split(
+            assets, numpy.cumsum(numpy.bincount(inv))[:-1])
         return mesh, assets_by_site
 
     def __iter__(self):
@@ -16,14 +16,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
-import operator
 import logging
 import collections
 from urllib.parse import unquote_plus
 import numpy
 
 from openquake.baselib import hdf5, performance
-from openquake.baselib.general import groupby, AccumDict
+from openquake.baselib.general import AccumDict
 from openquake.risklib import scientific, riskmodels
 
 
@@ -33,10 +32,19 @@ class ValidationError(Exception):
 
 U32 = numpy.uint32
 F32 = numpy.float32
-by_taxonomy = operator.attrgetter('taxonomy')
 indices_dt = numpy.dtype([('start', U32), ('stop', U32)])
 
 
+def group_by_taxonomy(assets):
+    """
+    :param assets: a composite array of assets with a field taxonomy
+    :yields: pairs (taxonomy, assets) in order of taxonomy index
+    """
+    taxonomies = assets['taxonomy']
+    for taxonomy in numpy.unique(taxonomies):
+        yield taxonomy, assets[taxonomies == taxonomy]
+
+
 def read_composite_risk_model(dstore):
     """
     :param dstore: a DataStore instance
@@ -224,11 +232,10 @@ class CompositeRiskModel(collections.Mapping):
         sids = hazard_getter.sids
         # group the assets by taxonomy
         dic = collections.defaultdict(list)
+        epsgetter = riskinput.epsilon_getter
         for sid, assets in zip(sids, riskinput.assets_by_site):
-            group = groupby(assets, by_taxonomy)
-            for taxonomy in group:
-                epsgetter = riskinput.epsilon_getter
-                dic[taxonomy].append((sid, group[taxonomy], epsgetter))
+            for taxonomy, tassets in group_by_taxonomy(assets):
+                dic[taxonomy].append((sid, tassets, epsgetter))
         if hasattr(hazard_getter, 'rlzs_by_gsim'):
             # save memory in event based risk by working one gsim at the time
             for gsim in hazard_getter.rlzs_by_gsim:
@@ -300,22 +307,17 @@ class RiskInput(object):
     :param hazard_getter:
         a callable returning the hazard data for a given realization
     :param assets_by_site:
-        array of assets, one per site
+        array of composite arrays of assets, one per site
     :param eps_dict:
-        dictionary of epsilons (can be None)
+        dictionary of epsilons, or an :class:`EpsilonGetter` (can be None)
     """
     def __init__(self, hazard_getter, assets_by_site, eps_dict=None):
         self.hazard_getter = hazard_getter
         self.assets_by_site = assets_by_site
         self.eps = eps_dict or {}
-        taxonomies_set = set()
-        aids = []
-        for assets in self.assets_by_site:
-            for asset in assets:
-                taxonomies_set.add(asset.taxonomy)
-                aids.append(asset.ordinal)
-        self.aids = numpy.array(aids, numpy.uint32)
-        self.taxonomies = sorted(taxonomies_set)
+        assets = numpy.concatenate(assets_by_site)
+        self.aids = numpy.array(assets['ordinal'], numpy.uint32)
+        self.taxonomies = sorted(set(assets['taxonomy']))
         self.by_site = hazard_getter.__class__.__name__ != 'GmfGetter'
 
     @property
@@ -326,17 +328,26 @@ class RiskInput(object):
     def epsilon_getter(self, aid, eids):
         """
         :param aid: asset ordinal
-        :param eids: ignored
+        :param eids: an array of E event IDs
         :returns: an array of E epsilons
         """
-        if len(self.eps) == 0:
+        if not self.eps:
             return
+        elif isinstance(self.eps, EpsilonGetter):
+            return self.eps(aid, eids)
         eid2idx = self.hazard_getter.eid2idx
         idx = [eid2idx[eid] for eid in eids]
-        try:  # from ruptures
-            return self.eps[aid, idx]
-        except TypeError:  # from GMFs
-            return self.eps[aid][idx]
+        return self.eps[aid][idx]
+
+    def get_epsilons(self, aids, eids):
+        """
+        :param aids: an array of P asset ordinals
+        :param eids: an array of P event IDs
+        :returns: an array of P epsilons, or None if there are no epsilons
+        """
+        if not self.eps:
+            return
+        return self.eps(aids, eids)
 
     def __repr__(self):
         return '<%s taxonomy=%s, %d asset(s)>' % (
@@ -344,89 +355,35 @@ class RiskInput(object):
             ' '.join(map(str, self.taxonomies)), len(self.aids))
 
 
-class EpsilonMatrix0(object):
+class EpsilonGetter(object):
     """
-    Mock-up for a matrix of epsilons of size N x E,
-    used when asset_correlation=0.
+    Callable returning the epsilons of (asset, event) pairs, computed on
+    the fly with :func:`openquake.risklib.scientific.counter_epsilons`,
+    so that no matrix of assets x events is ever stored.
 
-    :param num_assets: N assets
-    :param seeds: E seeds, set before calling numpy.random.normal
+    :param master_seed: the seed of the epsilons
+    :param correlation: asset correlation (0 or 1); if 1 all the assets
+                        have the same epsilon for a given event
     """
-    def __init__(self, num_assets, seeds):
-        self.num_assets = num_assets
-        self.seeds = seeds
-        self.eps = None
+    def __init__(self, master_seed, correlation):
+        assert correlation in (0, 1), correlation
+        assert master_seed >= 0, master_seed
+        self.master_seed = master_seed
+        self.correlation = correlation
 
-    def make_eps(self):
+    def __call__(self, aids, eids):
         """
-        Builds a matrix of N x E epsilons
+        :param aids: an array of asset ordinals (or a single ordinal)
+        :param eids: an array of event IDs broadcastable with the aids
+        :returns: an array of float32 epsilons
         """
-        eps = numpy.zeros((self.num_assets, len(self.seeds)), F32)
-        for i, seed in enumerate(self.seeds):
-            numpy.random.seed(seed)
-            eps[:, i] = numpy.random.normal(size=self.num_assets)
-        return eps
-
-    def __getitem__(self, aid):
-        if self.eps is None:
-            self.eps = self.make_eps()
-        return self.eps[aid]
-
-    def __len__(self):
-        return self.num_assets
-
+        if self.correlation:  # the same epsilons for all assets
+            aids = numpy.zeros_like(aids)
+        return scientific.counter_epsilons(self.master_seed, aids, eids)
 
-class EpsilonMatrix1(object):
-    """
-    Mock-up for a matrix of epsilons of size N x E,
-    used when asset_correlation=1.
-
-    :param num_assets: number of assets
-    :param num_events: number of events
-    :param seed: seed used to generate E epsilons
-    """
-    def __init__(self, num_assets, num_events, seed):
-        self.num_assets = num_assets
-        self.num_events = num_events
-        self.seed = seed
-        numpy.random.seed(seed)
-        self.eps = numpy.random.normal(size=num_events)
-
-    def __getitem__(self, item):
-        if isinstance(item, tuple):
-            # item[0] is the asset index, item[1] the event index
-            # the epsilons are equal for all assets since asset_correlation=1
-            return self.eps[item[1]]
-        elif isinstance(item, int):  # item is an asset index
-            return self.eps
-        else:
-            raise TypeError('Invalid item %r' % item)
-
-    def __len__(self):
-        return self.num_assets
-
-
-def make_epsilon_getter(n_assets, n_events, correlation, master_seed, no_eps):
-    """
-    :returns: a function (start, stop) -> matrix of shape (n_assets, n_events)
-    """
-    assert n_assets > 0, n_assets
-    assert n_events > 0, n_events
-    assert correlation in (0, 1), correlation
-    assert master_seed >= 0, master_seed
-    assert no_eps in (True, False), no_eps
-    seeds = master_seed + numpy.arange(n_events)
-
-    def get_eps(start=0, stop=n_events):
-        if no_eps:
-            eps = None
-        elif correlation:
-            eps = EpsilonMatrix1(n_assets, stop - start, master_seed)
-        else:
-            eps = EpsilonMatrix0(n_assets, seeds[start:stop])
-        return eps
-
-    return get_eps
+    def __repr__(self):
+        return '<%s seed=%d, correlation=%d>' % (
+            self.__class__.__name__, self.master_seed, self.correlation)
 
 
 # used in scenario_risk
@@ -438,17 +395,15 @@ def make_eps(assetcol, num_samples, seed, correlation):
     :param float correlation: the correlation coefficient
     :returns: epsilons matrix of shape (num_assets, num_samples)
     """
-    assets_by_taxo = groupby(assetcol, by_taxonomy)
+    taxonomies = assetcol.taxonomies
     eps = numpy.zeros((len(assetcol), num_samples), numpy.float32)
-    for taxonomy, assets in assets_by_taxo.items():
+    for taxonomy in numpy.unique(taxonomies):
         # the association with the epsilons is done in order
-        assets.sort(key=operator.attrgetter('ordinal'))
-        shape = (len(assets), num_samples)
+        aids, = numpy.where(taxonomies == taxonomy)
+        shape = (len(aids), num_samples)
         logging.info('Building %s epsilons for taxonomy %s', shape, taxonomy)
         zeros = numpy.zeros(shape)
-        epsilons = scientific.make_epsilons(zeros, seed, correlation)
-        for asset, epsrow in zip(assets, epsilons):
-            eps[asset.ordinal] = epsrow
+        eps[aids] = scientific.make_epsilons(zeros, seed, correlation)
     return eps
 
 
@@ -158,11 +158,41 @@ def get_risk_models(oqparam, kind=None):
 
 def get_values(loss_type, assets, time_event=None):
     """
+    :param loss_type: the loss type
+    :param assets: a composite array of assets, as returned by
+        :meth:`openquake.risklib.asset.AssetCollection.get_risk_array`
+    :param time_event: the time event (used for the occupants)
     :returns:
         a numpy array with the values for the given assets, depending on the
         loss_type.
     """
-    return numpy.array([a.value(loss_type, time_event) for a in assets])
+    if loss_type == 'occupants':
+        return _get_column(assets, 'occupants_' + str(time_event))
+    return _get_column(assets, 'value-' + loss_type)
+
+
+def get_deductibles(loss_type, assets):
+    """
+    :returns:
+        a numpy array with the deductibles of the given assets, as
+        fractions of the asset values (NaN if missing)
+    """
+    return _get_column(assets, 'deductible-' + loss_type)
+
+
+def get_insurance_limits(loss_type, assets):
+    """
+    :returns:
+        a numpy array with the insurance limits of the given assets, as
+        fractions of the asset values (NaN if missing)
+    """
+    return _get_column(assets, 'insurance_limit-' + loss_type)
+
+
+def _get_column(assets, name):
+    if name in assets.dtype.names:
+        return assets[name]
+    return numpy.full(len(assets), numpy.nan)
 
 
 class RiskModel(object):
@@ -196,7 +226,7 @@ class RiskModel(object):
 
     def get_output(self, assets, data_by_lt, epsgetter):
         """
-        :param assets: a list of assets with the same taxonomy
+        :param assets: a composite array of assets with the same taxonomy
         :param data_by_lt: hazards for each loss type
         :param epsgetter: an epsilon getter function
         :returns: an ArrayWrapper of shape (L, ...)
@@ -279,8 +309,7 @@ class Classical(RiskModel):
         :param str loss_type:
             the loss type considered
         :param assets:
-            assets is an iterator over N
-            :class:`openquake.risklib.scientific.Asset` instances
+            a composite array of N assets
         :param hazard_curve:
             an array of poes
         :param _eps:
@@ -334,7 +363,8 @@ class ProbabilisticEventBased(RiskModel):
         :param str loss_type:
             the loss type considered
         :param assets:
-           a list of assets on the same site and with the same taxonomy
+           a composite array of assets on the same site and with the same
+           taxonomy
         :param gmvs_eids:
            a pair (gmvs, eids) with E values each
         :param epsgetter:
@@ -351,14 +381,70 @@ class ProbabilisticEventBased(RiskModel):
         loss_ratios = numpy.zeros((A, E, I), F32)
         vf = self.risk_functions[loss_type]
         means, covs, idxs = vf.interpolate(gmvs)
-        for i, asset in enumerate(assets):
-            epsilons = epsgetter(asset.ordinal, eids)
+        deductibles = get_deductibles(loss_type, assets)
+        limits = get_insurance_limits(loss_type, assets)
+        for i, aid in enumerate(assets['ordinal']):
+            epsilons = epsgetter(aid, eids)
             ratios = vf.sample(means, covs, idxs, epsilons)
             loss_ratios[i, idxs, 0] = ratios
             if self.insured_losses and loss_type != 'occupants':
                 loss_ratios[i, idxs, 1] = scientific.insured_losses(
-                    ratios,  asset.deductible(loss_type),
-                    asset.insurance_limit(loss_type))
+                    ratios, deductibles[i], limits[i])
+        return loss_ratios
+
+    def get_loss_ratios(self, loss_type, gmvs, blocks, gidx, epsilons,
+                        deductibles=None, limits=None):
+        """
+        Vectorized version of `__call__`, computing the loss ratios of
+        the assets of many sites in one go. The vulnerability function
+        is interpolated once on the ground motion values of all the sites
+        and the results are gathered on the (asset, event) pairs.
+
+        :param str loss_type:
+            the loss type considered
+        :param gmvs:
+            an array of G ground motion values, site by site
+        :param blocks:
+            a list of slices over the gmvs, one per site
+        :param gidx:
+            an array of P indices over the gmvs, one per (asset, event) pair
+        :param epsilons:
+            an array of P epsilons or None
+        :param deductibles:
+            an array of P deductibles, used only for the insured losses
+        :param limits:
+            an array of P insurance limits, used only for the insured losses
+        :returns:
+            an array of shape (P, I) of loss ratios
+        """
+        I = self.insured_losses + 1
+        loss_ratios = numpy.zeros((len(gidx), I), F32)
+        vf = self.risk_functions[loss_type]
+        pmf = isinstance(vf, scientific.VulnerabilityFunctionWithPMF)
+        if pmf or epsilons is None:
+            # the ratios depend only on the ground motion values; the PMF
+            # sampling depends on the event ordinal, so it is done by site
+            ratios = numpy.zeros(len(gmvs))
+            overmin = numpy.zeros(len(gmvs), bool)
+            for block in (blocks if pmf else [slice(None)]):
+                means, covs, idxs = vf.interpolate(gmvs[block])
+                rat = numpy.zeros(len(idxs))
+                rat[idxs] = vf.sample(means, covs, idxs, None)
+                ratios[block] = rat
+                overmin[block] = idxs
+            ratios = ratios[gidx]
+            ok = overmin[gidx]
+        else:
+            means, covs, idxs = vf.interpolate(gmvs)
+            pos = numpy.cumsum(idxs) - 1  # position in the means array
+            ok = idxs[gidx]
+            sel = pos[gidx[ok]]
+            ratios = numpy.zeros(len(gidx))
+            ratios[ok] = vf.sample(means[sel], covs[sel], ok, epsilons)
+        loss_ratios[:, 0] = ratios
+        if self.insured_losses and loss_type != 'occupants':
+            loss_ratios[ok, 1] = scientific.insured_losses(
+                ratios[ok], deductibles[ok], limits[ok])
         return loss_ratios
 
 
@@ -386,7 +472,7 @@ class ClassicalBCR(RiskModel):
     def __call__(self, loss_type, assets, hazard, _eps=None, _eids=None):
         """
         :param loss_type: the loss type
-        :param assets: a list of N assets of the same taxonomy
+        :param assets: a composite array of N assets of the same taxonomy
         :param hazard: an hazard curve
         :param _eps: dummy parameter, unused
         :param _eids: dummy parameter, unused
@@ -403,8 +489,9 @@ class ClassicalBCR(RiskModel):
                                         steps=self.lrem_steps_per_interval)
         curves_retro = functools.partial(scientific.classical, vf_retro, imls,
                                          steps=self.lrem_steps_per_interval)
-        original_loss_curves = utils.numpy_map(curves_orig, [hazard] * n)
-        retrofitted_loss_curves = utils.numpy_map(curves_retro, [hazard] * n)
+        # the curves are the same for all the assets on the site
+        original_loss_curves = numpy.array([curves_orig(hazard)] * n)
+        retrofitted_loss_curves = numpy.array([curves_retro(hazard)] * n)
 
         eal_original = utils.numpy_map(
             scientific.average_loss, original_loss_curves)
@@ -412,12 +499,14 @@ class ClassicalBCR(RiskModel):
         eal_retrofitted = utils.numpy_map(
             scientific.average_loss, retrofitted_loss_curves)
 
+        values = get_values(loss_type, assets)
         bcr_results = [
             scientific.bcr(
                 eal_original[i], eal_retrofitted[i],
                 self.interest_rate, self.asset_life_expectancy,
-                asset.value(loss_type), asset.retrofitted())
-            for i, asset in enumerate(assets)]
+                values[i], retrofitted)
+            for i, retrofitted in enumerate(
+                _get_column(assets, 'retrofitted'))]
         return list(zip(eal_original, eal_retrofitted, bcr_results))
 
 
@@ -437,7 +526,8 @@ class Scenario(RiskModel):
 
     def __call__(self, loss_type, assets, gmvs_eids, epsgetter):
         gmvs, eids = gmvs_eids
-        epsilons = [epsgetter(asset.ordinal, eids) for asset in assets]
+        epsilons = numpy.array(
+            [epsgetter(aid, eids) for aid in assets['ordinal']])
         values = get_values(loss_type, assets, self.time_event)
         ok = ~numpy.isnan(values)
         if not ok.any():
@@ -448,6 +538,7 @@ class Scenario(RiskModel):
         if missing_value:
             assets = assets[ok]
             epsilons = epsilons[ok]
+            values = values[ok]
 
         E = len(epsilons[0])
         I = self.insured_losses + 1
@@ -459,13 +550,12 @@ class Scenario(RiskModel):
         vf = self.risk_functions[loss_type]
         means, covs, idxs = vf.interpolate(gmvs)
         loss_ratio_matrix = numpy.zeros((len(assets), E))
-        for i, eps in enumerate(epsilons):
-            loss_ratio_matrix[i, idxs] = vf.sample(means, covs, idxs, eps)
+        loss_ratio_matrix[:, idxs] = vf.sample(means, covs, idxs, epsilons)
         loss_matrix[:, :, 0] = (loss_ratio_matrix.T * values).T
 
         if self.insured_losses and loss_type != "occupants":
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_deductibles(loss_type, assets)
+            limits = get_insurance_limits(loss_type, assets)
             insured_loss_ratio_matrix = utils.numpy_map(
                 scientific.insured_losses, loss_ratio_matrix,
                 deductibles, limits)
@@ -489,7 +579,7 @@ class Damage(RiskModel):
     def __call__(self, loss_type, assets, gmvs_eids, _eps=None):
         """
         :param loss_type: the loss type
-        :param assets: a list of N assets of the same taxonomy
+        :param assets: a composite array of N assets of the same taxonomy
         :param gmvs_eids: pairs (gmvs, eids), each one with E elements
         :param _eps: dummy parameter, unused
         :returns: N arrays of E x D elements
@@ -497,10 +587,19 @@ class Damage(RiskModel):
         where N is the number of points, E the number of events
         and D the number of damage states.
         """
+        damages = self.get_fractions(loss_type, gmvs_eids[0])  # shape (D, E)
+        return [damages.T] * len(assets)
+
+    def get_fractions(self, loss_type, gmvs):
+        """
+        :param loss_type: the loss type
+        :param gmvs: an array of ground motion values of any shape
+        :returns: an array of damage fractions of shape (D,) + gmvs.shape
+        """
         ffs = self.risk_functions[loss_type]
-        damages = scientific.scenario_damage(ffs, gmvs_eids[0])  # shape (D, E)
+        damages = scientific.scenario_damage(ffs, gmvs)
         damages[damages < 1E-7] = 0  # sanity check
-        return [damages.T] * len(assets)
+        return damages
 
 
 @registry.add('classical_damage')
@@ -524,7 +623,7 @@ class ClassicalDamage(Damage):
     def __call__(self, loss_type, assets, hazard_curve, _eps=None):
         """
         :param loss_type: the loss type
-        :param assets: a list of N assets of the same taxonomy
+        :param assets: a composite array of N assets of the same taxonomy
         :param hazard_curve: an hazard curve array
         :returns: an array of N assets and an array of N x D elements
 
@@ -536,7 +635,7 @@ class ClassicalDamage(Damage):
             ffl, hazard_imls, hazard_curve,
             investigation_time=self.investigation_time,
             risk_investigation_time=self.risk_investigation_time)
-        return [a.number * damage for a in assets]
+        return [number * damage for number in assets['number']]
 
 
 # NB: the approach used here relies on the convention of having the
@@ -27,14 +27,16 @@ import collections
 
 import numpy
 from numpy.testing import assert_equal
-from scipy import interpolate, stats, random
+from scipy import interpolate, stats, special
 
 from openquake.baselib.general import CallableDict, group_array
 from openquake.hazardlib.stats import compute_stats2
 from openquake.risklib import utils
 
 F32 = numpy.float32
+U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 
 
 def fine_graining(points, steps):
@@ -61,6 +63,30 @@ def fine_graining(points, steps):
                             for x, y in utils.pairwise(points)])
     return numpy.concatenate([ls, [points[-1]]])
 
+
+def _slopes(xp, fp):
+    """
+    :param xp: an array of L increasing breakpoints
+    :param fp: an array of values of shape (L, M)
+    :returns: the slopes of the segments, of shape (L - 1, M)
+    """
+    return numpy.diff(fp, axis=0) / numpy.diff(xp)[:, None]
+
+
+def _interp(x, xp, fp, slopes):
+    """
+    Stateless linear interpolation of many functions on precomputed
+    breakpoints, giving the same numbers as `scipy.interpolate.interp1d`.
+
+    :param x: an array of E points with xp[0] <= x <= xp[-1]
+    :param xp: an array of L increasing breakpoints
+    :param fp: an array of values of shape (L, M)
+    :param slopes: the output of `_slopes(xp, fp)`
+    :returns: an array of shape (E, M)
+    """
+    lo = numpy.searchsorted(xp, x).clip(1, len(xp) - 1) - 1
+    return slopes[lo] * (x - xp[lo])[:, None] + fp[lo]
+
 #
 # Input models
 #
@@ -68,6 +94,7 @@ def fine_graining(points, steps):
 
 class VulnerabilityFunction(object):
     dtype = numpy.dtype([('iml', F32), ('loss_ratio', F32), ('cov', F32)])
+    seed = None  # set in CompositeRiskModel.__init__, used by BT sampling
 
     def __init__(self, vf_id, imt, imls, mean_loss_ratios, covs=None,
                  distribution="LN"):
@@ -117,23 +144,16 @@ class VulnerabilityFunction(object):
         self.distribution_name = distribution
 
         # to be set in .init(), called also by __setstate__
-        (self.stddevs, self._mlr_i1d, self._covs_i1d,
-         self.distribution) = None, None, None, None
+        (self.stddevs, self.distribution) = None, None
         self.init()
 
     def init(self):
         self.stddevs = self.covs * self.mean_loss_ratios
-        self._mlr_i1d = interpolate.interp1d(self.imls, self.mean_loss_ratios)
-        self._covs_i1d = interpolate.interp1d(self.imls, self.covs)
-        self.set_distribution(None)
-
-    def set_distribution(self, epsilons=None):
+        # the distribution is stateless, so it can be shared across threads
         if (self.covs > 0).any():
             self.distribution = DISTRIBUTIONS[self.distribution_name]()
         else:
             self.distribution = DegenerateDistribution()
-        self.distribution.epsilons = (numpy.array(epsilons)
-                                      if epsilons is not None else None)
 
     def interpolate(self, gmvs):
         """
@@ -143,11 +163,11 @@ class VulnerabilityFunction(object):
            (interpolated loss ratios, interpolated covs, indices > min)
         """
         # gmvs are clipped to max(iml)
-        gmvs_curve = numpy.piecewise(
-            gmvs, [gmvs > self.imls[-1]], [self.imls[-1], lambda x: x])
+        gmvs_curve = numpy.minimum(gmvs, self.imls[-1])
         idxs = gmvs_curve >= self.imls[0]  # indices over the minimum
         gmvs_curve = gmvs_curve[idxs]
-        return self._mlr_i1d(gmvs_curve), self._cov_for(gmvs_curve), idxs
+        mlrs = numpy.interp(gmvs_curve, self.imls, self.mean_loss_ratios)
+        return mlrs, self._cov_for(gmvs_curve), idxs
 
     def sample(self, means, covs, idxs, epsilons):
         """
@@ -161,14 +181,15 @@ class VulnerabilityFunction(object):
         :param idxs:
            array of E booleans with E >= E'
         :param epsilons:
-           array of E floats
+           array of E floats, or a matrix of shape (A, E)
         :returns:
-           array of E' loss ratios
+           array of E' loss ratios, or a matrix of shape (A, E')
         """
         if epsilons is None:
             return means
-        self.set_distribution(epsilons)
-        return self.distribution.sample(means, covs, means * covs, idxs)
+        eps = numpy.asarray(epsilons)[..., idxs]
+        return self.distribution.sample(means, covs, means * covs, eps,
+                                        self.seed)
 
     # this is used in the tests, not in the engine code base
     def __call__(self, gmvs, epsilons):
@@ -238,15 +259,12 @@ class VulnerabilityFunction(object):
         [0.0049, 0.006, 0.027], the clipped imls are
         [0.005,  0.006, 0.0269].
         """
-        return self._covs_i1d(
-            numpy.piecewise(
-                imls,
-                [imls > self.imls[-1], imls < self.imls[0]],
-                [self.imls[-1], self.imls[0], lambda x: x]))
+        imls = numpy.clip(imls, self.imls[0], self.imls[-1])
+        return numpy.interp(imls, self.imls, self.covs)
 
     def __getstate__(self):
         return (self.id, self.imt, self.imls, self.mean_loss_ratios,
-                self.covs, self.distribution_name)
+                self.covs, self.distribution_name, self.seed)
 
     def __setstate__(self, state):
         self.id = state[0]
@@ -255,6 +273,7 @@ class VulnerabilityFunction(object):
         self.mean_loss_ratios = state[3]
         self.covs = state[4]
         self.distribution_name = state[5]
+        self.seed = state[6]
         self.init()
 
     def _check_vulnerability_data(self, imls, loss_ratios, covs, distribution):
@@ -341,14 +360,14 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
         self.id = vf_id
         self.imt = imt
         self._check_vulnerability_data(imls, loss_ratios, probs)
-        self.imls = imls
+        self.imls = numpy.array(imls)
         self.loss_ratios = loss_ratios
         self.probs = probs
         self.seed = seed
         self.distribution_name = "PM"
 
         # to be set in .init(), called also by __setstate__
-        (self._probs_i1d, self.distribution) = None, None
+        (self._probs_slopes, self.distribution) = None, None
         self.init()
 
         ls = [('iml', F32)] + [('prob-%s' % lr, F32) for lr in loss_ratios]
@@ -356,13 +375,8 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
 
     def init(self):
         # the seed is reset in CompositeRiskModel.__init__
-        self._probs_i1d = interpolate.interp1d(self.imls, self.probs)
-        self.set_distribution(None)
-
-    def set_distribution(self, epsilons=None):
+        self._probs_slopes = _slopes(self.imls, self.probs.T)
         self.distribution = DISTRIBUTIONS[self.distribution_name]()
-        self.distribution.epsilons = epsilons
-        self.distribution.seed = self.seed
 
     def __getstate__(self):
         return (self.id, self.imt, self.imls, self.loss_ratios,
@@ -393,11 +407,12 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
            (interpolated probabilities, None, indices > min)
         """
         # gmvs are clipped to max(iml)
-        gmvs_curve = numpy.piecewise(
-            gmvs, [gmvs > self.imls[-1]], [self.imls[-1], lambda x: x])
+        gmvs_curve = numpy.minimum(gmvs, self.imls[-1])
         idxs = gmvs_curve >= self.imls[0]  # indices over the minimum
         gmvs_curve = gmvs_curve[idxs]
-        return self._probs_i1d(gmvs_curve), None, idxs
+        probs = _interp(gmvs_curve, self.imls, self.probs.T,
+                        self._probs_slopes)
+        return probs.T, None, idxs
 
     def sample(self, probs, _covs, idxs, epsilons):
         """
@@ -414,8 +429,7 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
         :returns:
            array of E' probabilities
         """
-        self.set_distribution(epsilons)
-        return self.distribution.sample(self.loss_ratios, probs)
+        return self.distribution.sample(self.loss_ratios, probs, self.seed)
 
     @utils.memoized
     def loss_ratio_exceedance_matrix(self, steps):
@@ -734,12 +748,14 @@ class Distribution(metaclass=abc.ABCMeta):
     """
 
     @abc.abstractmethod
-    def sample(self, means, covs, stddevs, idxs):
+    def sample(self, means, covs, stddevs, epsilons, seed=None):
         """
         :returns: sample a set of losses
         :param means: an array of mean losses
         :param covs: an array of covariances
         :param stddevs: an array of stddevs
+        :param epsilons: an array of epsilons broadcastable to the means
+        :param seed: used by the distributions not based on the epsilons
         """
         raise NotImplementedError
 
@@ -757,7 +773,7 @@ class DegenerateDistribution(Distribution):
     The degenerate distribution. E.g. a distribution with a delta
     corresponding to the mean.
     """
-    def sample(self, means, _covs, _stddev, _idxs):
+    def sample(self, means, _covs, _stddev, _epsilons, _seed=None):
         return means
 
     def survival(self, loss_ratio, mean, _stddev):
@@ -765,6 +781,40 @@ class DegenerateDistribution(Distribution):
             loss_ratio, [loss_ratio > mean or not mean], [0, 1])
 
 
+def _splitmix64(z):
+    # the finalizer of the SplitMix64 generator, on arrays of uint64;
+    # numpy wraps around on overflow, which is what we want here
+    z = z + U64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> U64(30))) * U64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> U64(27))) * U64(0x94D049BB133111EB)
+    return z ^ (z >> U64(31))
+
+
+def counter_epsilons(seed, aids, eids):
+    """
+    Counter-based generation of standard normal epsilons: the epsilon
+    of the pair (aid, eid) is a hash of the seed, of the asset ordinal and
+    of the event ID, so it does not depend on the other pairs, nor on the
+    order of the calls, nor on the global random state.
+
+    :param seed: a non-negative integer
+    :param aids: an array of asset ordinals
+    :param eids: an array of event IDs, broadcastable with the aids
+    :returns: an array of float32 epsilons with the broadcast shape
+
+    >>> counter_epsilons(42, [0, 1, 0], [7, 7, 7])
+    array([-0.42631668, -0.77326196, -0.42631668], dtype=float32)
+    """
+    aids, eids = numpy.broadcast_arrays(
+        numpy.array(aids, U64, ndmin=1), numpy.array(eids, U64, ndmin=1))
+    z = _splitmix64(numpy.full(aids.shape, seed, U64))
+    z = _splitmix64(z ^ eids)
+    z = _splitmix64(z ^ aids)
+    # the 53 most significant bits give a uniform number in (0, 1)
+    uniform = ((z >> U64(11)).astype(float) + .5) / 2. ** 53
+    return special.ndtri(uniform).astype(F32)
+
+
 def make_epsilons(matrix, seed, correlation):
     """
     Given a matrix N * R returns a matrix of the same shape N * R
@@ -790,21 +840,13 @@ def make_epsilons(matrix, seed, correlation):
 class LogNormalDistribution(Distribution):
     """
     Model a distribution of a random variable whoose logarithm are
-    normally distributed.
-
-    :attr epsilons: An array of random numbers generated with
-                    :func:`numpy.random.multivariate_normal` with size E
+    normally distributed. The epsilons are passed to `.sample`, typically
+    generated with :func:`numpy.random.multivariate_normal`.
     """
-    def __init__(self, epsilons=None):
-        self.epsilons = epsilons
-
-    def sample(self, means, covs, _stddevs, idxs):
-        if self.epsilons is None:
-            raise ValueError("A LogNormalDistribution must be initialized "
-                             "before you can use it")
-        eps = self.epsilons[idxs]
+    def sample(self, means, covs, _stddevs, epsilons, _seed=None):
         sigma = numpy.sqrt(numpy.log(covs ** 2.0 + 1.0))
-        probs = means / numpy.sqrt(1 + covs ** 2) * numpy.exp(eps * sigma)
+        probs = means / numpy.sqrt(1 + covs ** 2) * numpy.exp(
+            epsilons * sigma)
         return probs
 
     def survival(self, loss_ratio, mean, stddev):
@@ -825,10 +867,25 @@ class LogNormalDistribution(Distribution):
 
 @DISTRIBUTIONS.add('BT')
 class BetaDistribution(Distribution):
-    def sample(self, means, _covs, stddevs, _idxs=None):
+    def sample(self, means, _covs, stddevs, epsilons=None, seed=None):
+        """
+        :param means: an array of mean loss ratios
+        :param _covs: ignored, it is there only for API consistency
+        :param stddevs: an array of stddevs
+        :param epsilons: not used, but they fix the shape of the output
+        :param seed: a seed or a RandomState; if None, use the global state
+        :returns: an array of loss ratios
+        """
         alpha = self._alpha(means, stddevs)
         beta = self._beta(means, stddevs)
-        return numpy.random.beta(alpha, beta, size=None)
+        size = None if epsilons is None else numpy.shape(epsilons)
+        if seed is None:
+            rng = numpy.random
+        elif isinstance(seed, numpy.random.RandomState):
+            rng = seed
+        else:  # using a RandomState keeps the global state intact
+            rng = numpy.random.RandomState(seed)
+        return rng.beta(alpha, beta, size=size)
 
     def survival(self, loss_ratio, mean, stddev):
         return stats.beta.sf(loss_ratio,
@@ -846,17 +903,24 @@ class BetaDistribution(Distribution):
 
 @DISTRIBUTIONS.add('PM')
 class DiscreteDistribution(Distribution):
-    seed = None  # to be set
-
-    def sample(self, loss_ratios, probs):
-        ret = []
-        r = numpy.arange(len(loss_ratios))
-        for i in range(probs.shape[1]):
-            random.seed(self.seed + i)
-            # the seed is set inside the loop to avoid block-size dependency
-            pmf = stats.rv_discrete(name='pmf', values=(r, probs[:, i])).rvs()
-            ret.append(loss_ratios[pmf])
-        return ret
+
+    def sample(self, loss_ratios, probs, seed):
+        """
+        :param loss_ratios: an array of M loss ratios
+        :param probs: a matrix of probabilities of shape (M, E)
+        :param seed: the seed of the first column
+        :returns: an array of E loss ratios
+        """
+        # the seed depends on the column to avoid block-size dependency;
+        # using a RandomState for each column keeps the global state intact
+        rnd = numpy.array([numpy.random.RandomState(seed + i).random_sample()
+                           for i in range(probs.shape[1])])
+        # this is searchsorted(cumsum, rnd, 'right') on each column; the
+        # indices are clipped since, because of rounding, the cumulative
+        # sum can be slightly smaller than 1 and smaller than rnd
+        cumsum = numpy.cumsum(probs, axis=0)
+        idxs = numpy.minimum((cumsum <= rnd).sum(axis=0), len(cumsum) - 1)
+        return numpy.asarray(loss_ratios)[idxs]
 
     def survival(self, loss_ratios, probs):
         """
@@ -887,15 +951,20 @@ CurveParams = collections.namedtuple(
 def scenario_damage(fragility_functions, gmvs):
     """
     :param fragility_functions: a list of D - 1 fragility functions
-    :param gmvs: an array of E ground motion values
-    :returns: an array of (D, E) damage fractions
+    :param gmvs: an array of E ground motion values (or of any shape)
+    :returns: an array of (D, E) damage fractions (or of shape (D,) + shape)
     """
-    lst = [numpy.ones_like(gmvs)]
+    gmvs = numpy.asarray(gmvs)
+    # the fragility functions are evaluated only once for each distinct
+    # ground motion value and the results are used as a lookup table
+    ugmvs, inv = numpy.unique(gmvs, return_inverse=True)
+    lst = [numpy.ones_like(ugmvs)]
     for f, ff in enumerate(fragility_functions):  # D - 1 functions
-        lst.append(ff(gmvs))
-    lst.append(numpy.zeros_like(gmvs))
-    # convert a (D + 1, E) array into a (D, E) array
-    return pairwise_diff(numpy.array(lst))
+        lst.append(ff(ugmvs))
+    lst.append(numpy.zeros_like(ugmvs))
+    # convert a (D + 1, U) array into a (D, U) array
+    table = pairwise_diff(numpy.array(lst))
+    return table[:, inv].reshape((len(table),) + gmvs.shape)
 
 #
 # Classical Damage
@@ -962,6 +1031,65 @@ def classical_damage(
 #
 
 
+# LRU cache (vulnerability function, hazard IMLs, steps) -> (loss ratios,
+# kernel) shared by all the tasks running in the same process; it is bounded
+# since the workers can be reused by many calculations
+MAX_CLASSICAL_KERNELS = 256
+_classical_kernels = collections.OrderedDict()
+
+
+def classical_kernel(vulnerability_function, hazard_imls, steps=10):
+    """
+    The loss curve computed by :func:`classical` depends linearly on the
+    hazard curve, through a matrix (the kernel) which depends only on the
+    vulnerability function, on the hazard IMLs and on the number of steps.
+    The kernel is computed once and cached; the least recently used
+    kernels are discarded when there are more than MAX_CLASSICAL_KERNELS.
+
+    :param vulnerability_function:
+        an instance of
+        :py:class:`openquake.risklib.scientific.VulnerabilityFunction`
+    :param hazard_imls:
+        the I hazard intensity measure levels
+    :param int steps:
+        Number of steps between loss ratios.
+    :returns:
+        an array of C loss ratios and a kernel of shape (C, I)
+    """
+    vf = vulnerability_function
+    hazard_imls = numpy.array(hazard_imls, float)
+    key = (vf.id, vf.imt, vf.distribution_name, vf.imls.tobytes(),
+           vf.mean_loss_ratios.tobytes(), vf.covs.tobytes(),
+           hazard_imls.tobytes(), steps)
+    try:
+        _classical_kernels.move_to_end(key)
+    except KeyError:
+        pass
+    else:
+        return _classical_kernels[key]
+    loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(steps)
+
+    # saturate imls to hazard imls
+    imls = numpy.clip(vf.mean_imls(), hazard_imls[0], hazard_imls[-1])
+
+    # matrix of shape (len(imls), I) interpolating the hazard curve
+    idx = numpy.searchsorted(hazard_imls, imls, 'right').clip(
+        1, len(hazard_imls) - 1)
+    lo, hi = hazard_imls[idx - 1], hazard_imls[idx]
+    weights = (imls - lo) / (hi - lo)
+    interp = numpy.zeros((len(imls), len(hazard_imls)))
+    rows = numpy.arange(len(imls))
+    interp[rows, idx - 1] = 1. - weights
+    interp[rows, idx] += weights
+
+    # the poos are the pairwise differences of the interpolated poes
+    kernel = lrem.dot(pairwise_diff(interp))
+    _classical_kernels[key] = loss_ratios, kernel
+    if len(_classical_kernels) > MAX_CLASSICAL_KERNELS:
+        _classical_kernels.popitem(last=False)
+    return loss_ratios, kernel
+
+
 def classical(vulnerability_function, hazard_imls, hazard_poes, steps=10):
     """
     :param vulnerability_function:
@@ -977,24 +1105,32 @@ def classical(vulnerability_function, hazard_imls, hazard_poes, steps=10):
     """
     assert len(hazard_imls) == len(hazard_poes), (
         len(hazard_imls), len(hazard_poes))
-    vf = vulnerability_function
-    imls = vf.mean_imls()
-    loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(steps)
+    loss_ratios, kernel = classical_kernel(
+        vulnerability_function, hazard_imls, steps)
+    return numpy.array([loss_ratios, kernel.dot(hazard_poes)])
 
-    # saturate imls to hazard imls
-    min_val, max_val = hazard_imls[0], hazard_imls[-1]
-    numpy.putmask(imls, imls < min_val, min_val)
-    numpy.putmask(imls, imls > max_val, max_val)
 
-    # interpolate the hazard curve
-    poes = interpolate.interp1d(hazard_imls, hazard_poes)(imls)
+def classical_curves(vulnerability_function, hazard_imls, hazard_curves,
+                     steps=10):
+    """
+    Vectorized version of :func:`classical`, computing the loss curves
+    for a block of hazard curves with a single matrix product.
 
-    # compute the poos
-    pos = pairwise_diff(poes)
-    lrem_po = numpy.empty(lrem.shape)
-    for idx, po in enumerate(pos):
-        lrem_po[:, idx] = lrem[:, idx] * po  # column * po
-    return numpy.array([loss_ratios, lrem_po.sum(axis=1)])
+    :param vulnerability_function:
+        an instance of
+        :py:class:`openquake.risklib.scientific.VulnerabilityFunction`
+    :param hazard_imls:
+        the I hazard intensity measure levels
+    :param hazard_curves:
+        an array of shape (S, I) with S hazard curves
+    :param int steps:
+        Number of steps between loss ratios.
+    :returns:
+        an array of C loss ratios and an array of poes of shape (S, C)
+    """
+    loss_ratios, kernel = classical_kernel(
+        vulnerability_function, hazard_imls, steps)
+    return loss_ratios, numpy.dot(hazard_curves, kernel.T)
 
 
 def conditional_loss_ratio(loss_ratios, poes, probability):
@@ -1054,8 +1190,11 @@ def conditional_loss_ratio(loss_ratios, poes, probability):
 def insured_losses(losses, deductible, insured_limit):
     """
     :param losses: an array of ground-up loss ratios
-    :param float deductible: the deductible limit in fraction form
-    :param float insured_limit: the insured limit in fraction form
+    :param deductible: the deductible limit in fraction form
+    :param insured_limit: the insured limit in fraction form
+
+    The deductible and the insured limit can be floats or arrays
+    broadcastable to the shape of `losses`.
 
     Compute insured losses for the given asset and losses, from the point
     of view of the insurance company. For instance:
@@ -1067,10 +1206,9 @@ def insured_losses(losses, deductible, insured_limit):
     - if the loss is 20 the company pays 20 - 5 = 15
     - if the loss is 101 the company pays 100 - 5 = 95
     """
-    return numpy.piecewise(
-        losses,
-        [losses < deductible, losses > insured_limit],
-        [0, insured_limit - deductible, lambda x: x - deductible])
+    return numpy.where(
+        losses > insured_limit, insured_limit - deductible,
+        numpy.where(losses < deductible, 0, losses - deductible))
 
 
 def insured_loss_curve(curve, deductible, insured_limit):
@@ -1141,6 +1279,42 @@ def mean_std(fractions):
     return numpy.mean(fractions, axis=0), numpy.std(fractions, axis=0, ddof=1)
 
 
+class RunningStats(object):
+    """
+    Mean and standard deviation (with ddof=1) of a stream of observations,
+    updated block by block with the parallel version of Welford's
+    algorithm, so that the observations do not need to be kept in memory.
+
+    :param shape: the shape of a single observation
+    """
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = numpy.zeros(shape)
+        self.m2 = numpy.zeros(shape)  # sum of the squared deviations
+
+    def update(self, block):
+        """
+        :param block: an array of observations, of shape (B,) + shape
+        """
+        n = len(block)
+        if n == 0:
+            return
+        mean = block.mean(axis=0)
+        m2 = ((block - mean) ** 2).sum(axis=0)
+        delta = mean - self.mean
+        tot = self.n + n
+        self.mean += delta * n / tot
+        self.m2 += m2 + delta ** 2 * self.n * n / tot
+        self.n = tot
+
+    def get(self):
+        """
+        :returns: the arrays mean and stddev, as :func:`mean_std` would do
+        """
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return self.mean, numpy.sqrt(self.m2 / (self.n - 1))
+
+
 def loss_maps(curves, conditional_loss_poes):
     """
     :param curves: an array of loss curves
@@ -1312,6 +1486,92 @@ def losses_by_period(losses, return_periods, num_events, eff_time):
     return curve
 
 
+def num_top_losses(return_periods, eff_time):
+    """
+    :param return_periods: return periods of interest
+    :param eff_time: investigation_time * ses_per_logic_tree_path
+    :returns: how many of the largest losses are needed by
+              :func:`losses_by_period` for the given return periods
+
+    >>> num_top_losses([30, 60, 120], 500)
+    18
+    """
+    return int(eff_time / min(return_periods)) + 2
+
+
+def top_losses(keys, losses, k):
+    """
+    Extract the largest `k` losses for each key. Since the top losses of
+    a set of losses are the top losses of the union of the top losses of
+    its subsets, the results can be merged.
+
+    :param keys: an array of N integer keys, possibly repeated
+    :param losses: an array of N non-negative losses
+    :param k: the number of losses to keep for each key
+    :returns: the U unique keys and an array of shape (U, k) with the
+              largest losses for each key, in ascending order and padded
+              with zeros
+
+    >>> keys, top = top_losses([1, 0, 1, 1, 0], [.1, .5, .3, .2, .4], 2)
+    >>> keys
+    array([0, 1])
+    >>> top
+    array([[0.4, 0.5],
+           [0.2, 0.3]])
+    """
+    keys = numpy.asarray(keys)
+    losses = numpy.asarray(losses)
+    ukeys, inv = numpy.unique(keys, return_inverse=True)
+    idx = numpy.lexsort((-losses, inv))  # by key and decreasing loss
+    inv, losses = inv[idx], losses[idx]
+    rank = numpy.arange(len(inv)) - numpy.searchsorted(inv, inv)
+    ok = rank < k
+    top = numpy.zeros((len(ukeys), k), losses.dtype)
+    top[inv[ok], k - 1 - rank[ok]] = losses[ok]
+    return ukeys, top
+
+
+def agg_loss_table(eids, rlzs, agg_ids, lis, losses, LI):
+    """
+    Sum the losses with the same event, realization and aggregation ID.
+
+    :param eids: an array of N event IDs
+    :param rlzs: an array of N realization indices
+    :param agg_ids: an array of N aggregation IDs
+    :param lis: an array of N loss type indices in the range 0..LI-1
+    :param losses: an array of N losses
+    :param LI: the number of loss type indices
+    :returns: a composite array with fields eid, rlzi, agg_id, loss
+              (a vector of LI losses) with a row for each distinct triple
+              (eid, rlzi, agg_id), ordered by triple
+
+    >>> agg_loss_table([1, 0, 1, 1], [0, 0, 0, 0], [3, 3, 3, 2],
+    ...                [0, 0, 1, 0], [.1, .2, .3, .4], 2)['loss']
+    array([[0.2, 0. ],
+           [0.4, 0. ],
+           [0.1, 0.3]], dtype=float32)
+    """
+    dt = numpy.dtype([('eid', U64), ('rlzi', U16), ('agg_id', U32),
+                      ('loss', (F32, (LI,)))])
+    if len(losses) == 0:
+        return numpy.zeros(0, dt)
+    eids, rlzs, agg_ids = map(numpy.asarray, (eids, rlzs, agg_ids))
+    idx = numpy.lexsort((agg_ids, rlzs, eids))
+    eids, rlzs, agg_ids = eids[idx], rlzs[idx], agg_ids[idx]
+    new = numpy.ones(len(idx), bool)
+    new[1:] = ((eids[1:] != eids[:-1]) | (rlzs[1:] != rlzs[:-1]) |
+               (agg_ids[1:] != agg_ids[:-1]))
+    rows = numpy.cumsum(new) - 1  # ordinal of the triple
+    table = numpy.zeros(rows[-1] + 1, dt)
+    table['eid'] = eids[new]
+    table['rlzi'] = rlzs[new]
+    table['agg_id'] = agg_ids[new]
+    table['loss'] = numpy.bincount(
+        rows * LI + numpy.asarray(lis)[idx],
+        numpy.asarray(losses)[idx], len(table) * LI).reshape(-1, LI)
+    return table
+
+
 class LossesByPeriodBuilder(object):
     """
     Build losses by period for all loss types at the same time.
@@ -1365,6 +1625,31 @@ class LossesByPeriodBuilder(object):
                         self.num_events[r], self.eff_time)
         return self.pair(array, stats)
 
+    # used in the EbrPostCalculator when the top losses are available
+    def build_top(self, asset_values, top_losses, stats=()):
+        """
+        :param asset_values: a list of asset values
+        :param top_losses: an array of shape (A, R, K, LI) with the largest
+                           loss ratios in ascending order
+        :param stats: list of pairs [(statname, statfunc), ...]
+        :returns: two composite arrays of shape (A, R, P) and (A, S, P)
+        """
+        A, R, K, LI = top_losses.shape
+        P = len(self.return_periods)
+        array = numpy.zeros((A, R, P), self.loss_dt)
+        for a, asset_value in enumerate(asset_values):
+            for r in range(R):
+                # there cannot be more nonzero losses than events
+                top = top_losses[a, r, max(K - self.num_events[r], 0):]
+                if not top.any():  # no loss ratios > 0 for the given asset
+                    continue
+                for li, lt in enumerate(self.loss_dt.names):
+                    aval = asset_value[lt.replace('_ins', '')]
+                    array[a, r][lt] = aval * losses_by_period(
+                        top[:, li], self.return_periods,
+                        self.num_events[r], self.eff_time)
+        return self.pair(array, stats)
+
     # used in the LossCurvesExporter
     def build_rlz(self, asset_values, loss_ratios, rlzi):
         """
@@ -192,3 +192,34 @@ class ClassicalTestCase(unittest.TestCase):
         for loss, poe in expected_curve:
             numpy.testing.assert_allclose(
                 poe, actual_poes_interp(loss), atol=0.005)
+
+    def test_classical_curves(self):
+        # the curves for a block of hazard curves are computed with the
+        # cached kernel and are the same as the curves computed one by one
+        hazard_imls = [0.01, 0.08, 0.17, 0.26, 0.36, 0.55, 0.7]
+        hazard_curves = numpy.array([
+            [0.99, 0.96, 0.89, 0.82, 0.7, 0.4, 0.01],
+            [0.9, 0.8, 0.5, 0.3, 0.2, 0.1, 0.]])
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+            [0.5, 0.3, 0.2, 0.1], "LN")
+        ratios, poes = scientific.classical_curves(
+            vf, hazard_imls, hazard_curves, 2)
+        for hcurve, curve_poes in zip(hazard_curves, poes):
+            # reference implementation interpolating the hazard curve
+            imls = numpy.clip(vf.mean_imls(), 0.01, 0.7)
+            pos = -numpy.diff(interp1d(hazard_imls, hcurve)(imls))
+            _, lrem = vf.loss_ratio_exceedance_matrix(2)
+            numpy.testing.assert_allclose(curve_poes, lrem.dot(pos))
+            numpy.testing.assert_allclose(
+                scientific.classical(vf, hazard_imls, hcurve, 2),
+                [ratios, curve_poes])
+
+    def test_classical_kernels_bounded(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+            [0.5, 0.3, 0.2, 0.1], "LN")
+        maxsize = scientific.MAX_CLASSICAL_KERNELS
+        for i in range(maxsize + 10):
+            scientific.classical_kernel(vf, [0.01, 0.1 + i / 1000., 0.7], 2)
+        self.assertEqual(len(scientific._classical_kernels), maxsize)
@@ -24,7 +24,7 @@ import numpy
 from numpy.testing import assert_almost_equal
 from openquake.baselib.general import gettemp
 from openquake.hazardlib import InvalidFile, nrml
-from openquake.risklib import riskmodels
+from openquake.risklib import riskmodels, scientific
 from openquake.qa_tests_data.scenario_damage import case_4b
 
 FF_DIR = os.path.dirname(case_4b.__file__)
@@ -294,3 +294,36 @@ lossCategory="contents">
             nrml.to_python(self.wrong_csq_model_3)
         self.assertIn("node params: Expected 'ds3', got 'ds4', line 12",
                       str(ctx.exception))
+
+
+class ProbabilisticEventBasedTestCase(unittest.TestCase):
+
+    def test_vectorized_loss_ratios(self):
+        # computing the loss ratios of two sites in one go must give
+        # the same results as computing them asset by asset
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [.1, .2, .4], [.05, .2, .6], [.3, .3, .3], 'LN')
+        rm = riskmodels.ProbabilisticEventBased(
+            'tax', {'structural': vf}, [], insured_losses=True)
+        gmvs = numpy.array([.05, .15, .3, .5, .12, .25], numpy.float32)
+        eps = numpy.random.RandomState(42).normal(size=(3, 6))
+        assets = numpy.zeros(3, [('ordinal', numpy.uint32),
+                                 ('deductible-structural', float),
+                                 ('insurance_limit-structural', float)])
+        assets['ordinal'] = range(3)
+        assets['deductible-structural'] = .05
+        assets['insurance_limit-structural'] = .4
+        # asset 0 is on the first site (events 0..3), assets 1 and 2 are
+        # on the second site (events 4 and 5)
+        expected = [rm('structural', assets[:1], (gmvs[:4], None),
+                       lambda aid, eids: eps[aid, :4])[0],
+                    rm('structural', assets[1:], (gmvs[4:], None),
+                       lambda aid, eids: eps[aid, 4:])]
+        apos = numpy.array([0, 0, 0, 0, 1, 1, 2, 2])
+        gidx = numpy.array([0, 1, 2, 3, 4, 5, 4, 5])
+        ratios = rm.get_loss_ratios(
+            'structural', gmvs, [slice(0, 4), slice(4, 6)], gidx,
+            eps[apos, gidx], numpy.repeat(.05, 8), numpy.repeat(.4, 8))
+        numpy.testing.assert_equal(ratios[:4], expected[0])
+        numpy.testing.assert_equal(ratios[4:6], expected[1][0])
+        numpy.testing.assert_equal(ratios[6:], expected[1][1])
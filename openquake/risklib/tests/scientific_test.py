@@ -53,6 +53,22 @@ class BetaDistributionTestCase(unittest.TestCase):
             [0.057241368], scientific.BetaDistribution().sample(
                 numpy.array([0.1]), None, numpy.array([0.1])))
 
+    def test_sample_seed(self):
+        means, stddevs = numpy.array([.1, .2]), numpy.array([.1, .1])
+        dist = scientific.BetaDistribution()
+        eps = numpy.zeros((3, 2))
+        numpy.random.seed(0)
+        state = numpy.random.get_state()
+        ratios = dist.sample(means, None, stddevs, eps, 42)
+        self.assertEqual(ratios.shape, (3, 2))
+        # the global random state is untouched
+        numpy.testing.assert_array_equal(
+            numpy.random.get_state()[1], state[1])
+        numpy.testing.assert_array_equal(
+            dist.sample(means, None, stddevs, eps, 42), ratios)
+        numpy.testing.assert_array_equal(dist.sample(
+            means, None, stddevs, eps, numpy.random.RandomState(42)), ratios)
+
 
 class TestMemoize(unittest.TestCase):
     def test_cache(self):
@@ -196,6 +212,21 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
         numpy.testing.assert_allclose(
             expected_covs, self.test_func._cov_for(test_input))
 
+    def test_sample_is_stateless(self):
+        # sampling does not change the function, so that a function can be
+        # shared by many threads with different epsilons
+        means, covs, idxs = self.test_func.interpolate(
+            numpy.array([0.006, 0.0269]))
+        eps1, eps2 = numpy.array([1., 1.]), numpy.array([-1., -1.])
+        ratios1 = self.test_func.sample(means, covs, idxs, eps1)
+        ratios2 = self.test_func.sample(means, covs, idxs, eps2)
+        numpy.testing.assert_allclose(
+            ratios1, self.test_func.sample(means, covs, idxs, eps1))
+        # a matrix of epsilons gives a matrix of loss ratios
+        numpy.testing.assert_allclose(
+            [ratios1, ratios2], self.test_func.sample(
+                means, covs, idxs, numpy.array([eps1, eps2])))
+
     def test_vuln_func_constructor_raises_on_invalid_lr_cov(self):
         # If a loss ratio is 0.0 and the corresponding CoV is > 0.0, we expect
         # a ValueError.
@@ -337,12 +368,10 @@ class LogNormalDistributionTestCase(unittest.TestCase):
         epsilons = scientific.make_epsilons(
             numpy.zeros((assets_num, samples_num)),
             seed=17, correlation=correlation)
-        self.dist = scientific.LogNormalDistribution(epsilons)
 
         tol = 0.1
         for a1, a2 in utils.pairwise(range(assets_num)):
-            coeffs = numpy.corrcoef(
-                self.dist.epsilons[a1, :], self.dist.epsilons[a2, :])
+            coeffs = numpy.corrcoef(epsilons[a1, :], epsilons[a2, :])
 
             numpy.testing.assert_allclose([1, 1], [coeffs[0, 0], coeffs[1, 1]])
             numpy.testing.assert_allclose(
@@ -359,13 +388,97 @@ class LogNormalDistributionTestCase(unittest.TestCase):
         epsilons = scientific.make_epsilons(
             numpy.zeros((assets_num, samples_num)),
             seed=17, correlation=correlation)
-        self.dist = scientific.LogNormalDistribution(epsilons)
+        self.dist = scientific.LogNormalDistribution()
         samples = self.dist.sample(numpy.array([0., 0., .1, .1]),
                                    numpy.array([0., .1, 0., .1]),
-                                   None, slice(None)).reshape(-1)
+                                   None, epsilons).reshape(-1)
         numpy.testing.assert_allclose([0., 0., 0.1, 0.10228396], samples)
 
 
+class DiscreteDistributionTestCase(unittest.TestCase):
+    def test_sample_rounding(self):
+        # the random numbers of the two columns are 0.5488 and 0.4170; the
+        # second one is larger than the sum of the probabilities of the
+        # second column, so the last loss ratio is taken
+        dist = scientific.DiscreteDistribution()
+        probs = numpy.array([[.2, .2], [.8, .1]])
+        numpy.testing.assert_equal(
+            dist.sample([.1, .9], probs, 0), [.9, .9])
+        numpy.testing.assert_equal(
+            dist.sample([.1, .9], numpy.array([[.6], [.4]]), 0), [.1])
+
+
+class CounterEpsilonsTestCase(unittest.TestCase):
+    def test_independent_pairs(self):
+        aids = numpy.arange(100)
+        eids = numpy.arange(50, 250, 2)
+        eps = scientific.counter_epsilons(42, aids[:, None], eids)
+        self.assertEqual(eps.shape, (100, 100))
+        self.assertEqual(eps.dtype, numpy.float32)
+        # the epsilon of a pair does not depend on the other pairs
+        numpy.testing.assert_equal(
+            scientific.counter_epsilons(42, [7, 3], [eids[5], eids[9]]),
+            [eps[7, 5], eps[3, 9]])
+        # nor on the global random state
+        numpy.random.seed(1)
+        numpy.testing.assert_equal(
+            scientific.counter_epsilons(42, aids[:, None], eids), eps)
+        # but it depends on the seed
+        eps43 = scientific.counter_epsilons(43, aids[:, None], eids)
+        self.assertFalse((eps43 == eps).any())
+
+    def test_normal(self):
+        eps = scientific.counter_epsilons(
+            1, numpy.arange(1000)[:, None], numpy.arange(1000))
+        numpy.testing.assert_allclose(eps.mean(), 0, atol=.01)
+        numpy.testing.assert_allclose(eps.std(), 1, atol=.01)
+        corr = numpy.corrcoef(eps[:, 0], eps[:, 1])[0, 1]
+        numpy.testing.assert_allclose(corr, 0, atol=.1)
+
+
+class TopLossesTestCase(unittest.TestCase):
+    periods = numpy.array([30, 60, 120, 240, 480, 960])
+    eff_time = 1000
+
+    def test_losses_by_period(self):
+        # the top losses are enough to compute the losses by period
+        losses = numpy.random.RandomState(42).random_sample(200)
+        k = scientific.num_top_losses(self.periods, self.eff_time)
+        for num_events in (200, 500):
+            _, [top] = scientific.top_losses(numpy.zeros(200), losses, k)
+            numpy.testing.assert_equal(
+                scientific.losses_by_period(
+                    top, self.periods, num_events, self.eff_time),
+                scientific.losses_by_period(
+                    losses, self.periods, num_events, self.eff_time))
+
+    def test_merge(self):
+        rng = numpy.random.RandomState(42)
+        keys = rng.randint(0, 5, 100)
+        losses = rng.random_sample(100)
+        ukeys, top = scientific.top_losses(keys, losses, 4)
+        k1, top1 = scientific.top_losses(keys[:50], losses[:50], 4)
+        k2, top2 = scientific.top_losses(keys[50:], losses[50:], 4)
+        numpy.testing.assert_equal(k1, ukeys)
+        numpy.testing.assert_equal(k2, ukeys)
+        merged = numpy.sort(numpy.concatenate([top1, top2], axis=1))[:, -4:]
+        numpy.testing.assert_equal(merged, top)
+
+
+class RunningStatsTestCase(unittest.TestCase):
+    def test_blocks(self):
+        # the statistics computed block by block are the same as the
+        # statistics computed on the full array
+        fractions = numpy.random.RandomState(42).random_sample((100, 3, 4))
+        stats = scientific.RunningStats((3, 4))
+        for block in (fractions[:7], fractions[7:50], fractions[50:]):
+            stats.update(block)
+        mean, std = stats.get()
+        expected_mean, expected_std = scientific.mean_std(fractions)
+        numpy.testing.assert_allclose(mean, expected_mean)
+        numpy.testing.assert_allclose(std, expected_std)
+
+
 class VulnerabilityLossRatioStepsTestCase(unittest.TestCase):
     IMT = 'PGA'
 